@@ -56,3 +56,12 @@ ORM -- object-to-redis mapper
 from .managers import *
 from .models import *
 from .utils import *
+from .reaper import Reaper
+from .cache import LocalCache
+from .query import Q
+from .ids import RandomIds, TimeOrderedIds, SequenceIds
+from .instrumentation import Instrumentation
+from .pools import POOL_DEFAULTS
+from .sharding import setup_sharded_redis, get_shard
+from .serializers import (Serializer, Codec, PickleCodec, JSONCodec,
+                          MsgpackCodec, CallableCodec, register_codec)
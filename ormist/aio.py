@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio support
+
+Managers get async counterparts of their methods, backed by
+:mod:`redis.asyncio` clients, registered with :func:`ormist.setup_redis`
+along with synchronous ones. The key layout is the same, so synchronous and
+asynchronous code share the data.
+
+.. code-block:: python
+
+    user = await User.objects.acreate(name='John Doe')
+    same_user = await User.objects.aget(user.id)
+    async for book in Book.objects.afind('python'):
+        print(book.title)
+
+Requires Python 3.6+ and redis-py 4.2+.
+"""
+from .compat import u, text
+from .ids import SequenceIds, DEFAULT_ID_STRATEGY
+from .query import Q, QueryCompiler, as_query
+from .scripts import SCRIPTS
+from .sharding import is_sharded, get_shards, get_shard, group_by_shard
+from .utils import chunks, random_string
+
+try:
+    import redis.asyncio as aioredis
+    from redis.exceptions import NoScriptError
+except ImportError:
+    aioredis = None
+
+
+#: clients of systems, which have been used so far, {name: client}
+ASYNC_SYSTEMS = {}
+
+#: configurations of systems, {name: (host, port, kw)}. Clients are created
+#: on first use by :func:`get_async_redis`
+ASYNC_SYSTEM_CONFIGS = {
+    'default': ('localhost', 6379, {}),
+}
+
+
+def setup_async_redis(name, host=None, port=None, **kw):
+    """
+    Setup an asyncio redis system. Usually called by :func:`ormist.setup_redis`
+
+    :param redis: pre-configured :class:`redis.asyncio.Redis` object
+    """
+    redis_instance = kw.pop('redis', None)
+    remove_async_redis(name)
+    if redis_instance:
+        ASYNC_SYSTEMS[name] = redis_instance
+    elif aioredis is not None:
+        ASYNC_SYSTEM_CONFIGS[name] = (host, port, kw)
+
+
+def remove_async_redis(name):
+    """
+    Forget the asyncio redis system, so that async methods fail for it
+    """
+    ASYNC_SYSTEMS.pop(name, None)
+    ASYNC_SYSTEM_CONFIGS.pop(name, None)
+
+
+def get_async_redis(system='default'):
+    """
+    Get a redis.asyncio client instance with entry `system`.
+    """
+    client = ASYNC_SYSTEMS.get(system)
+    if client is None:
+        if system not in ASYNC_SYSTEM_CONFIGS:
+            raise KeyError('The system %r has no async client, pass '
+                           'async_redis to setup_redis()' % system)
+        host, port, kw = ASYNC_SYSTEM_CONFIGS[system]
+        client = ASYNC_SYSTEMS[system] = aioredis.Redis(host=host, port=port, **kw)
+    return client
+
+
+class AsyncManagerMixin(object):
+    """
+    Async methods of :class:`ormist.ModelManager`
+    """
+
+    async def aget(self, id, system=None):
+        system = self.get_system(system)
+        return (await self._aload_many([id], system))[0]
+
+    async def aget_many(self, ids, system=None, only=None, defer=None):
+        system = self.get_system(system)
+        ret = []
+        for chunk in chunks(ids, self.chunk_size):
+            instances = await self._aload_many(chunk, system, only=only,
+                                               defer=defer)
+            ret += [instance for instance in instances if instance]
+        return ret
+
+    async def _aload_many(self, ids, system, only=None, defer=None):
+        ids = [text(u(id)) for id in ids]
+        if is_sharded(system):
+            instances = {}
+            for shard, shard_ids in group_by_shard(system, ids):
+                shard_instances = await self._aload_many(shard_ids, shard, only,
+                                                         defer)
+                instances.update(zip(shard_ids, shard_instances))
+            return [instances[id] for id in ids]
+        fields = await self._aprojection(ids, system, only, defer)
+        records = self._get_cached(ids, fields, system)
+        missing = [id for id in ids if id not in records]
+        if missing:
+            generation = self._cache_generation()
+            pipe = get_async_redis(system).pipeline(transaction=False)
+            self._queue_load(pipe, missing, fields)
+            replies = iter(await pipe.execute())
+            records.update(self._parse_records(missing, replies, fields, system,
+                                               generation))
+        return self._make_instances(ids, records, fields, system)
+
+    async def _aprojection(self, ids, system, only, defer):
+        if self.storage != 'hash' or defer is None or only is not None:
+            return self._projection(ids, system, only, None)
+        pipe = get_async_redis(system).pipeline(transaction=False)
+        self._queue_field_names(pipe, ids)
+        return self._parse_field_names(await pipe.execute(), defer)
+
+    async def acreate(self, *args, **attrs):
+        instance = self.model(*args, **attrs)
+        await self.asave_instance(instance)
+        return instance
+
+    async def asave_instance(self, instance, system=None, force=False):
+        system = self.get_system(system)
+        instance._validate()
+        if instance.id is None:
+            instance.id = (await self.anew_ids(1, system=system))[0]
+        system = get_shard(system, instance.id)
+        await self._aload_scripts(system)
+        pipe = get_async_redis(system).pipeline()
+        self._queue_save_instance(pipe, instance, force, system)
+        await self._aexecute(pipe, system)
+
+    async def adelete_instance(self, instance, system=None):
+        await self.adelete_many([instance.id], system=system)
+        instance._mark_unsaved()
+
+    async def adelete_many(self, ids_or_instances, system=None):
+        system = self.get_system(system)
+        for chunk in chunks(ids_or_instances, self.chunk_size):
+            ids = [u(getattr(item, 'id', item)) for item in chunk]
+            for shard, shard_ids in group_by_shard(system, ids):
+                await self._adelete_chunk(shard_ids, shard)
+            # deleted instances are written in full by the next save
+            for item in chunk:
+                if hasattr(item, '_mark_unsaved'):
+                    item._mark_unsaved()
+
+    async def _adelete_chunk(self, ids, system):
+        await self._aload_scripts(system)
+        lookup = get_async_redis(system).pipeline(transaction=False)
+        self._queue_delete_lookup(lookup, ids)
+        records = self._parse_delete_lookup(ids, iter(await lookup.execute()))
+        pipe = get_async_redis(system).pipeline()
+        for id, record in zip(ids, records):
+            self._queue_delete(pipe, id, record, system)
+            self._queue_invalidate(pipe, id, system)
+        await self._aexecute(pipe, system)
+
+    async def anew_ids(self, count, system=None):
+        """
+        The async counterpart of :meth:`ormist.ModelManager.new_ids`
+        """
+        system = self.get_system(system)
+        strategy = self.id_strategy or DEFAULT_ID_STRATEGY
+        if strategy.local:
+            return strategy.generate(self, count, system)
+        if isinstance(strategy, SequenceIds):
+            ids = strategy.take(self, count, system)
+            while len(ids) < count:
+                client = get_async_redis(strategy.counter_system(system))
+                last = await client.incrby(strategy.counter_key(self),
+                                           strategy.block_size)
+                strategy.add_block(self, system, last)
+                ids += strategy.take(self, count - len(ids), system)
+            return ids
+        return [await self.areserve_random_id(system=system)
+                for _ in range(count)]
+
+    async def areserve_random_id(self, max_attempts=10, system=None):
+        system = self.get_system(system)
+        key = self._key('__all__')
+        for _ in range(max_attempts):
+            value = random_string(self.id_length)
+            if await get_async_redis(get_shard(system, value)).sadd(key, value):
+                return value
+        raise RuntimeError('Unable to reserve random id for model "%s"' % self.model_name)
+
+    def aall(self, system=None):
+        """
+        Return :class:`AsyncModelResultSet` with all objects
+        """
+        system = self.get_system(system)
+        all_key = self._key('__all__')
+        return AsyncModelResultSet(self, lambda client: client.smembers(all_key),
+                                   system)
+
+    async def _aload_scripts(self, system):
+        """
+        Load scripts, which haven't been loaded yet, so that queueing them
+        doesn't require synchronous calls
+        """
+        for script in SCRIPTS:
+            if system not in script.systems:
+                await get_async_redis(system).script_load(script.source)
+                script.systems.add(system)
+
+    async def _aexecute(self, pipe, system):
+        """
+        The async counterpart of :meth:`ModelManager._execute`
+        """
+        stack = list(pipe.command_stack)
+        try:
+            ret = await pipe.execute()
+        except NoScriptError:
+            for script in SCRIPTS:
+                script.systems.discard(system)
+            await self._aload_scripts(system)
+            pipe = get_async_redis(system).pipeline()
+            for args, options in stack:
+                pipe.execute_command(*args, **options)
+            ret = await pipe.execute()
+        self._invalidate_executed(stack, system)
+        return ret
+
+
+class AsyncTaggedManagerMixin(AsyncManagerMixin):
+    """
+    Async methods of :class:`ormist.TaggedModelManager`
+    """
+
+    def afind(self, *tags, **kw):
+        """
+        Return :class:`AsyncModelResultSet` with objects having all given
+        tags, which may be combined with :class:`ormist.Q` expressions, like
+        in :meth:`ormist.TaggedModelManager.find`
+        """
+        system = self.get_system(kw.get('system'))
+        if not tags:
+            return AsyncModelResultSet(self, None, system)
+        query = as_query(tags)
+        if query.op == Q.AND and not any(isinstance(child, Q)
+                                         for child in query.children):
+            keys = self._tag_keys(query.children)
+            return AsyncModelResultSet(self, lambda client: client.sinter(*keys),
+                                       system)
+        return AsyncModelResultSet(self, lambda client: self._aquery_ids(query, client),
+                                   system)
+
+    async def _aquery_ids(self, query, client):
+        """
+        Evaluate the query on the server, like :meth:`_store_query` does,
+        and return ids of the result
+        """
+        tags = list(query.tags())
+        pipe = client.pipeline(transaction=False)
+        for key in self._tag_keys(tags):
+            pipe.scard(key)
+        pipe.scard(self._key('__all__'))
+        replies = await pipe.execute()
+        compiler = QueryCompiler(self, dict(zip(tags, replies)), replies[-1])
+        pipe = client.pipeline()
+        key = compiler.compile(pipe, query)
+        index = len(pipe)
+        pipe.smembers(key)
+        if compiler.temp_keys:
+            pipe.delete(*compiler.temp_keys)
+        return (await pipe.execute())[index]
+
+
+class AsyncModelResultSet(object):
+    """
+    The async counterpart of :class:`ormist.ModelResultSet`, supporting
+    ``async for``
+    """
+
+    def __init__(self, manager, fetch_ids, system=None):
+        """
+        :param fetch_ids: function, accepting an async redis client and
+                          returning the awaitable with ids of objects, or
+                          None for the empty result set
+        """
+        self.manager = manager
+        self.fetch_ids = fetch_ids
+        self.system = system
+        self._only = None
+        self._defer = None
+
+    def _clone(self, **attrs):
+        clone = self.__class__(self.manager, self.fetch_ids, self.system)
+        clone._only = self._only
+        clone._defer = self._defer
+        for attr, value in attrs.items():
+            setattr(clone, attr, value)
+        return clone
+
+    def only(self, *fields):
+        return self._clone(_only=fields, _defer=None)
+
+    def defer(self, *fields):
+        return self._clone(_only=None, _defer=fields)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        if self.fetch_ids is None:
+            return
+        system = self.manager.get_system(self.system)
+        for shard in get_shards(system):
+            ids = await self.fetch_ids(get_async_redis(shard))
+            for chunk in chunks(ids, self.manager.chunk_size):
+                instances = await self.manager._aload_many(chunk, shard,
+                                                           only=self._only,
+                                                           defer=self._defer)
+                for instance in instances:
+                    if instance:
+                        yield instance
+
+    async def alist(self):
+        return [instance async for instance in self]
+
+    async def acount(self):
+        return len(await self.alist())
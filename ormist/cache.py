@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+In-process cache of objects
+
+.. code-block:: python
+
+    class Session(ormist.Model):
+        cache = ormist.LocalCache(maxsize=10000, ttl=10)
+
+    # invalidate entries, when other processes change sessions
+    Session.objects.listen_invalidations()
+
+    Session.objects.get(id)  # goes to redis
+    Session.objects.get(id)  # served from the cache
+    Session.objects.cache.stats()
+
+The cache keeps raw records loaded from the database, and every read
+builds a fresh instance, so changes of instances never leak to the cache.
+Records are put to the cache along with the :meth:`LocalCache.generation`
+taken before they've been loaded, so that records, which have been
+invalidated while they were loaded, are dropped. Objects are invalidated
+when writes are queued, and again when they're executed. Until then (and
+longer for systems with read replicas, which may lag behind), objects
+are held out of the cache.
+"""
+import collections
+import logging
+import threading
+import time
+
+import redis
+
+from .compat import u
+from .utils import utcnow
+
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache(object):
+
+    def __init__(self, maxsize=1000, ttl=10):
+        """
+        Create a new cache
+
+        :param maxsize: max number of cached objects, least recently used
+                        ones are evicted first
+        :param ttl: number of seconds to keep objects in the cache. Objects,
+                    expiring earlier, are kept until they expire
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # {key: (deadline, record)}
+        self._data = collections.OrderedDict()
+        # recent invalidations, {key: generation}. Fills older than
+        # _forgotten may be invalidated by entries, which are trimmed
+        self._invalidated = collections.OrderedDict()
+        # {key: deadline} of keys, which aren't cached until the deadline
+        self._held = {}
+        self._generation = 0
+        self._forgotten = 0
+        self._lock = threading.Lock()
+
+    def generation(self):
+        """
+        Return the number of invalidations so far, to pass to :meth:`set`
+        """
+        with self._lock:
+            return self._generation
+
+    def get(self, key):
+        """
+        Return the cached record, or None
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            expire = entry[1]['expire']
+            if expire and expire < utcnow():
+                self.misses += 1
+                return None
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, record, generation=None):
+        """
+        Put the record to the cache
+
+        :param generation: the result of :meth:`generation`, taken before
+                           the record has been loaded. If the key has been
+                           invalidated since then, the record is dropped
+        """
+        with self._lock:
+            if generation is not None and (
+                    generation < self._forgotten or
+                    generation < self._invalidated.get(key, 0)):
+                return
+            if key in self._held:
+                if self._held[key] > time.time():
+                    return
+                del self._held[key]
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, record)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key, hold=None):
+        """
+        Remove the record from the cache
+
+        :param hold: number of seconds, during which the record isn't cached
+                     again, e.g. because the write, which changes it, is not
+                     executed (or replicated) yet. 0 releases the hold, and
+                     None keeps it as it is
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._generation += 1
+            self._invalidated.pop(key, None)
+            self._invalidated[key] = self._generation
+            while len(self._invalidated) > self.maxsize:
+                _, self._forgotten = self._invalidated.popitem(last=False)
+            if hold:
+                now = time.time()
+                self._held[key] = now + hold
+                if len(self._held) > self.maxsize:
+                    self._held = dict((k, deadline) for k, deadline in self._held.items()
+                                      if deadline > now)
+            elif hold is not None:
+                self._held.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+            self._invalidated.clear()
+            self._forgotten = self._generation
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+    def listen(self, redis_instance, channel, system):
+        """
+        Invalidate entries of the system by ids, published to the channel.
+        Runs in a background (daemon) thread, which is returned.
+
+        While the connection is broken, the cache may miss invalidations, so
+        it's cleared after every reconnect.
+        """
+        def run():
+            while True:
+                try:
+                    pubsub = redis_instance.pubsub()
+                    pubsub.subscribe(channel)
+                    self.clear()
+                    for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            self.invalidate((system, u(message['data'])))
+                except redis.ConnectionError:
+                    logger.warning('Lost connection to the invalidation channel',
+                                   exc_info=True)
+                    time.sleep(1)
+
+        thread = threading.Thread(target=run, name='ormist-cache-listener')
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
+import re
 import sys
 
+import redis
+
 #--- py3k compatibility (copied and inspired by six)
 PY3 = sys.version_info[0] == 3
 if PY3:
+    from collections.abc import MutableMapping
     xrange = range
     text = str
     binary = bytes
     def b(s):
         return s.encode("latin-1")
 else:
+    from collections import MutableMapping
     xrange = xrange
     text = unicode
     binary = str
@@ -20,3 +25,27 @@ def u(b):
     if isinstance(b, binary):
         return b.decode('latin-1')
     return b
+
+
+#--- redis-py compatibility
+
+def zadd(client, name, member, score):
+    """
+    Add the member to the sorted set with any version of redis-py (signatures
+    of zadd() are different in them)
+    """
+    return client.execute_command('ZADD', name, score, member)
+
+
+REDIS_PY_VERSION = tuple(int(part) for part in
+                         re.findall(r'\d+', redis.__version__)[:2])
+
+
+def hset(client, name, mapping):
+    """
+    Set fields of the hash with any version of redis-py: hset() accepts
+    mappings since redis-py 3.5, and hmset() is deprecated since 4.0
+    """
+    if REDIS_PY_VERSION >= (3, 5):
+        return client.hset(name, mapping=mapping)
+    return client.hmset(name, mapping)
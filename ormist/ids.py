@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Strategies of allocation of ids for new objects
+
+.. code-block:: python
+
+    class Event(ormist.Model):
+        # ULID-like ids, sortable by creation time, without round trips
+        id_strategy = ormist.TimeOrderedIds()
+
+    class Invoice(ormist.Model):
+        # 1, 2, 3... with one INCRBY per 100 ids
+        id_strategy = ormist.SequenceIds(block_size=100)
+
+By default, random ids are reserved in the set of all objects (one round
+trip per :meth:`ormist.ModelManager.save_instance`, or per chunk of
+:meth:`ormist.ModelManager.save_many`), so that they never collide. Other
+strategies generate ids without checking them: objects with colliding ids
+would overwrite each other.
+"""
+import os
+import threading
+import time
+
+from .sharding import get_shards
+from .utils import random_string, _system_random
+
+
+class RandomIds(object):
+    """
+    Random strings of ``id_length`` letters and digits of the model
+    """
+
+    def __init__(self, check=True):
+        """
+        :param check: reserve ids in the set of all objects, retrying on
+                      collisions. Without the check, ids are generated
+                      locally, and 16 characters make collisions practically
+                      impossible
+        """
+        self.check = check
+
+    @property
+    def local(self):
+        return not self.check
+
+    def generate(self, manager, count, system):
+        if not self.check:
+            return [random_string(manager.id_length) for _ in range(count)]
+        if count == 1:
+            return [manager.reserve_random_id(system=system)]
+        return manager.reserve_random_ids(count, system=system)
+
+
+#: alphabet of Crockford's base32, used by ULIDs
+CROCKFORD_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+
+class TimeOrderedIds(object):
+    """
+    ULID-like ids of 26 characters: 48 bits of milliseconds since the epoch
+    and 80 random bits, encoded with Crockford's base32. Ids sort in the
+    order of their creation (within a millisecond, the order is random).
+    """
+
+    local = True
+
+    def generate(self, manager, count, system):
+        return [self.new_id() for _ in range(count)]
+
+    def new_id(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        value = (int(timestamp * 1000) << 80) | _system_random.getrandbits(80)
+        chars = []
+        for _ in range(26):
+            chars.append(CROCKFORD_ALPHABET[value & 31])
+            value >>= 5
+        return ''.join(reversed(chars))
+
+
+class SequenceIds(object):
+    """
+    Sequential integer ids. Processes reserve blocks of ids with INCRBY of
+    the counter of the model, and hand them out locally, so that only one
+    object of a block costs a round trip. Ids are unique, but objects
+    created by different processes interleave, and ids of blocks, which
+    aren't used up before the process exits, are skipped. The counter
+    survives :meth:`ormist.ModelManager.full_cleanup`, so that ids aren't
+    handed out again.
+    """
+
+    local = False
+
+    def __init__(self, block_size=100):
+        self.block_size = block_size
+        # {(model name, system): [next id, last id]}
+        self._blocks = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def generate(self, manager, count, system):
+        from .managers import get_redis
+        ids = self.take(manager, count, system)
+        while len(ids) < count:
+            client = get_redis(self.counter_system(system))
+            self.add_block(manager, system,
+                           client.incrby(self.counter_key(manager), self.block_size))
+            ids += self.take(manager, count - len(ids), system)
+        return ids
+
+    def counter_key(self, manager):
+        return manager._key('__sequence__')
+
+    def counter_system(self, system):
+        # the only counter of sharded systems lives on their first shard
+        return get_shards(system)[0]
+
+    def take(self, manager, count, system):
+        """
+        Return at most count ids of the current block
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # blocks of the parent process are used by the parent
+                self._blocks.clear()
+                self._pid = os.getpid()
+            block = self._blocks.get((manager.model_name, system))
+            if block is None:
+                return []
+            start = block[0]
+            stop = min(start + count, block[1] + 1)
+            block[0] = stop
+            return [str(id) for id in range(start, stop)]
+
+    def add_block(self, manager, system, last):
+        """
+        Replace the current block with the one ending with the last id,
+        which INCRBY of the counter has returned
+        """
+        with self._lock:
+            self._blocks[(manager.model_name, system)] = [last - self.block_size + 1,
+                                                          last]
+
+
+#: the strategy of models, which don't define their own one
+DEFAULT_ID_STRATEGY = RandomIds()
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of operations of managers
+
+.. code-block:: python
+
+    stats = ormist.Instrumentation(slow_threshold=0.05)
+    stats.add_hook(after=lambda op: statsd.timing(
+        'ormist.%s.%s' % (op.model, op.name), op.duration * 1000))
+
+    class User(ormist.Model):
+        instrumentation = stats
+
+    # or for all models of the system
+    ormist.setup_redis('default', 'localhost', 6379, instrumentation=stats)
+
+    User.objects.get(id)
+    stats.stats()['user']['get']
+    # {'count': 1, 'round_trips': 1, 'commands': {'MGET': 2}, ...}
+
+Every call of ``get``, ``save``, ``delete``, ``expire`` and ``exists``,
+every iteration over a result set (``find``) and every ``count`` is an
+operation. Commands issued by operations, called inside other ones (like
+loading objects of a result set), are accounted to the outer operation.
+Iterations of result sets are timed without the time spent by the code
+consuming them. Async methods of managers are not instrumented.
+"""
+import collections
+import logging
+import threading
+from timeit import default_timer
+
+
+logger = logging.getLogger(__name__)
+
+#: upper bounds of buckets of latency histograms, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+#: instrumentations of systems, set up with :func:`ormist.setup_redis`
+SYSTEM_INSTRUMENTATIONS = {}
+
+_local = threading.local()
+
+
+def get_instrumentation(system):
+    return SYSTEM_INSTRUMENTATIONS.get(system)
+
+
+def current_operation():
+    """
+    Return the operation running in the current thread, or None
+    """
+    return getattr(_local, 'operation', None)
+
+
+class Instrumentation(object):
+
+    def __init__(self, slow_threshold=None, slow_log_size=100,
+                 buckets=DEFAULT_BUCKETS):
+        """
+        Create a new instrumentation
+
+        :param slow_threshold: number of seconds. Operations taking longer
+                               are logged with the "ormist.instrumentation"
+                               logger and kept in :attr:`slow_log`. None
+                               disables the slow log
+        :param slow_log_size: max number of operations in :attr:`slow_log`,
+                              older ones are dropped
+        :param buckets: upper bounds of buckets of latency histograms
+        """
+        self.slow_threshold = slow_threshold
+        self.slow_log = collections.deque(maxlen=slow_log_size)
+        self.buckets = tuple(sorted(buckets))
+        self.before_hooks = []
+        self.after_hooks = []
+        # {(model, name): OperationStats}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def add_hook(self, before=None, after=None):
+        """
+        Add functions, called with the :class:`Operation` before it starts
+        and after it's finished. Exceptions of hooks are logged and ignored.
+        """
+        if before:
+            self.before_hooks.append(before)
+        if after:
+            self.after_hooks.append(after)
+
+    def operation(self, model, name, system, autofinish=True):
+        return Operation(self, model, name, system, autofinish=autofinish)
+
+    def stats(self):
+        """
+        Return stats of operations, {model: {operation name: stats}}. Stats
+        are dicts with keys "count", "errors", "total_time", "max_time",
+        "latency" (list of cumulative tuples (upper bound, count), the last
+        one is (inf, count)), "round_trips", "commands" ({command: count}),
+        "pipelines" (number of executed pipelines), "pipelined_commands" and
+        "serialization_time".
+        """
+        ret = {}
+        with self._lock:
+            for (model, name), stats in self._stats.items():
+                ret.setdefault(model, {})[name] = stats.as_dict(self.buckets)
+        return ret
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.slow_log.clear()
+
+    def _started(self, operation):
+        self._call_hooks(self.before_hooks, operation)
+
+    def _finished(self, operation):
+        with self._lock:
+            key = (operation.model, operation.name)
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = OperationStats(len(self.buckets))
+            stats.add(operation, self.buckets)
+        if self.slow_threshold is not None and operation.duration >= self.slow_threshold:
+            self.slow_log.append(operation)
+            logger.warning('Slow operation %r', operation)
+        self._call_hooks(self.after_hooks, operation)
+
+    def _call_hooks(self, hooks, operation):
+        for hook in hooks:
+            try:
+                hook(operation)
+            except Exception:
+                logger.exception('Instrumentation hook failed')
+
+
+class Operation(object):
+    """
+    The operation of the manager, which is being run or has been finished
+
+    The operation is a context manager, which can be entered several times
+    (e.g. for every chunk of a result set). Unless it's created with
+    ``autofinish=False``, it's finished on the first exit, otherwise
+    :meth:`finish` is called explicitly.
+    """
+
+    def __init__(self, instrumentation, model, name, system, autofinish=True):
+        self.instrumentation = instrumentation
+        self.model = model
+        self.name = name
+        self.system = system
+        self.autofinish = autofinish
+        #: number of seconds the operation has been running
+        self.duration = 0.0
+        #: number of seconds spent on serialization and deserialization
+        self.serialization_time = 0.0
+        self.round_trips = 0
+        #: {command: count}
+        self.commands = {}
+        #: sizes of executed pipelines
+        self.pipelines = []
+        #: the exception raised by the operation
+        self.error = None
+        self.finished = False
+        self._started = False
+        self._active = False
+        self._entered_at = None
+
+    def __enter__(self):
+        if current_operation() is not None:
+            # commands go to the outer operation
+            return self
+        if not self._started:
+            self._started = True
+            self.instrumentation._started(self)
+        _local.operation = self
+        self._active = True
+        self._entered_at = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self._active:
+            return
+        self.duration += default_timer() - self._entered_at
+        self._active = False
+        _local.operation = None
+        if exc_value is not None and self.error is None:
+            self.error = exc_value
+        if self.autofinish:
+            self.finish()
+
+    def finish(self):
+        if self._started and not self.finished:
+            self.finished = True
+            self.instrumentation._finished(self)
+
+    def record(self, command, pipelined=False):
+        self.commands[command] = self.commands.get(command, 0) + 1
+        if not pipelined:
+            self.round_trips += 1
+
+    def record_pipeline(self, size):
+        self.pipelines.append(size)
+        self.round_trips += 1
+
+    def trace(self, client):
+        """
+        Return the proxy of the client, which records commands
+        """
+        return TracedClient(client, self)
+
+    def __repr__(self):
+        return '<Operation %s.%s on %s: %.4fs, %d round trips>' % (
+            self.model, self.name, self.system, self.duration,
+            self.round_trips)
+
+
+class NullOperation(object):
+    """
+    The operation of models without instrumentation
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_OPERATION = NullOperation()
+
+
+class OperationStats(object):
+
+    def __init__(self, buckets):
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        # the last bucket is for operations above the last bound
+        self.latency = [0] * (buckets + 1)
+        self.round_trips = 0
+        self.commands = {}
+        self.pipelines = 0
+        self.pipelined_commands = 0
+        self.serialization_time = 0.0
+
+    def add(self, operation, buckets):
+        self.count += 1
+        if operation.error is not None:
+            self.errors += 1
+        self.total_time += operation.duration
+        self.max_time = max(self.max_time, operation.duration)
+        index = 0
+        while index < len(buckets) and operation.duration > buckets[index]:
+            index += 1
+        self.latency[index] += 1
+        self.round_trips += operation.round_trips
+        for command, count in operation.commands.items():
+            self.commands[command] = self.commands.get(command, 0) + count
+        self.pipelines += len(operation.pipelines)
+        self.pipelined_commands += sum(operation.pipelines)
+        self.serialization_time += operation.serialization_time
+
+    def as_dict(self, buckets):
+        latency = []
+        total = 0
+        for bound, count in zip(buckets + (float('inf'), ), self.latency):
+            total += count
+            latency.append((bound, total))
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total_time': self.total_time,
+            'max_time': self.max_time,
+            'latency': latency,
+            'round_trips': self.round_trips,
+            'commands': dict(self.commands),
+            'pipelines': self.pipelines,
+            'pipelined_commands': self.pipelined_commands,
+            'serialization_time': self.serialization_time,
+        }
+
+
+class TracedClient(object):
+    """
+    Proxy of the redis client, which records commands to the operation
+    """
+
+    def __init__(self, client, operation):
+        self._client = client
+        self._operation = operation
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        if name == 'pipeline':
+            def pipeline(*args, **kwargs):
+                return TracedPipeline(attr(*args, **kwargs), self._operation)
+            return pipeline
+        if name.endswith('_iter'):
+            return self._scan_iter(name[:-len('_iter')])
+
+        def command(*args, **kwargs):
+            self._operation.record(command_name(name, args))
+            return attr(*args, **kwargs)
+        return command
+
+    def _scan_iter(self, name):
+        """
+        Return the replacement of scan_iter() and friends, which records
+        every page, because every page is a round trip
+        """
+        scan = getattr(self, name)
+        # the cursor goes after the key, if there's one
+        position = 0 if name == 'scan' else 1
+
+        def scan_iter(*args, **kwargs):
+            cursor = 0
+            while True:
+                cursor, items = scan(*(args[:position] + (cursor, ) + args[position:]),
+                                     **kwargs)
+                if isinstance(items, dict):
+                    # HSCAN
+                    items = items.items()
+                for item in items:
+                    yield item
+                if not int(cursor):
+                    break
+        return scan_iter
+
+
+class TracedPipeline(object):
+    """
+    Proxy of the pipeline, which records commands and its size to the
+    operation
+    """
+
+    def __init__(self, pipe, operation):
+        self._pipe = pipe
+        self._operation = operation
+        self._queued = 0
+
+    def __len__(self):
+        return len(self._pipe)
+
+    def __enter__(self):
+        self._pipe.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._pipe.__exit__(exc_type, exc_value, traceback)
+
+    def __getattr__(self, name):
+        attr = getattr(self._pipe, name)
+        if not callable(attr) or name == 'reset':
+            return attr
+        if name == 'execute':
+            def execute(*args, **kwargs):
+                # redis-py doesn't send empty pipelines
+                if self._queued:
+                    self._operation.record_pipeline(self._queued)
+                self._queued = 0
+                return attr(*args, **kwargs)
+            return execute
+
+        def command(*args, **kwargs):
+            self._queued += 1
+            self._operation.record(command_name(name, args), pipelined=True)
+            return attr(*args, **kwargs)
+        return command
+
+
+def command_name(method, args):
+    """
+    Return the name of the Redis command, sent by the method of the client
+    """
+    if method == 'execute_command':
+        return args[0].upper()
+    return method.upper().replace('_', ' ')
@@ -1,20 +1,103 @@
 # -*- coding: utf-8 -*-
-import pickle
-import redis
+import copy
+import datetime
+import hashlib
+import heapq
+import itertools
+import os
+import sys
+import threading
+from timeit import default_timer
+from contextlib import contextmanager
+from itertools import islice
+from redis.exceptions import NoScriptError, WatchError
 from .utils import (timestamp_to_datetime, datetime_to_timestamp, random_string,
-                    utcnow, random_true)
-from .compat import xrange, b, u
+                    utcnow, chunks, to_score)
+from .compat import xrange, b, u, zadd, hset, text, binary, MutableMapping
+from . import serializers
+from .scripts import SAVE_TAGS, DELETE_TAGGED, REMOVE_STALE_IDS, reload_scripts
+from .query import Q, QueryCompiler, as_query
+from .repair import TagRepairReport, RateLimiter
+from .ids import DEFAULT_ID_STRATEGY, SequenceIds
+from .instrumentation import (SYSTEM_INSTRUMENTATIONS, NULL_OPERATION,
+                              current_operation, get_instrumentation)
+from .pools import POOL_ARGUMENTS, create_redis, connection_stats
+from .sharding import is_sharded, get_shards, get_shard, group_by_shard
 
+if sys.version_info >= (3, 6):
+    from .aio import (AsyncManagerMixin, AsyncTaggedManagerMixin,
+                      setup_async_redis, remove_async_redis)
+else:
+    class AsyncManagerMixin(object):
+        pass
+
+    class AsyncTaggedManagerMixin(AsyncManagerMixin):
+        pass
+
+    setup_async_redis = remove_async_redis = None
+
+
+#: name of the field, which marks existing objects stored as hashes
+HASH_MARKER = '__ormist__'
 
 #--- Systems related ----------------------------------------------
 
-SYSTEMS = {
-    'default': redis.Redis(host='localhost', port=6379)
+#: configurations of systems, {name: (host, port, kw)}. Clients are created
+#: on first use by :func:`get_redis`
+SYSTEM_CONFIGS = {
+    'default': ('localhost', 6379, {}),
 }
 
+# clients of systems, which have been used so far, {name: client}
+_clients = {}
+# ids of processes, which created clients, {name: pid}
+_pids = {}
+_systems_lock = threading.Lock()
+
+
+class Systems(MutableMapping):
+    """
+    Clients of all systems, {name: client}. Clients, which are not created
+    yet, are created on access. Assigned clients are registered like the
+    ones given to :func:`setup_redis`.
+    """
+
+    def __getitem__(self, name):
+        if name not in _clients and name not in SYSTEM_CONFIGS:
+            raise KeyError(name)
+        return _get_client(name)
+
+    def __setitem__(self, name, client):
+        _register_system(name, client, None)
+
+    def __delitem__(self, name):
+        with _systems_lock:
+            if name not in _clients and name not in SYSTEM_CONFIGS:
+                raise KeyError(name)
+            _clients.pop(name, None)
+            SYSTEM_CONFIGS.pop(name, None)
+
+    def __iter__(self):
+        return iter(set(SYSTEM_CONFIGS) | set(_clients))
+
+    def __len__(self):
+        return len(set(SYSTEM_CONFIGS) | set(_clients))
+
+    def created(self):
+        """
+        Return {name: client} of systems, which have been used so far
+        """
+        return dict(_clients)
+
+
+#: clients of systems, {name: client}. See :class:`Systems`
+SYSTEMS = Systems()
+
+
 def setup_redis(name, host=None, port=None, **kw):
     """
-    Setup a redis system.
+    Setup a redis system. The client is created on first use, and its
+    connections are dropped in child processes after fork.
 
     :param name: The name of the system
     :param host: The host of the redis installation
@@ -22,6 +105,32 @@ def setup_redis(name, host=None, port=None, **kw):
     :param redis: It's a special keyword. If you don't want to use standard
                   :class:`redis.Redis` and have your own pre-configured
                   object, feel free to pass it as a "redis" parameter
+    :param serializer: It's a special keyword too. The instance of
+                  :class:`ormist.Serializer` to use for models of the system,
+                  which don't define their own serializer
+    :param replicas: It's a special keyword too. The list of read replicas
+                  of the system: pre-configured :class:`redis.Redis`
+                  objects, or dicts of arguments, which override
+                  arguments of the primary. Managers send read-only
+                  operations to replicas, unless they're in the
+                  :func:`use_primary` block
+    :param replica_strategy: "round_robin" (default) to use replicas in
+                  turn, or "least_loaded" to use the replica with the least
+                  number of connections in use
+    :param max_connections: the max number of connections in the pool,
+                  :data:`POOL_DEFAULTS` by default
+    :param blocking_pool: if True, wait up to ``pool_timeout`` seconds for a
+                  free connection, when all of them are in use, instead of
+                  raising ConnectionError
+    :param instrumentation: It's a special keyword too. The instance of
+                  :class:`ormist.Instrumentation` to use for models of the
+                  system, which don't define their own instrumentation
+    :param async_redis: It's a special keyword too. Pre-configured
+                  :class:`redis.asyncio.Redis` object, used by async methods
+                  of managers. By default, it's created with the same
+                  arguments as the synchronous client, if redis.asyncio is
+                  available (Python 3.6+, redis-py 4.2+). Systems with a
+                  custom ``redis`` object have no async client by default
     :param \*\*kw: Any additional keyword arguments to be passed to
                   :class:`redis.Redis`.
 
@@ -29,11 +138,55 @@ def setup_redis(name, host=None, port=None, **kw):
 
         setup_redis('stats_redis', 'localhost', 6380)
         mark_event('active', 1, system='stats_redis')
+        setup_redis('default', 'primary', 6379, max_connections=50,
+                    replicas=[{'host': 'replica1'}, {'host': 'replica2'}])
     """
     redis_instance = kw.pop('redis', None)
-    if not redis_instance:
-        redis_instance = redis.Redis(host=host, port=port, **kw)
-    SYSTEMS[name] = redis_instance
+    async_redis_instance = kw.pop('async_redis', None)
+    replicas = kw.pop('replicas', None)
+    replica_strategy = kw.pop('replica_strategy', 'round_robin')
+    serializer = kw.pop('serializer', None)
+    if serializer:
+        serializers.SYSTEM_SERIALIZERS[name] = serializer
+    instrumentation = kw.pop('instrumentation', None)
+    if instrumentation:
+        SYSTEM_INSTRUMENTATIONS[name] = instrumentation
+    if setup_async_redis is not None:
+        if async_redis_instance or not redis_instance:
+            async_kw = dict((key, value) for key, value in kw.items()
+                            if key not in POOL_ARGUMENTS)
+            setup_async_redis(name, host, port, redis=async_redis_instance,
+                              **async_kw)
+        else:
+            # we can't guess how to connect to a custom synchronous client,
+            # and async methods mustn't go to another server
+            remove_async_redis(name)
+    _register_system(name, redis_instance, (host, port, kw))
+    REPLICAS.pop(name, None)
+    if replicas:
+        names = []
+        for i, replica in enumerate(replicas):
+            replica_name = '%s:replica%d' % (name, i)
+            if isinstance(replica, dict):
+                params = dict(kw)
+                params.update(replica)
+                _register_system(replica_name, None,
+                                 (params.pop('host', host), params.pop('port', port), params))
+            else:
+                _register_system(replica_name, replica, None)
+            names.append(replica_name)
+        REPLICAS[name] = ReplicaSet(names, strategy=replica_strategy)
+
+
+def _register_system(name, redis_instance, config):
+    with _systems_lock:
+        _clients.pop(name, None)
+        SYSTEM_CONFIGS.pop(name, None)
+        if redis_instance is not None:
+            _clients[name] = redis_instance
+            _pids[name] = os.getpid()
+        else:
+            SYSTEM_CONFIGS[name] = config
 
 
 def get_redis(system='default'):
@@ -42,23 +195,197 @@ def get_redis(system='default'):
 
     :param :system The name of the system, extra systems can be setup via `setup_redis`
     """
-    return SYSTEMS[system]
+    return _trace(_get_client(system))
+
+
+def _get_client(system):
+    client = _clients.get(system)
+    if client is None:
+        with _systems_lock:
+            client = _clients.get(system)
+            if client is None:
+                host, port, kw = SYSTEM_CONFIGS[system]
+                client = create_redis(host, port, **kw)
+                _pids[system] = os.getpid()
+                _clients[system] = client
+    elif _pids[system] != os.getpid():
+        # the process has been forked: connections belong to the parent, and
+        # sharing them would mix up replies
+        with _systems_lock:
+            if _pids[system] != os.getpid():
+                client.connection_pool.reset()
+                _pids[system] = os.getpid()
+    return client
+
+
+def pool_stats(system=None):
+    """
+    Return stats of the connection pool of the system: the dict with
+    numbers of connections "created", "in_use", "idle", and
+    "max_connections". Blocking pools report the number of "waits" for a
+    free connection too. If the system is not given, return {name: stats}
+    for all systems, which have been used so far, including replicas.
+    """
+    if system is None:
+        return dict((name, connection_stats(client))
+                    for name, client in SYSTEMS.created().items())
+    return connection_stats(_get_client(system))
+
+
+def _trace(client):
+    """
+    Return the client, recording commands to the operation running in the
+    current thread, if there's one
+    """
+    operation = current_operation()
+    if operation is None:
+        return client
+    return operation.trace(client)
+
+
+#: read replicas of systems, {name: ReplicaSet}
+REPLICAS = {}
 
+_local = threading.local()
 
 
-class ModelManager(object):
+class ReplicaSet(object):
+
+    strategies = ('round_robin', 'least_loaded')
+
+    def __init__(self, replicas, strategy='round_robin'):
+        """
+        :param replicas: list of clients or names of systems
+        """
+        if strategy not in self.strategies:
+            raise RuntimeError('Unknown replica strategy %r' % strategy)
+        self.replicas = replicas
+        self.strategy = strategy
+        self._counter = itertools.count()
+
+    @property
+    def clients(self):
+        return [_get_client(replica) if isinstance(replica, (text, binary)) else replica
+                for replica in self.replicas]
+
+    def choose(self):
+        """
+        Return the client of the replica to send the next read to
+        """
+        clients = self.clients
+        start = next(self._counter) % len(clients)
+        # ties of least loaded replicas are broken in turn
+        clients = clients[start:] + clients[:start]
+        if self.strategy == 'least_loaded':
+            return min(clients, key=lambda client: connection_stats(client)['in_use'])
+        return clients[0]
+
+
+def get_read_redis(system='default'):
+    """
+    Get a redis-py client instance for read-only operations with the
+    system: one of its replicas, or the primary, if the system has no
+    replicas, or if it's called in the :func:`use_primary` block
+    """
+    replicas = REPLICAS.get(system)
+    if replicas is None or getattr(_local, 'use_primary', 0):
+        return get_redis(system)
+    return _trace(replicas.choose())
+
+
+@contextmanager
+def use_primary():
+    """
+    Send all operations of the current thread to primaries of systems,
+    e.g. to read what has just been written, while replicas may lag behind::
+
+        with use_primary():
+            user.save()
+            user = User.objects.get(user.id)
+    """
+    _local.use_primary = getattr(_local, 'use_primary', 0) + 1
+    try:
+        yield
+    finally:
+        _local.use_primary -= 1
+
+
+
+class ModelManager(AsyncManagerMixin):
     # metaclass ModelBase ensures this object has "model_name", "id_length"
     # and "model" attribute,
 
+    #: max number of objects loaded with a single pipeline by
+    #: :meth:`get_many` and :class:`ModelResultSet`
+    chunk_size = 100
+
+    #: suffixes of auxiliary keys "object:<id>:<suffix>" an object may own.
+    #: Subclasses storing more per-object keys must extend this list, so
+    #: that the keys are removed along with the object
+    object_keys = ('expire', )
+
+    #: suffixes of auxiliary keys of an object, which don't get TTLs in the
+    #: native TTL mode, because they're required to clean up after it
+    persistent_object_keys = ('expire', )
+
+    #: names of attributes, which are indexed with sorted sets, so that
+    #: objects can be found by ranges of their values. Set with the
+    #: ``indexes`` attribute of the model
+    indexes = ()
+
+    #: Redis Cluster mode, set with the ``cluster`` attribute of the model.
+    #: Keys of every object are hash-tagged with its id, so that they're in
+    #: the same hash slot, and keys of collections are hash-tagged with the
+    #: model name, so that set operations over them work
+    cluster = False
+
+    #: number of seconds temporary keys (like stored intersections of tags)
+    #: live, unless they're removed explicitly
+    temp_key_ttl = 60
+
+    #: :class:`ormist.Instrumentation`, recording operations of the model.
+    #: Set with the ``instrumentation`` attribute of the model
+    instrumentation = None
+
+    #: native TTL mode, set with the ``native_ttl`` attribute of the model.
+    #: Keys of expiring objects get PEXPIREAT, so that Redis removes them in
+    #: time, and objects are loaded along with their PTTL. The expiration
+    #: index is still maintained, so that :meth:`expire` removes expired
+    #: objects from sets of all objects, tags and sorted indexes
+    native_ttl = False
+
+    #: keep loaded payloads of instances undecoded until their attributes
+    #: are accessed. Set with the ``compact`` attribute of the model, which
+    #: also removes ``__dict__`` from instances
+    compact = False
+
+    #: the strategy of allocation of ids for new objects, see
+    #: :mod:`ormist.ids`. Set with the ``id_strategy`` attribute of the model
+    id_strategy = None
+
     def _key(self, key, *args, **kwargs):
         key = u(key)
         prefix = 'ormist'
         model_name = self.model_name
-        template = '{0}:{1}:{2}'.format(prefix, model_name, key)
+        if self.cluster:
+            if key.startswith('object:'):
+                args = ('{%s}' % u(args[0]), ) + args[1:]
+            else:
+                model_name = '{%s}' % model_name
 
         if args or kwargs:
-            template = template.format(*args, **kwargs)
-        return b(template)
+            key = key.format(*args, **kwargs)
+        return b('{0}:{1}:{2}'.format(prefix, model_name, key))
+
+    def _key_patterns(self):
+        """
+        Return the list of SCAN patterns matching all keys of the model
+        """
+        patterns = [self._key('*')]
+        if self.cluster:
+            # object keys are outside of the hash slot of the model
+            patterns.append(b('ormist:{0}:object:*'.format(self.model_name)))
+        return patterns
 
     def set_system(self, system):
         """
@@ -73,119 +400,1173 @@ class ModelManager(object):
         """
         return arg or self.system
 
-    def full_cleanup(self, system=None):
+    def get_serializer(self, system):
+        """
+        get serializer to use for the system: serializer of the model, if it's
+        defined, or the serializer of the system otherwise
+        """
+        return self.serializer or serializers.get_serializer(system)
+
+    def _operation(self, name, system, autofinish=True):
+        """
+        Return the context manager, which records the operation to the
+        instrumentation of the model, or of the system
+        """
+        instrumentation = self.instrumentation or get_instrumentation(system)
+        if instrumentation is None:
+            return NULL_OPERATION
+        return instrumentation.operation(self.model_name, name, system,
+                                         autofinish=autofinish)
+
+    def full_cleanup(self, system=None, batch_size=1000, unlink=True,
+                     callback=None):
+        """
+        Remove all keys of the model
+
+        Keys are iterated with SCAN and removed with UNLINK in batches of
+        :param:`batch_size` keys, so that neither command blocks the server
+        for long, and it's safe to run the cleanup against a live instance.
+        The counter of :class:`ormist.SequenceIds` is kept, because other
+        processes may still hand out ids of blocks they've reserved.
+
+        :param unlink: set it to False to use DEL instead of UNLINK (for
+                       Redis < 4.0)
+        :param callback: optional function, called after every batch with
+                         the number of keys removed so far
+        :returns: the number of removed keys
+        """
         system = self.get_system(system)
-        key = self._key('*')
-        keys = get_redis(system).keys(key)
-        if keys:
-            get_redis(system).delete(*keys)
+        if self.cache is not None:
+            self.cache.clear()
+        command = 'UNLINK' if unlink else 'DEL'
+        kept = set()
+        strategy = self.id_strategy or DEFAULT_ID_STRATEGY
+        if isinstance(strategy, SequenceIds):
+            kept.add(strategy.counter_key(self))
+        removed = 0
+        for shard in get_shards(system):
+            redis = get_redis(shard)
+            for pattern in self._key_patterns():
+                keys = (key for key in redis.scan_iter(pattern, count=batch_size)
+                        if key not in kept)
+                for batch in chunks(keys, batch_size):
+                    if self.cluster:
+                        # keys of the batch are in different hash slots
+                        pipe = redis.pipeline(transaction=False)
+                        for key in batch:
+                            pipe.execute_command(command, key)
+                        removed += sum(pipe.execute())
+                    else:
+                        removed += redis.execute_command(command, *batch)
+                    if callback:
+                        callback(removed)
+        return removed
 
     def get(self, id, system=None):
         system = self.get_system(system)
-        id = u(id)
-        if random_true(0.01):
-            self.expire()
-        key = self._key('object:{0}', id)
-        value = get_redis(system).get(key)
-        if value:
-            expire_key = self._key('object:{0}:expire', id)
-            expire_value = get_redis(system).get(expire_key)
-            expire = timestamp_to_datetime(expire_value)
-            if expire and expire < utcnow():
+        with self._operation('get', system):
+            return self._load_many([id], system)[0]
+
+    def exists(self, id, system=None):
+        """
+        Return True, if the object exists and is not expired. Nothing is
+        loaded or deserialized, and it takes one round trip.
+        """
+        system = get_shard(self.get_system(system), id)
+        with self._operation('exists', system):
+            if self.native_ttl:
+                # Redis doesn't see expired keys
+                return bool(get_read_redis(system).exists(self._key('object:{0}', id)))
+            pipe = get_read_redis(system).pipeline(transaction=False)
+            pipe.exists(self._key('object:{0}', id))
+            pipe.get(self._key('object:{0}:expire', id))
+            exists, expire_value = pipe.execute()
+        if not exists:
+            return False
+        expire = timestamp_to_datetime(expire_value)
+        return not expire or expire >= utcnow()
+
+    def get_many(self, ids, system=None, only=None, defer=None):
+        """
+        Get the list of instances by their ids.
+
+        Objects are loaded in chunks of :attr:`chunk_size` items, with one
+        pipeline per chunk. Missing and expired objects are skipped, the
+        order of ids is preserved.
+
+        :param only: list of attributes to load, see :meth:`ModelResultSet.only`
+        :param defer: list of attributes to skip, see :meth:`ModelResultSet.defer`
+        """
+        system = self.get_system(system)
+        ret = []
+        with self._operation('get', system):
+            for chunk in chunks(ids, self.chunk_size):
+                instances = self._load_many(chunk, system, only=only, defer=defer)
+                ret += [instance for instance in instances if instance]
+        return ret
+
+    def _load_many(self, ids, system, only=None, defer=None):
+        """
+        Load a chunk of objects with a single pipeline
+
+        Return the list of the same length as ids, with instances or None
+        for missing and expired objects.
+        """
+        ids = [text(u(id)) for id in ids]
+        if is_sharded(system):
+            instances = {}
+            for shard, shard_ids in group_by_shard(system, ids):
+                shard_instances = self._load_many(shard_ids, shard, only, defer)
+                instances.update(zip(shard_ids, shard_instances))
+            return [instances[id] for id in ids]
+        fields = self._projection(ids, system, only, defer)
+        records = self._get_cached(ids, fields, system)
+        missing = [id for id in ids if id not in records]
+        if missing:
+            generation = self._cache_generation()
+            pipe = get_read_redis(system).pipeline(transaction=False)
+            self._queue_load(pipe, missing, fields)
+            replies = iter(pipe.execute())
+            records.update(self._parse_records(missing, replies, fields, system,
+                                               generation))
+        return self._make_instances(ids, records, fields, system)
+
+    def _get_cached(self, ids, fields, system):
+        """
+        Return the dict {id: record} of objects found in the cache
+        """
+        records = {}
+        # projections bypass the cache
+        if self.cache is not None and fields is None:
+            for id in ids:
+                record = self.cache.get((system, id))
+                if record:
+                    records[id] = record
+        return records
+
+    def _cache_generation(self):
+        """
+        Return the generation of the cache to pass to :meth:`_parse_records`,
+        taken before objects are loaded
+        """
+        if self.cache is not None:
+            return self.cache.generation()
+        return None
+
+    def _parse_records(self, ids, replies, fields, system, generation=None):
+        """
+        Parse replies of commands added by :meth:`_queue_load`, put records
+        to the cache, and return them as the dict {id: record}
+
+        :param generation: the result of :meth:`_cache_generation`. Records
+                           of objects invalidated since then aren't cached
+        """
+        records = dict(zip(ids, self._parse_load(ids, replies, fields)))
+        if self.cache is not None and fields is None:
+            for id, record in records.items():
+                if record:
+                    self.cache.set((system, id), record, generation)
+        return records
+
+    def _make_instances(self, ids, records, fields, system):
+        instances = []
+        for id in ids:
+            record = records[id]
+            instance = None
+            if record:
+                instance = self._make_instance(id, record)
+                instance._partial = fields is not None
+                instance._mark_saved(system)
+            instances.append(instance)
+        return instances
+
+    def _projection(self, ids, system, only, defer):
+        """
+        Return the list of fields to load, or None to load all of them.
+
+        Projections make sense for models stored as hashes only, strings
+        are always loaded completely.
+        """
+        if self.storage != 'hash':
+            return None
+        if only is not None:
+            return list(only)
+        if defer is not None:
+            # we need one more pipeline to find out which fields to load
+            pipe = get_read_redis(system).pipeline(transaction=False)
+            self._queue_field_names(pipe, ids)
+            return self._parse_field_names(pipe.execute(), defer)
+        return None
+
+    def _queue_field_names(self, pipe, ids):
+        for id in ids:
+            pipe.hkeys(self._key('object:{0}', id))
+
+    def _parse_field_names(self, replies, defer):
+        fields = set()
+        for names in replies:
+            fields.update(u(name) for name in names)
+        fields.discard(HASH_MARKER)
+        return list(fields - set(defer))
+
+    def _queue_load(self, pipe, ids, fields=None):
+        """
+        Add commands loading objects with given ids to the pipeline
+        """
+        if self.storage == 'hash':
+            for id in ids:
+                key = self._key('object:{0}', id)
+                if fields is None:
+                    pipe.hgetall(key)
+                else:
+                    pipe.hmget(key, [HASH_MARKER] + fields)
+        elif self.cluster:
+            # MGET can't fetch keys from different hash slots
+            for id in ids:
+                pipe.get(self._key('object:{0}', id))
+        else:
+            pipe.mget([self._key('object:{0}', id) for id in ids])
+        if self.native_ttl:
+            for id in ids:
+                pipe.pttl(self._key('object:{0}', id))
+        elif self.cluster:
+            for id in ids:
+                pipe.get(self._key('object:{0}:expire', id))
+        else:
+            pipe.mget([self._key('object:{0}:expire', id) for id in ids])
+
+    def _parse_load(self, ids, replies, fields=None):
+        """
+        Consume replies of commands added by :meth:`_queue_load` and
+        return the list of records (dicts) or None for every id
+        """
+        if self.storage == 'hash':
+            values = [self._parse_hash(next(replies), fields) for _ in ids]
+        elif self.cluster:
+            values = [next(replies) for _ in ids]
+        else:
+            values = next(replies)
+        if self.native_ttl or self.cluster:
+            expire_values = [next(replies) for _ in ids]
+        else:
+            expire_values = next(replies)
+        now = utcnow()
+        records = []
+        for value, expire_value in zip(values, expire_values):
+            record = None
+            if value and self.native_ttl:
+                # the reply is PTTL: -1 for keys without TTL (None with
+                # redis-py 2.x)
+                expire = None
+                if expire_value is not None and expire_value >= 0:
+                    expire = now + datetime.timedelta(milliseconds=expire_value)
+                record = {'value': value, 'expire': expire}
+            elif value:
+                expire = timestamp_to_datetime(expire_value)
+                if not expire or expire >= now:
+                    record = {'value': value, 'expire': expire}
+            records.append(record)
+        return records
+
+    def _parse_hash(self, reply, fields):
+        """
+        Convert the reply of HGETALL or HMGET to the dict of encoded
+        values, or None, if the object doesn't exist
+        """
+        if fields is not None:
+            if reply[0] is None:
                 return None
-            attrs = pickle.loads(value)
-            return self.model(id=id, expire=expire, **attrs)
+            return dict((field, value) for field, value in zip(fields, reply[1:])
+                        if value is not None)
+        if not reply:
+            return None
+        reply = dict((u(field), value) for field, value in reply.items())
+        reply.pop(HASH_MARKER, None)
+        return reply
+
+    def _make_instance(self, id, record):
+        value = record['value']
+        if self.compact:
+            instance = self.model(id=id, expire=record['expire'])
+            # decoded on first access. Records may be shared with the cache,
+            # and fields of hashes are removed from raw ones, when decoded
+            instance._set_raw(dict(value) if isinstance(value, dict) else value)
+            return instance
+        operation = current_operation()
+        started = operation and default_timer()
+        if isinstance(value, dict):
+            attrs = dict((field, serializers.loads(field_value))
+                         for field, field_value in value.items())
+        else:
+            attrs = serializers.loads(value)
+        if operation:
+            operation.serialization_time += default_timer() - started
+        return self.model(id=id, expire=record['expire'], **attrs)
 
     def create(self, *args, **attrs):
         model = self.model(*args, **attrs)
         model.save()
         return model
 
-    def save_instance(self, instance, system=None):
+    def create_many(self, items, system=None):
+        """
+        Create and save a bunch of instances with :meth:`save_many`
+
+        :param items: iterable of dicts with attributes of new instances, or
+                      of tuples (args, attrs) for models accepting
+                      positional arguments (like tags of tagged models)
+        :returns: the list of created instances
+        """
+        instances = []
+        for item in items:
+            if isinstance(item, dict):
+                args, attrs = (), item
+            else:
+                args, attrs = item
+            instances.append(self.model(*args, **attrs))
+        self.save_many(instances, system=system)
+        return instances
+
+    def save_instance(self, instance, pipe=None, apply=True, system=None,
+                      force=False):
+        """
+        Save the instance
+
+        Instances, loaded from (or saved to) the same system before, write
+        only what has been changed since then, and nothing at all if nothing
+        has been changed.
+
+        :param force: write the whole object, as if it was a new one
+        """
         system = self.get_system(system)
-        if instance.id is None:
-            instance.id = self.reserve_random_id(system=system)
+        with self._operation('save', system):
+            if instance.id is None:
+                instance.id = self.new_ids(1, system)[0]
+            system = get_shard(system, instance.id)
+            if pipe is None:
+                pipe = get_redis(system).pipeline()
+            self._queue_save_instance(pipe, instance, force, system)
+            if apply:
+                self._execute(pipe, system)
 
-        # object itself
-        value = pickle.dumps(instance.attrs)
+    def _queue_save_instance(self, pipe, instance, force, system):
+        """
+        Add commands saving the instance and invalidating caches to the
+        pipeline
+        """
+        full = force or instance._saved_system != system
+        queued = len(pipe)
+        self._queue_save(pipe, instance, full, system)
+        if len(pipe) > queued:
+            # the object may have been deleted since it was loaded, and
+            # SADD is idempotent
+            pipe.sadd(self._key('__all__'), instance.id)
+            if self.native_ttl:
+                self._queue_ttl(pipe, instance)
+            self._queue_invalidate(pipe, instance.id, system)
+        instance._mark_saved(system)
 
-        pipe = get_redis(system).pipeline()
-        pipe.sadd(self._key('__all__'), instance.id)
-        pipe.set(self._key('object:{0}', instance.id), value)
+    def _queue_ttl(self, pipe, instance):
+        """
+        Add commands setting TTLs of keys of the object to the pipeline.
+        Writes (like SET) drop TTLs, so it goes after other commands saving
+        the object.
+        """
+        keys = [self._key('object:{0}', instance.id)]
+        for suffix in self.object_keys:
+            if suffix not in self.persistent_object_keys:
+                keys.append(self._key('object:{0}:{1}', instance.id, suffix))
         if instance.expire:
-            expire_ts = datetime_to_timestamp(instance.expire)
-            pipe.set(self._key('object:{0}:expire', instance.id), expire_ts)
-            pipe.zadd(self._key('__expire__'), instance.id, expire_ts)
-        pipe.execute()
+            when = int(datetime_to_timestamp(instance.expire) * 1000)
+            for key in keys:
+                pipe.pexpireat(key, when)
+        elif instance._saved_expire:
+            for key in keys:
+                pipe.persist(key)
+
+    def _queue_save(self, pipe, instance, full, system):
+        """
+        Add commands saving the instance to the pipeline
+
+        :param full: if False, save only changes since the last load or save
+        """
+        changed, removed = instance._get_changes()
+        if full:
+            changed, removed = set(instance.attrs), set()
+
+        # object itself
+        serializer = self.get_serializer(system)
+        key = self._key('object:{0}', instance.id)
+        operation = current_operation()
+        started = operation and default_timer()
+        if self.storage == 'hash':
+            value = dict((field, serializer.dumps(instance.attrs[field]))
+                         for field in changed)
+        elif changed or removed or full:
+            value = serializer.dumps(instance.attrs)
+        if operation:
+            operation.serialization_time += default_timer() - started
+        if self.storage == 'hash':
+            if full and not instance._partial:
+                # partially loaded instances don't know about all fields
+                pipe.delete(key)
+            if full or changed or removed:
+                # the marker recreates the object, if it's been deleted
+                value[HASH_MARKER] = 1
+                hset(pipe, key, value)
+            if removed:
+                pipe.hdel(key, *removed)
+        elif changed or removed or full:
+            pipe.set(key, value)
+
+        # expiration
+        if full or instance.expire != instance._saved_expire:
+            expire_key = self._key('object:{0}:expire', instance.id)
+            if instance.expire:
+                expire_ts = datetime_to_timestamp(instance.expire)
+                if not self.native_ttl:
+                    pipe.set(expire_key, expire_ts)
+                zadd(pipe, self._key('__expire__'), instance.id, expire_ts)
+            elif not full:
+                if not self.native_ttl:
+                    pipe.delete(expire_key)
+                pipe.zrem(self._key('__expire__'), instance.id)
+
+        # sorted indexes
+        for attr in self.indexes:
+            if full or attr in changed or attr in removed:
+                value = instance.attrs.get(attr)
+                if value is not None:
+                    zadd(pipe, self._index_key(attr), instance.id,
+                         to_score(value))
+                elif not full:
+                    pipe.zrem(self._index_key(attr), instance.id)
+
+    def save_many(self, instances, system=None):
+        """
+        Save a bunch of instances
+
+        Instances are written in chunks of :attr:`chunk_size` items, with
+        one pipeline per chunk (and per shard of sharded systems). Ids for
+        instances without them are reserved with one more pipeline per chunk.
+        """
+        system = self.get_system(system)
+        with self._operation('save', system):
+            for chunk in chunks(instances, self.chunk_size):
+                self._save_chunk(chunk, system)
+
+    def _save_chunk(self, chunk, system):
+        for instance in chunk:
+            instance._validate()
+        new_instances = [instance for instance in chunk if instance.id is None]
+        if new_instances:
+            ids = self.new_ids(len(new_instances), system)
+            for instance, id in zip(new_instances, ids):
+                instance.id = id
+        get_id = lambda instance: instance.id
+        for shard, shard_chunk in group_by_shard(system, chunk, get_id):
+            pipe = get_redis(shard).pipeline()
+            for instance in shard_chunk:
+                self.save_instance(instance, pipe=pipe, apply=False,
+                                   system=shard)
+            self._execute(pipe, shard)
 
     def delete_instance(self, instance, system=None):
         self.delete_instance_by_id(instance.id, system=system)
+        instance._mark_unsaved()
 
     def delete_instance_by_id(self, instance_id, pipe=None, apply=True,
                               system=None):
-        system = self.get_system(system)
         instance_id = u(instance_id)
-        all_key = self._key('__all__')
-        expire_key = self._key('__expire__')
-        key = self._key('object:{0}', instance_id)
-        extra_keys = get_redis(system).keys(self._key('object:{0}:*', instance_id))
-        if not pipe:
+        system = get_shard(self.get_system(system), instance_id)
+        with self._operation('delete', system):
+            lookup = get_redis(system).pipeline(transaction=False)
+            self._queue_delete_lookup(lookup, [instance_id])
+            record = self._parse_delete_lookup([instance_id],
+                                               iter(lookup.execute()))[0]
+            if pipe is None:
+                pipe = get_redis(system).pipeline()
+            self._queue_delete(pipe, instance_id, record, system)
+            self._queue_invalidate(pipe, instance_id, system)
+            if apply:
+                self._execute(pipe, system)
+
+    def delete_many(self, ids_or_instances, system=None):
+        """
+        Delete a bunch of objects, given by ids or instances
+
+        Objects are deleted in chunks of :attr:`chunk_size` items, with one
+        pipeline per chunk. Models, which have to look up something before
+        deleting (like tagged models do), spend one more pipeline per chunk.
+        """
+        system = self.get_system(system)
+        with self._operation('delete', system):
+            for chunk in chunks(ids_or_instances, self.chunk_size):
+                ids = [u(getattr(item, 'id', item)) for item in chunk]
+                for shard, shard_ids in group_by_shard(system, ids):
+                    self._delete_chunk(shard_ids, shard)
+                # deleted instances are written in full by the next save
+                for item in chunk:
+                    if hasattr(item, '_mark_unsaved'):
+                        item._mark_unsaved()
+
+    def _delete_chunk(self, ids, system):
+        lookup = get_redis(system).pipeline(transaction=False)
+        self._queue_delete_lookup(lookup, ids)
+        records = self._parse_delete_lookup(ids, iter(lookup.execute()))
+        pipe = get_redis(system).pipeline()
+        for id, record in zip(ids, records):
+            self._queue_delete(pipe, id, record, system)
+            self._queue_invalidate(pipe, id, system)
+        self._execute(pipe, system)
+
+    def _object_keys(self, id):
+        """
+        Return the list of all keys owned by the object
+        """
+        keys = [self._key('object:{0}', id)]
+        for suffix in self.object_keys:
+            keys.append(self._key('object:{0}:{1}', id, suffix))
+        return keys
+
+    def _queue_delete_lookup(self, pipe, ids):
+        """
+        Add commands, collecting information required to delete objects
+        with given ids, to the pipeline
+        """
+
+    def _parse_delete_lookup(self, ids, replies):
+        """
+        Consume replies of commands added by :meth:`_queue_delete_lookup` and
+        return the list of records (dicts) for every id
+        """
+        return [{} for _ in ids]
+
+    def _queue_delete(self, pipe, id, record, system):
+        """
+        Add commands deleting the object to the pipeline
+        """
+        pipe.srem(self._key('__all__'), id)
+        pipe.zrem(self._key('__expire__'), id)
+        pipe.delete(*self._object_keys(id))
+        self._queue_unindex(pipe, id)
+
+    def _queue_unindex(self, pipe, id):
+        """
+        Add commands removing the object from sorted indexes to the pipeline
+        """
+        for attr in self.indexes:
+            pipe.zrem(self._index_key(attr), id)
+
+    def _queue_invalidate(self, pipe, id, system):
+        """
+        Remove the object from the local cache, and add the command, which
+        invalidates caches of other processes, to the pipeline
+
+        The object isn't cached again, until :meth:`_execute` executes the
+        pipeline, or for the TTL of the cache, if the pipeline is executed
+        by the caller.
+        """
+        if self.cache is not None:
+            self.cache.invalidate((system, text(u(id))), hold=self.cache.ttl)
+            pipe.publish(self._key('__invalidate__'), id)
+
+    def _invalidate_executed(self, stack, system):
+        """
+        Remove objects, invalidated by commands of the executed pipeline,
+        from the local cache again, because they may have been loaded
+        before the pipeline has been executed. Replicas may still return
+        old records, so that objects of systems with replicas are held out
+        of the cache for its TTL.
+        """
+        if self.cache is None:
+            return
+        channel = self._key('__invalidate__')
+        hold = self.cache.ttl if system in REPLICAS else 0
+        for args, options in stack:
+            if args[0].upper() == 'PUBLISH' and b(u(args[1])) == channel:
+                self.cache.invalidate((system, text(u(args[2]))), hold=hold)
+
+    def listen_invalidations(self, system=None):
+        """
+        Start the background thread, which removes objects changed by other
+        processes from the local cache
+
+        :returns: the thread, or the list of threads (one per shard) for
+                  sharded systems
+        """
+        system = self.get_system(system)
+        threads = [self.cache.listen(get_redis(shard), self._key('__invalidate__'),
+                                     shard)
+                   for shard in get_shards(system)]
+        return threads if is_sharded(system) else threads[0]
+
+    def _queue_script(self, pipe, script, keys, args, system):
+        """
+        Add the call of the Lua script to the pipeline
+        """
+        script.load(get_redis(system), system)
+        script.queue(pipe, keys, args)
+
+    def _execute(self, pipe, system):
+        """
+        Execute the pipeline with writes
+
+        If the server has lost its scripts (after restart, failover or
+        SCRIPT FLUSH), load them again and repeat the whole pipeline. It's
+        safe, because all writes we do are idempotent.
+        """
+        stack = list(pipe.command_stack)
+        try:
+            ret = pipe.execute()
+        except NoScriptError:
+            reload_scripts(get_redis(system), system)
             pipe = get_redis(system).pipeline()
-        pipe.srem(all_key, instance_id)
-        pipe.zrem(expire_key, instance_id)
-        pipe.delete(key, *extra_keys)
-        if apply:
-            pipe.execute()
+            for args, options in stack:
+                pipe.execute_command(*args, **options)
+            ret = pipe.execute()
+        self._invalidate_executed(stack, system)
+        return ret
 
-    def expire(self, system=None):
+    def expire(self, system=None, limit=None):
+        """
+        Remove expired objects from the database
+
+        Expired objects are never returned by the manager, but they're kept
+        in the database until this method is called. Usually it's a job of
+        :class:`ormist.reaper.Reaper`.
+
+        :param limit: max number of objects to remove, None means "no limit"
+        :returns: the number of removed objects
+        """
         system = self.get_system(system)
         expire_ts = datetime_to_timestamp(utcnow())
         expire_key = self._key('__expire__')
-        remove_ids = get_redis(system).zrangebyscore(expire_key, 0, expire_ts)
-        if remove_ids:
-            pipe = get_redis(system).pipeline()
-            for id in remove_ids:
-               self.delete_instance_by_id(id, pipe=pipe, apply=False,
-                                          system=system)
-            pipe.execute()
+        removed = 0
+        with self._operation('expire', system):
+            for shard in get_shards(system):
+                num = None if limit is None else limit - removed
+                if num is not None and num <= 0:
+                    break
+                start = 0 if num is not None else None
+                remove_ids = get_redis(shard).zrangebyscore(
+                    expire_key, 0, expire_ts, start=start, num=num)
+                if remove_ids:
+                    self.delete_many(remove_ids, system=shard)
+                removed += len(remove_ids)
+        return removed
+
+    def expire_lag(self, system=None):
+        """
+        Return the number of seconds the oldest expired object, which is not
+        removed yet, is past its expiration time, or 0, if there are no
+        such objects
+        """
+        system = self.get_system(system)
+        expire_key = self._key('__expire__')
+        oldest = []
+        for shard in get_shards(system):
+            oldest += get_read_redis(shard).zrange(expire_key, 0, 0,
+                                                   withscores=True)
+        if not oldest:
+            return 0
+        lag = datetime_to_timestamp(utcnow()) - min(score for _, score in oldest)
+        return max(lag, 0)
+
+    def new_ids(self, count, system=None):
+        """
+        Return the list of ids for new objects, allocated with the id
+        strategy of the model
+        """
+        system = self.get_system(system)
+        strategy = self.id_strategy or DEFAULT_ID_STRATEGY
+        return strategy.generate(self, count, system)
 
     def reserve_random_id(self, max_attempts=10, system=None):
         system = self.get_system(system)
         key = self._key('__all__')
         for _ in xrange(max_attempts):
             value = random_string(self.id_length)
-            ret = get_redis(system).sadd(key, value)
+            ret = get_redis(get_shard(system, value)).sadd(key, value)
             if ret != 0:
                 return value
         raise RuntimeError('Unable to reserve random id for model "%s"' % self.model_name)
 
-    def all(self, system=None):
+    def reserve_random_ids(self, count, max_attempts=10, system=None):
+        """
+        Reserve :param:`count` random ids at once
+
+        Every attempt is one pipeline, which tries to reserve all ids which
+        are still missing.
+        """
         system = self.get_system(system)
-        all_key = self._key('__all__')
+        key = self._key('__all__')
         ids = []
-        if get_redis(system).exists(all_key):
-            ids = get_redis(system).smembers(all_key)
-        return ModelResultSet(self, ids, system)
+        for _ in xrange(max_attempts):
+            values = [random_string(self.id_length)
+                      for _ in xrange(count - len(ids))]
+            for shard, shard_values in group_by_shard(system, values):
+                pipe = get_redis(shard).pipeline(transaction=False)
+                for value in shard_values:
+                    pipe.sadd(key, value)
+                ids += [value for value, ret in zip(shard_values, pipe.execute())
+                        if ret != 0]
+            if len(ids) == count:
+                return ids
+        raise RuntimeError('Unable to reserve random ids for model "%s"' % self.model_name)
+
+    def all(self, system=None):
+        system = self.get_system(system)
+        return ModelResultSet(self, system=system, keys=[self._key('__all__')])
+
+    def _store_result(self, result_set, system):
+        """
+        Evaluate the source of ids of the result set on the server side. The
+        ordering of the result set isn't applied, see :meth:`_ordered_result`
+
+        :returns: tuple (key, temp, zset): the key with ids, True if it's a
+                  temporary key to remove after use, and True if it's a
+                  sorted set
+        """
+        if result_set.query is not None:
+            key, temp_keys = self._store_query(result_set.query, system)
+        elif len(result_set.keys) == 1:
+            key, temp_keys = result_set.keys[0], []
+        elif self._caches_queries(result_set):
+            key, temp_keys = self._cached_intersection(result_set.keys, system), []
+        else:
+            key = self._store_intersection(result_set.keys, system)
+            temp_keys = [key]
+        zset = False
+        if result_set.ranges:
+            key = self._store_ranges(key, result_set.ranges, temp_keys, system)
+            temp_keys, zset = [key], True
+        return key, bool(temp_keys), zset
+
+    def _ordered_result(self, result_set, system):
+        """
+        Return the key of the sorted set with ids of the ordered result set,
+        scored with values of the attribute it's ordered by. Objects without
+        the attribute are left out.
+
+        The index of the attribute is used as is for all objects of the
+        model. Otherwise the result is stored in a temporary key once, and
+        pages of the result set reuse it while it's alive.
+
+        :returns: tuple (key, temp): temp is True for stored results
+        """
+        attr = result_set.ordering[0]
+        if (result_set.query is None and not result_set.ranges and
+                result_set.keys == [self._key('__all__')]):
+            return self._index_key(attr), False
+        key = result_set._ordered_keys.get(system)
+        if key is not None and get_redis(system).expire(key, self.temp_key_ttl):
+            return key, True
+        key, temp, zset = self._store_result(result_set, system)
+        key = self._store_ordering(key, attr, [key] if temp else [], system)
+        result_set._ordered_keys[system] = key
+        return key, True
+
+    def _store_ranges(self, key, ranges, temp_keys, system):
+        """
+        Store ids of the set, which are in given ranges of indexed
+        attributes, in a new temporary sorted set, and return its key.
+        Temporary keys created before are removed.
+
+        :param ranges: list of tuples (attr, low, high), where low and high
+                       are None or tuples (score, inclusive)
+        """
+        pipe = get_redis(system).pipeline()
+        for attr, low, high in ranges:
+            dest = self._new_temp_key()
+            # scores of the result are values of the attribute
+            pipe.zinterstore(dest, {key: 0, self._index_key(attr): 1})
+            if low is not None:
+                score, inclusive = low
+                pipe.zremrangebyscore(dest, '-inf',
+                                      '(%s' % score if inclusive else score)
+            if high is not None:
+                score, inclusive = high
+                pipe.zremrangebyscore(dest, '(%s' % score if inclusive else score,
+                                      '+inf')
+            pipe.expire(dest, self.temp_key_ttl)
+            temp_keys.append(dest)
+            key = dest
+        if len(temp_keys) > 1:
+            pipe.delete(*temp_keys[:-1])
+        pipe.execute()
+        return key
+
+    def _store_ordering(self, key, attr, temp_keys, system):
+        """
+        Store ids of the set in a new temporary sorted set, with values of
+        the indexed attribute as scores, and return its key. Objects without
+        the attribute are left out. Temporary keys created before are
+        removed.
+        """
+        dest = self._new_temp_key()
+        pipe = get_redis(system).pipeline()
+        pipe.zinterstore(dest, {key: 0, self._index_key(attr): 1})
+        pipe.expire(dest, self.temp_key_ttl)
+        if temp_keys:
+            pipe.delete(*temp_keys)
+        pipe.execute()
+        return dest
+
+    def _scan_result(self, result_set, system, offset=0):
+        """
+        Iterate over ids of the result set
+
+        :param offset: number of ids to skip. Ordered result sets skip them
+                       on the server side
+        """
+        if is_sharded(system):
+            return self._scan_shards(result_set, system, offset)
+        if result_set.ordering:
+            key, stored = self._ordered_result(result_set, system)
+            return self._range_key(key, system, keepalive=stored, offset=offset,
+                                   desc=result_set.ordering[1])
+        key, temp, zset = self._store_result(result_set, system)
+        if not temp and self._caches_queries(result_set):
+            # the cached intersection, shared with other result sets
+            ids = self._scan_key(key, system, zset=zset, readonly=False,
+                                 keepalive=self.query_cache_ttl)
+        else:
+            ids = self._scan_key(key, system, temp=temp, zset=zset)
+        return islice(ids, offset, None) if offset else ids
+
+    def _scan_shards(self, result_set, system, offset=0):
+        """
+        Iterate over ids of the result set on every shard of the system.
+        Ordered results of shards are merged by scores.
+        """
+        # iterators of shards are closed, when the iteration is over or
+        # abandoned, so that they remove their temporary keys
+        streams = []
+        try:
+            ids = self._merge_shards(result_set, system, streams)
+            for id in islice(ids, offset, None):
+                yield id
+        finally:
+            for stream in streams:
+                stream.close()
+
+    def _merge_shards(self, result_set, system, streams):
+        """
+        Iterate over ids of the result set on every shard of the system,
+        adding iterators of shards to :param:`streams`
+        """
+        shards = get_shards(system)
+        if not result_set.ordering:
+            for shard in shards:
+                ids = self._scan_result(result_set, shard)
+                streams.append(ids)
+                for id in ids:
+                    yield id
+            return
+        desc = result_set.ordering[1]
+        for shard in shards:
+            key, stored = self._ordered_result(result_set, shard)
+            streams.append(self._range_key(key, shard, keepalive=stored,
+                                           desc=desc, withscores=True))
+        scored = [((-score if desc else score, id) for id, score in items)
+                  for items in streams]
+        for _, id in heapq.merge(*scored):
+            yield id
+
+    def _range_key(self, key, system, keepalive=False, offset=0, desc=False,
+                   withscores=False):
+        """
+        Iterate over ids in the sorted set in the order of their scores
+
+        Ids are fetched with ZRANGE (or ZREVRANGE) in pages of
+        :attr:`chunk_size`, starting with :param:`offset`.
+
+        :param keepalive: the key is a temporary one, which has to be kept
+                          alive during the iteration
+        :param withscores: yield tuples (id, score) instead of ids
+        """
+        redis = get_redis(system)
+        while True:
+            pipe = redis.pipeline(transaction=False)
+            stop = offset + self.chunk_size - 1
+            if desc:
+                pipe.zrevrange(key, offset, stop, withscores=withscores)
+            else:
+                pipe.zrange(key, offset, stop, withscores=withscores)
+            if keepalive:
+                pipe.expire(key, self.temp_key_ttl)
+            ids = pipe.execute()[0]
+            for id in ids:
+                yield id
+            if len(ids) < self.chunk_size:
+                break
+            offset += self.chunk_size
+
+    def _count_result(self, result_set, system, exact=False):
+        """
+        Return the number of ids of the result set
+        """
+        if is_sharded(system):
+            return sum(self._count_result(result_set, shard, exact=exact)
+                       for shard in get_shards(system))
+        if result_set.ordering:
+            key, stored = self._ordered_result(result_set, system)
+            return self._count([key], system, exact=exact, zset=True,
+                               readonly=not stored)
+        if (result_set.query is None and not result_set.ranges and
+                not self._caches_queries(result_set)):
+            return self._count(result_set.keys, system, exact=exact,
+                               readonly=True)
+        key, temp, zset = self._store_result(result_set, system)
+        try:
+            # stored keys may be not replicated yet
+            return self._count([key], system, exact=exact, zset=zset,
+                               readonly=key in (result_set.keys or ()))
+        finally:
+            if temp:
+                get_redis(system).delete(key)
+
+    def _scan_key(self, key, system, temp=False, zset=False, readonly=None,
+                  keepalive=None):
+        """
+        Iterate over ids in the set
+
+        Ids are fetched with SSCAN in batches of :attr:`chunk_size`, so that
+        memory consumption doesn't depend on the size of the set. Like SSCAN
+        itself, the iterator may return the same id more than once, if the
+        set is modified during the iteration.
+
+        :param temp: the key is a temporary one, which has to be kept alive
+                     during the iteration and removed at the end of it
+        :param zset: the key is a sorted set, so that ZSCAN is used
+        :param readonly: the key can be read from replicas. By default, only
+                         keys, which are not temporary, are
+        :param keepalive: number of seconds to keep the key, which is not a
+                          temporary one, alive during the iteration
+        """
+        if readonly is None:
+            # temporary keys may be not replicated yet
+            readonly = not temp
+        if temp:
+            keepalive = self.temp_key_ttl
+        redis = get_read_redis(system) if readonly else get_redis(system)
+        try:
+            cursor = 0
+            while True:
+                pipe = redis.pipeline(transaction=False)
+                if zset:
+                    pipe.zscan(key, cursor, count=self.chunk_size)
+                else:
+                    pipe.sscan(key, cursor, count=self.chunk_size)
+                if keepalive:
+                    # slow consumers mustn't lose the rest of the result
+                    pipe.expire(key, keepalive)
+                cursor, ids = pipe.execute()[0]
+                if zset:
+                    ids = [id for id, score in ids]
+                for id in ids:
+                    yield id
+                if not int(cursor):
+                    break
+        finally:
+            if temp:
+                redis.delete(key)
+
+    def _count(self, keys, system, exact=False, zset=False, readonly=False):
+        """
+        Return the number of ids in the intersection of sets with given keys
+
+        :param exact: exclude ids of expired objects, which are not removed
+                      from sets yet
+        :param zset: the only given key is a sorted set
+        :param readonly: keys can be read from replicas
+        """
+        now = datetime_to_timestamp(utcnow())
+        temp_keys = []
+        if readonly and len(keys) == 1 and not exact:
+            pipe = get_read_redis(system).pipeline()
+        else:
+            pipe = get_redis(system).pipeline()
+        if zset:
+            pipe.zcard(keys[0])
+        elif len(keys) == 1:
+            pipe.scard(keys[0])
+        else:
+            # SINTERSTORE returns the cardinality of the result, and works
+            # with servers older than SINTERCARD (Redis 7.0)
+            temp_keys.append(self._new_temp_key())
+            pipe.sinterstore(temp_keys[-1], keys)
+        if exact:
+            # scores of the intersection are expiration timestamps
+            weights = dict((key, 0) for key in keys)
+            weights[self._key('__expire__')] = 1
+            temp_keys.append(self._new_temp_key())
+            pipe.zinterstore(temp_keys[-1], weights)
+            pipe.zcount(temp_keys[-1], '-inf', '(%s' % now)
+        if temp_keys:
+            pipe.delete(*temp_keys)
+        replies = pipe.execute()
+        if exact:
+            return replies[0] - replies[2]
+        return replies[0]
+
+    def _store_intersection(self, keys, system):
+        """
+        Store the intersection of sets in a new temporary key, which expires
+        in :attr:`temp_key_ttl` seconds, and return the key
+        """
+        temp_key = self._new_temp_key()
+        pipe = get_redis(system).pipeline()
+        pipe.sinterstore(temp_key, keys)
+        pipe.expire(temp_key, self.temp_key_ttl)
+        pipe.execute()
+        return temp_key
+
+    def _caches_queries(self, result_set):
+        """
+        Return True if the result set is an intersection of tags, cached
+        with :meth:`_cached_intersection`
+        """
+        return False
+
+    def _new_temp_key(self):
+        return self._key('__tmp__:{0}', random_string(16))
+
+    def _index_key(self, attr):
+        return self._key('index:{0}', attr)
 
 
 class ModelResultSet(object):
+    """
+    Lazy set of objects
+
+    Objects are loaded in chunks, while the result set is iterated over, so
+    that iterating over huge collections takes constant memory. Slicing and
+    indexing load only objects required to get the result.
+    """
 
-    def __init__(self, manager, ids, system=None):
+    def __init__(self, manager, ids=None, system=None, keys=None, query=None,
+                 ranges=None, ordering=None):
+        """
+        :param ids: list of object ids
+        :param keys: list of keys of sets, if ids are not given. Ids of
+                     objects are streamed from the intersection of the sets
+        :param query: :class:`ormist.Q` expression to evaluate, if neither
+                      ids nor keys are given
+        :param ranges: list of tuples (attr, low, high), which restrict keys
+                       or the query with indexed attributes, see
+                       :meth:`ModelManager._store_ranges`
+        :param ordering: tuple (attr, descending) to order objects by the
+                         indexed attribute, see :meth:`order_by`
+        """
         self.manager = manager
         self.ids = ids
+        self.keys = keys
+        self.query = query
+        self.ranges = ranges
+        self.ordering = ordering
         self.system = system
+        # {system: key of the stored ordered result}, see
+        # ModelManager._ordered_result
+        self._ordered_keys = {}
+        self._only = None
+        self._defer = None
         # we intentionally fill the cache only in list() method
         self._cache = None
 
+    def _clone(self, **attrs):
+        clone = copy.copy(self)
+        clone._cache = None
+        clone._ordered_keys = {}
+        for attr, value in attrs.items():
+            setattr(clone, attr, value)
+        return clone
+
+    def only(self, *fields):
+        """
+        Return the copy of the result set, which loads given attributes of
+        objects only. Useful for models stored as hashes, others are loaded
+        completely anyway.
+        """
+        return self._clone(_only=fields, _defer=None)
+
+    def defer(self, *fields):
+        """
+        Return the copy of the result set, which loads all attributes of
+        objects, except given ones. Useful for models stored as hashes, others
+        are loaded completely anyway.
+        """
+        return self._clone(_only=None, _defer=fields)
+
+    def order_by(self, field):
+        """
+        Return the copy of the result set, ordered by the indexed attribute
+        (see the ``indexes`` attribute of models) in the ascending order, or
+        in the descending one, if the name starts with "-". Objects without
+        the attribute are left out.
+
+        Ordered result sets of all objects page the index of the attribute,
+        others are stored in a sorted set on the server side once, and
+        reused by pages. Slices fetch only ids and objects of the requested
+        page::
+
+            Article.objects.all().order_by('-published')[40:60]
+        """
+        attr = field.lstrip('-')
+        if attr not in self.manager.indexes:
+            raise RuntimeError('Attribute "%s" of "%s" is not indexed'
+                               % (attr, self.manager.model_name))
+        if self.ids:
+            raise RuntimeError('Result set of given ids can\'t be ordered')
+        return self._clone(ordering=(attr, field.startswith('-')))
+
     def __iter__(self):
         if self._cache is not None:
-            for item in self._cache:
-                yield item
-        else:
-            for id in self.ids:
-                instance = self.manager.get(id, system=self.system)
-                if instance:
-                    yield instance
+            return iter(self._cache)
+        return self._iter_instances()
+
+    def _iter_ids(self, offset=0):
+        if self.ids is not None:
+            return islice(self.ids, offset, None)
+        system = self.manager.get_system(self.system)
+        return self.manager._scan_result(self, system, offset=offset)
+
+    def _iter_instances(self, limit=None, offset=0):
+        """
+        Iterate over existing instances, loading at most :param:`limit`
+        objects, if it's given, or all of them otherwise
+
+        :param offset: number of ids to skip without loading objects
+        """
+        system = self.manager.get_system(self.system)
+        # the operation is active only while the result set does its job,
+        # and not while the caller consumes instances
+        operation = self.manager._operation('find', system, autofinish=False)
+        ids = self._iter_ids(offset)
+        try:
+            while limit is None or limit > 0:
+                size = self.manager.chunk_size
+                if limit is not None:
+                    size = min(size, limit)
+                with operation:
+                    chunk = list(islice(ids, size))
+                    if not chunk:
+                        break
+                    instances = self.manager._load_many(chunk, system,
+                                                        only=self._only,
+                                                        defer=self._defer)
+                for instance in instances:
+                    if instance:
+                        if limit is not None:
+                            limit -= 1
+                        yield instance
+        finally:
+            # stop streaming ids from the server
+            if hasattr(ids, 'close'):
+                with operation:
+                    ids.close()
+            operation.finish()
 
     def list(self):
         if self._cache is not None:
@@ -197,88 +1578,405 @@ class ModelResultSet(object):
         self._cache = ret
         return ret
 
-    def count(self):
-        return len(self.list())
+    def count(self, exact=False):
+        """
+        Return the number of objects
+
+        Objects are counted on the server side, without loading them, unless
+        the result set has been created with the list of ids.
+
+        :param exact: exclude expired objects, which are not removed by the
+                      reaper yet. It takes a ZINTERSTORE over the whole
+                      result, so it's more expensive.
+        """
+        if self._cache is not None or self.ids is not None:
+            return len(self.list())
+        system = self.manager.get_system(self.system)
+        with self.manager._operation('count', system):
+            return self.manager._count_result(self, system, exact=exact)
 
     def __len__(self):
-        return self.count()
+        # list() calls it too, so that counting on the server would cost
+        # every list() a round trip
+        return len(self.list())
 
     def __getitem__(self, item):
-        return self.list()[item]
+        if self._cache is not None:
+            return self._cache[item]
+        if isinstance(item, slice):
+            start, stop, step = item.start or 0, item.stop, item.step or 1
+            if start < 0 or (stop is not None and stop < 0) or step < 0:
+                return self.list()[item]
+            if self.ordering:
+                # skip ids on the server side, expired objects, which are
+                # not removed yet, take their places in pages though
+                limit = None if stop is None else max(stop - start, 0)
+                instances = self._iter_instances(limit=limit, offset=start)
+                return list(islice(instances, 0, None, step))
+            instances = self._iter_instances(limit=stop)
+            return list(islice(instances, start, stop, step))
+        if item < 0:
+            return self.list()[item]
+        if self.ordering:
+            instances = list(self._iter_instances(limit=1, offset=item))
+        else:
+            instances = list(islice(self._iter_instances(limit=item + 1),
+                                    item, None))
+        if not instances:
+            raise IndexError('result set index out of range')
+        return instances[0]
 
 
-class TaggedModelManager(ModelManager):
+class TaggedModelManager(AsyncTaggedManagerMixin, ModelManager):
 
+    object_keys = ModelManager.object_keys + ('tags', )
 
-    def save_instance(self, instance, system=None):
-        system = self.get_system(system)
-        super(TaggedModelManager, self).save_instance(instance, system=system)
-        if not instance.tags:
-            return
-        pipe = get_redis(system).pipeline()
+    # tags of the object are required to remove it from tag sets
+    persistent_object_keys = ModelManager.persistent_object_keys + ('tags', )
+
+    #: update the tag index with Lua scripts, so that saves and deletes take
+    #: one round trip and the index stays consistent under concurrent
+    #: writes. Requires Redis 2.6+, set to False on servers without scripting
+    scripting = True
+
+    #: number of seconds intersections of tags are cached for, set with the
+    #: ``query_cache_ttl`` attribute of the model. Repeated :meth:`find`
+    #: calls with the same tags page through the stored intersection instead
+    #: of computing it again. Saves and deletes of objects bump generations
+    #: of tags they add or remove, so that later queries don't use cached
+    #: intersections of them. None disables the cache
+    query_cache_ttl = None
+
+    def _queue_save(self, pipe, instance, full, system):
+        super(TaggedModelManager, self)._queue_save(pipe, instance, full, system)
+        tags, saved_tags = set(instance.tags), set(instance._saved_tags)
         tags_key = self._key('object:{0}:tags', instance.id)
-        pipe.sadd(tags_key, *instance.tags)
-        for tag in instance.tags:
-            key = self._key('tags:{0}', tag)
-            pipe.sadd(key, instance.id)
-        for tag_to_rm in set(instance._saved_tags) - set(instance.tags):
-            key = self._key('tags:{0}', tag_to_rm)
-            pipe.srem(key, instance.id)
-        pipe.execute()
-        instance._saved_tags = instance.tags
+        if self.scripting:
+            # the script finds out which tags to remove on the server side
+            if tags != saved_tags or (full and tags):
+                args = [instance.id, self._key('tags:'), self._gens_prefix()]
+                self._queue_script(pipe, SAVE_TAGS, [tags_key], args + list(tags),
+                                   system)
+            return
+        added = tags if full else tags - saved_tags
+        removed = saved_tags - tags
+        if added:
+            pipe.sadd(tags_key, *added)
+            for tag in added:
+                pipe.sadd(self._key('tags:{0}', tag), instance.id)
+        if removed:
+            pipe.srem(tags_key, *removed)
+            for tag in removed:
+                pipe.srem(self._key('tags:{0}', tag), instance.id)
+        self._queue_invalidate_queries(pipe, added | removed)
 
-    def delete_instance(self, instance, system=None):
-        # we have to remove instance from all tags before removing the
-        # object itself
-        system = self.get_system(system)
-        tags_keys = self._key('object:{0}:tags', u(instance.id))
-        tags = get_redis(system).smembers(tags_keys)
-        pipe = get_redis(system).pipeline()
-        for tag in tags:
-            key = self._key('tags:{0}', u(tag))
-            pipe.srem(key, instance.id)
-        self.delete_instance_by_id(instance.id, pipe=pipe, apply=False,
-                                   system=system)
-        pipe.execute()
+    def _queue_delete_lookup(self, pipe, ids):
+        super(TaggedModelManager, self)._queue_delete_lookup(pipe, ids)
+        if not self.scripting:
+            # we have to remove instance from all tags before removing the
+            # object itself
+            for id in ids:
+                pipe.smembers(self._key('object:{0}:tags', id))
 
-    def get(self, id, system=None):
-        system = self.get_system(system)
-        instance = super(TaggedModelManager, self).get(id, system=system)
-        if instance:
-            tags_key = self._key('object:{0}:tags', u(id))
-            tags = get_redis(system).smembers(u(tags_key)) or []
-            instance.tags = [u(tag) for tag in tags]
+    def _parse_delete_lookup(self, ids, replies):
+        records = super(TaggedModelManager, self)._parse_delete_lookup(ids, replies)
+        if not self.scripting:
+            for record in records:
+                record['tags'] = [u(tag) for tag in next(replies)]
+        return records
+
+    def _queue_delete(self, pipe, id, record, system):
+        if self.scripting:
+            tags_key = self._key('object:{0}:tags', id)
+            keys = [self._key('__all__'), self._key('__expire__'), tags_key]
+            keys += [key for key in self._object_keys(id) if key != tags_key]
+            args = [id, self._key('tags:'), self._gens_prefix()]
+            self._queue_script(pipe, DELETE_TAGGED, keys, args, system)
+            self._queue_unindex(pipe, id)
+            return
+        for tag in record['tags']:
+            pipe.srem(self._key('tags:{0}', tag), id)
+        self._queue_invalidate_queries(pipe, record['tags'])
+        super(TaggedModelManager, self)._queue_delete(pipe, id, record, system)
+
+    def _queue_load(self, pipe, ids, fields=None):
+        super(TaggedModelManager, self)._queue_load(pipe, ids, fields)
+        for id in ids:
+            pipe.smembers(self._key('object:{0}:tags', id))
+
+    def _parse_load(self, ids, replies, fields=None):
+        records = super(TaggedModelManager, self)._parse_load(ids, replies,
+                                                              fields)
+        for record in records:
+            tags = next(replies)
+            if record:
+                record['tags'] = [u(tag) for tag in tags]
+        return records
+
+    def _make_instance(self, id, record):
+        instance = super(TaggedModelManager, self)._make_instance(id, record)
+        instance.tags = list(record['tags'])
         return instance
 
+    def _tag_keys(self, tags):
+        return [u(self._key('tags:{0}', tag)) for tag in tags]
+
+    def _gens_prefix(self):
+        """
+        Return the prefix of keys of generations of tags, which are parts of
+        keys of cached intersections, or '' if the cache is disabled
+        """
+        if not self.query_cache_ttl:
+            return ''
+        return self._key('__query_gen__:')
+
+    def _queue_invalidate_queries(self, pipe, tags):
+        """
+        Bump generations of tags, so that new queries don't use cached
+        intersections of them. Iterations over these intersections, which
+        have already started, keep reading them.
+        """
+        if self.query_cache_ttl:
+            for tag in tags:
+                pipe.incr(self._key('__query_gen__:{0}', tag))
+
+    def _caches_queries(self, result_set):
+        return bool(self.query_cache_ttl and result_set.keys and
+                    len(result_set.keys) > 1)
+
+    def _cached_intersection(self, keys, system):
+        """
+        Return the key of the cached intersection of tag sets, storing it
+        first, if it's not cached yet. The key depends on tags, in any
+        order, and on their generations.
+        """
+        prefix = u(self._key('tags:'))
+        tags = sorted(set(u(key)[len(prefix):] for key in keys))
+        redis = get_redis(system)
+        gens = redis.mget([self._key('__query_gen__:{0}', tag) for tag in tags])
+        parts = ['%s\n%d' % (tag, int(gen or 0)) for tag, gen in zip(tags, gens)]
+        digest = hashlib.sha1(b('\n'.join(parts))).hexdigest()
+        key = self._key('__query__:{0}', digest)
+        # hot queries stay cached
+        if not redis.expire(key, self.query_cache_ttl):
+            pipe = redis.pipeline()
+            pipe.sinterstore(key, keys)
+            pipe.expire(key, self.query_cache_ttl)
+            pipe.execute()
+        return key
+
     def find_ids(self, *tags, **kw):
         system = self.get_system(kw.get('system'))
         if not tags:
             return []
-        keys = []
-        for tag in tags:
-            key = self._key('tags:{0}', tag)
-            keys.append(u(key))
-        return get_redis(system).sinter(*keys)
+        ids = set()
+        for shard in get_shards(system):
+            ids |= get_read_redis(shard).sinter(*self._tag_keys(tags))
+        return ids
 
     def find(self, *tags, **kw):
+        """
+        Return the result set of objects having all given tags. Ids are
+        streamed from the server while the result set is iterated over.
+
+        Tags may be combined with :class:`ormist.Q` expressions::
+
+            Book.objects.find('python', Q('web') | Q('cli'), ~Q('beginners'))
+        """
         system = self.get_system(kw.get('system'))
-        ids = self.find_ids(system=system, *tags)
-        return ModelResultSet(self, ids, system)
+        if not tags:
+            return ModelResultSet(self, [], system)
+        query = as_query(tags)
+        if query.op == Q.AND and not any(isinstance(child, Q)
+                                         for child in query.children):
+            # plain intersection of tags doesn't need the compiler
+            keys = self._tag_keys(query.children)
+            return ModelResultSet(self, system=system, keys=keys)
+        return ModelResultSet(self, system=system, query=query)
+
+    def _store_query(self, query, system):
+        """
+        Evaluate the query and store the result in a temporary key
+
+        It takes two round trips: the first one gets cardinalities of tag
+        sets, and the second one evaluates the query in a transaction.
+
+        :returns: tuple (key, list of temporary keys to remove)
+        """
+        tags = list(query.tags())
+        # cardinalities are estimations anyway
+        pipe = get_read_redis(system).pipeline(transaction=False)
+        for key in self._tag_keys(tags):
+            pipe.scard(key)
+        pipe.scard(self._key('__all__'))
+        replies = pipe.execute()
+        compiler = QueryCompiler(self, dict(zip(tags, replies)), replies[-1])
+        pipe = get_redis(system).pipeline()
+        key = compiler.compile(pipe, query)
+        pipe.execute()
+        return key, compiler.temp_keys
+
+    def repair_tags(self, system=None, batch_size=1000, rate_limit=None,
+                    dry_run=False, callback=None):
+        """
+        Remove ids of objects, which don't exist anymore, from tag sets
+
+        Tag sets are found with SCAN and iterated over with SSCAN, and ids
+        are checked against the set of all objects in batches of
+        :param:`batch_size` ids, so it's safe to run against a live
+        instance. Every batch is checked and cleaned atomically by a script,
+        or by a transaction, which watches the tag set, without scripting.
+        Redis removes tag sets, which become empty, itself. Ids returned by
+        SSCAN more than once are counted once.
+
+        :param rate_limit: max number of ids checked per second, None means
+                           "no limit"
+        :param dry_run: find stale ids, but don't remove them
+        :param callback: optional function, called after every batch with
+                         the report
+        :returns: :class:`ormist.repair.TagRepairReport`
+        """
+        system = self.get_system(system)
+        report = TagRepairReport(dry_run=dry_run)
+        limiter = RateLimiter(rate_limit)
+        prefix = self._key('tags:')
+        for shard in get_shards(system):
+            redis = get_redis(shard)
+            for tag_key in redis.scan_iter(self._key('tags:*'), count=batch_size):
+                report.tags += 1
+                tag = u(tag_key[len(prefix):])
+                ids = redis.sscan_iter(tag_key, count=batch_size)
+                # SSCAN may return the same id more than once
+                stale_ids = set()
+                for batch in chunks(ids, batch_size):
+                    stale, removed = self._repair_tag_batch(tag_key, batch, shard,
+                                                            dry_run)
+                    stale = set(stale) - stale_ids
+                    stale_ids |= stale
+                    report.add(tag, len(batch), len(stale), len(removed))
+                    if callback:
+                        callback(report)
+                    limiter.wait(len(batch))
+        return report
+
+    def _repair_tag_batch(self, tag_key, ids, system, dry_run):
+        """
+        Check ids of the tag set, and remove ids of objects, which don't
+        exist, unless it's a dry run
+
+        :returns: tuple (list of stale ids, list of removed ids)
+        """
+        all_key = self._key('__all__')
+        if dry_run:
+            return self._find_stale_ids(get_read_redis(system), ids), []
+        if self.scripting:
+            pipe = get_redis(system).pipeline(transaction=False)
+            self._queue_script(pipe, REMOVE_STALE_IDS, [tag_key, all_key], ids,
+                               system)
+            removed = self._execute(pipe, system)[0]
+            return removed, removed
+        client = get_redis(system)
+        with client.pipeline() as pipe:
+            while True:
+                try:
+                    # ids added to the tag set meanwhile abort the transaction
+                    pipe.watch(tag_key)
+                    stale = self._find_stale_ids(client, ids)
+                    if not stale:
+                        pipe.unwatch()
+                        return [], []
+                    pipe.multi()
+                    for id in stale:
+                        pipe.srem(tag_key, id)
+                    replies = pipe.execute()
+                except WatchError:
+                    continue
+                removed = [id for id, reply in zip(stale, replies) if reply]
+                return removed, removed
+
+    def _find_stale_ids(self, client, ids):
+        """
+        Return ids, which are not in the set of all objects
+        """
+        all_key = self._key('__all__')
+        pipe = client.pipeline(transaction=False)
+        for id in ids:
+            pipe.sismember(all_key, id)
+        return [id for id, exists in zip(ids, pipe.execute()) if not exists]
 
 
 class TaggedAttrsModelManager(TaggedModelManager):
 
+    #: lookups of indexed attributes supported by :meth:`find`
+    lookups = ('gt', 'gte', 'lt', 'lte')
+
     def __init__(self, exclude_attrs=None):
         self.exclude_attrs = set(exclude_attrs or [])
 
     def attrs_to_tags(self, attrs):
         tags = []
         for k, v in attrs.items():
-            if k not in self.exclude_attrs:
+            # indexed attributes are found by their indexes
+            if k not in self.exclude_attrs and k not in self.indexes:
                 tags.append(u'{0}:{1}'.format(u(k), u(v)))
         return tags
 
+    def _queue_save(self, pipe, instance, full, system):
+        if instance._partial:
+            # tags of attributes, which haven't been loaded, can't be rebuilt
+            raise RuntimeError('Partially loaded instance of "%s" can\'t be saved'
+                               % self.model_name)
+        super(TaggedAttrsModelManager, self)._queue_save(pipe, instance, full,
+                                                         system)
+
     def find(self, **attrs):
+        """
+        Return the result set of objects with given values of attributes
+
+        Indexed attributes (see the ``indexes`` attribute of models) can be
+        looked up by ranges of values, with ``gt``, ``gte``, ``lt`` and
+        ``lte`` lookups, and combined with other attributes::
+
+            User.objects.find(department_id=1, age__gte=25, age__lt=40)
+        """
+        system = self.get_system(attrs.pop('system', None))
+        ranges = self._split_ranges(attrs)
+        tags = self.attrs_to_tags(attrs)
+        if not ranges:
+            return super(TaggedAttrsModelManager, self).find(system=system, *tags)
+        if tags:
+            result = super(TaggedAttrsModelManager, self).find(system=system, *tags)
+        else:
+            result = self.all(system=system)
+        return result._clone(ranges=ranges)
+
+    def _split_ranges(self, attrs):
+        """
+        Remove lookups of indexed attributes from attrs, and return them as
+        the list of ranges (attr, low, high)
+        """
+        bounds = {}
+        for name in list(attrs):
+            attr, _, lookup = name.rpartition('__')
+            if lookup not in self.lookups:
+                attr, lookup = name, None
+            if attr not in self.indexes:
+                if lookup:
+                    raise RuntimeError('Attribute "%s" of "%s" is not indexed'
+                                       % (attr, self.model_name))
+                continue
+            score = to_score(attrs.pop(name))
+            low, high = bounds.get(attr, (None, None))
+            if lookup in (None, 'gt', 'gte'):
+                low = (score, lookup != 'gt')
+            if lookup in (None, 'lt', 'lte'):
+                high = (score, lookup != 'lt')
+            bounds[attr] = (low, high)
+        return [(attr, low, high) for attr, (low, high) in sorted(bounds.items())]
+
+    def afind(self, **attrs):
         system = self.get_system(attrs.pop('system', None))
+        if self._split_ranges(dict(attrs)):
+            raise RuntimeError('Indexed attributes are not supported by afind()')
         tags = self.attrs_to_tags(attrs)
-        return super(TaggedAttrsModelManager, self).find(system=system, *tags)
+        return super(TaggedAttrsModelManager, self).afind(system=system, *tags)
@@ -2,8 +2,11 @@
 import calendar
 import time
 import re
+from timeit import default_timer
 from .managers import ModelManager, TaggedModelManager, TaggedAttrsModelManager
+from .instrumentation import current_operation
 from .utils import expire_to_datetime
+from . import serializers
 
 #--- Metaclass magic
 
@@ -25,6 +28,22 @@ class ModelBase(type):
         model_manager.model_name = attrs.pop('model_name', to_underscore(name))
         model_manager.id_length = attrs.pop('id_length', 16)
         model_manager.system = attrs.pop('system', 'default')
+        model_manager.serializer = attrs.pop('serializer', None)
+        model_manager.storage = attrs.pop('storage', 'string')
+        model_manager.cache = attrs.pop('cache', None)
+        model_manager.instrumentation = attrs.pop('instrumentation', None)
+        model_manager.id_strategy = attrs.pop('id_strategy', None)
+        model_manager.indexes = tuple(attrs.pop('indexes', ()))
+        model_manager.cluster = attrs.pop('cluster', False)
+        model_manager.native_ttl = attrs.pop('native_ttl', False)
+        model_manager.compact = attrs.pop('compact', False)
+        model_manager.query_cache_ttl = attrs.pop('query_cache_ttl', None)
+        if model_manager.compact:
+            # no __dict__ for instances, all attributes live in slots
+            attrs.setdefault('__slots__', ())
+        if model_manager.cluster:
+            # scripts can't touch keys of different hash slots
+            model_manager.scripting = False
         ret = type.__new__(cls, name, parents, attrs)
         model_manager.model = ret
         return ret
@@ -38,11 +57,21 @@ def to_underscore(name):
 
 
 
+MODEL_SLOTS = ('id', '_attrs', '_raw', 'expire', '_partial', '_saved_system',
+               '_saved_attrs', '_saved_expire', '_touched')
+
+
 class Model(object):
     """
     Base model class
-    """
 
+    Models with ``compact = True`` have instances without ``__dict__``, and
+    keep loaded payloads undecoded until attributes are accessed. Objects
+    stored as hashes decode only fields, which are accessed as attributes of
+    instances. Instances of compact models can't have attributes other than
+    ones of their base classes, and ``__slots__`` of their own.
+    """
+    __slots__ = MODEL_SLOTS
 
     def __init__(self, **attrs):
         """
@@ -53,7 +82,7 @@ class Model(object):
         When the expiration timestamp has reached, the model won't be accessible
         anymore and eventually will be removed from the database
 
-        :param \*\*attrs: additional attributes of the instance. Will be pickled and
+        :param \*\*attrs: additional attributes of the instance. Will be serialized and
         written to the store
         """
         id = attrs.pop('id', None)
@@ -61,15 +90,84 @@ class Model(object):
         if id is not None:
             id = str(id)
         self.id = id
-        self.attrs = attrs
+        self._raw = None
+        self._attrs = attrs
         self.expire = expire_to_datetime(expire)
+        # True for instances loaded with ModelResultSet.only() / defer()
+        self._partial = False
+        self._mark_unsaved()
 
     def __getattr__(self, attr):
+        if attr.startswith('__') or attr in MODEL_SLOTS:
+            # special methods, and slots, which are not set yet
+            raise AttributeError(attr)
+        raw = self._raw
+        if isinstance(raw, dict) and attr in raw:
+            # decode the only field of the hash
+            operation = current_operation()
+            started = operation and default_timer()
+            value = self._attrs[attr] = serializers.loads(raw.pop(attr))
+            if operation:
+                operation.serialization_time += default_timer() - started
+            if self._saved_system is not None:
+                self._saved_attrs[attr] = value
+            return value
         try:
             return self.attrs[attr]
         except KeyError as e:
             raise AttributeError(e)
 
+    @property
+    def attrs(self):
+        if self._raw is not None:
+            self._decode()
+        return self._attrs
+
+    @attrs.setter
+    def attrs(self, value):
+        self._raw = None
+        self._attrs = value
+
+    def _set_raw(self, raw):
+        """
+        Keep the loaded payload (serialized attributes, or the dict of
+        serialized fields of the hash) to decode it on first access
+        """
+        self._raw = raw
+
+    def _decode(self):
+        raw, self._raw = self._raw, None
+        operation = current_operation()
+        started = operation and default_timer()
+        if isinstance(raw, dict):
+            attrs = dict((field, serializers.loads(value))
+                         for field, value in raw.items())
+        else:
+            attrs = serializers.loads(raw)
+        if operation:
+            operation.serialization_time += default_timer() - started
+        self._attrs.update(attrs)
+        if self._saved_system is not None:
+            self._saved_attrs.update(attrs)
+
+    def __getstate__(self):
+        # pickle protocols 0 and 1 of Python 2 ignore slots
+        state = dict(getattr(self, '__dict__', {}))
+        for cls in type(self).__mro__:
+            slots = cls.__dict__.get('__slots__', ())
+            if isinstance(slots, str):
+                slots = (slots, )
+            for name in slots:
+                try:
+                    state[name] = object.__getattribute__(self, name)
+                except AttributeError:
+                    pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
     def __eq__(self, other):
         if other.__class__ != self.__class__:
             return False
@@ -81,16 +179,56 @@ class Model(object):
     def set_expire(self, expire):
         self.expire = expire_to_datetime(expire)
 
-    def save(self, system=None):
-        if hasattr(self, 'validate') and callable(self.validate):
-            self.validate()
-        self.objects.save_instance(self, system=system)
+    def save(self, system=None, force=False):
+        """
+        Save the instance
+
+        Only attributes changed since the instance has been loaded or saved
+        are written. Changes made with :meth:`set` and :meth:`unset`, and
+        assignments to ``attrs`` items are tracked, but in-place
+        modifications of mutable values are not: call :meth:`set` with the
+        modified value, or save with ``force=True`` to write everything.
+        """
+        self._validate()
+        self.objects.save_instance(self, system=system, force=force)
 
     def delete(self, system=None):
         self.objects.delete_instance(self, system=system)
 
+    def _validate(self):
+        if hasattr(self, 'validate') and callable(self.validate):
+            self.validate()
+
+    def _mark_saved(self, system):
+        """
+        Remember the state of the instance as it is stored in the system
+        """
+        self._saved_system = system
+        # attributes, which are not decoded yet, are saved as they are
+        self._saved_attrs = dict(self._attrs)
+        self._saved_expire = self.expire
+        self._touched = set()
+
+    def _mark_unsaved(self):
+        self._saved_system = None
+        self._saved_attrs = {}
+        self._saved_expire = None
+        self._touched = set()
+
+    def _get_changes(self):
+        """
+        Return the tuple of sets (changed, removed) with names of attributes
+        changed and removed since the instance has been loaded or saved
+        """
+        saved = self._saved_attrs
+        changed = set(k for k, v in self.attrs.items()
+                      if k in self._touched or k not in saved or saved[k] != v)
+        removed = set(saved) - set(self.attrs)
+        return changed, removed
+
     def set(self, **kwargs):
         self.attrs.update(**kwargs)
+        self._touched.update(kwargs)
 
     def unset(self, *args):
         for arg in args:
@@ -117,7 +255,8 @@ class Model(object):
 
 
 # support for python2x and py3k syntax
-Model = ModelBase('Model', (Model, ), {'objects': ModelManager()})
+Model = ModelBase('Model', (Model, ), {'objects': ModelManager(),
+                                       '__slots__': ()})
 
 
 class TaggedModel(Model):
@@ -125,6 +264,8 @@ class TaggedModel(Model):
     Model with tags support
     """
 
+    __slots__ = ('tags', '_saved_tags')
+
     objects = TaggedModelManager()
 
     def __init__(self, *tags, **kwargs):
@@ -139,15 +280,24 @@ class TaggedModel(Model):
         When the expiration timestamp has reached, the model won't be accessible
         anymore and eventually will be removed from the database
 
-        :param \*\*attrs: additional attributes of the instance. Will be pickled and
+        :param \*\*attrs: additional attributes of the instance. Will be serialized and
         written to the store
         """
         super(TaggedModel, self).__init__(**kwargs)
         self.tags = tags or []
-        self._saved_tags = self.tags
+
+    def _mark_saved(self, system):
+        super(TaggedModel, self)._mark_saved(system)
+        self._saved_tags = list(self.tags)
+
+    def _mark_unsaved(self):
+        super(TaggedModel, self)._mark_unsaved()
+        self._saved_tags = []
 
 class TaggedAttrsModel(TaggedModel):
 
+    __slots__ = ()
+
     objects = TaggedAttrsModelManager(exclude_attrs=[])
 
     def __init__(self, **attrs):
@@ -159,7 +309,7 @@ class TaggedAttrsModel(TaggedModel):
         When the expiration timestamp has reached, the model won't be accessible
         anymore and eventually will be removed from the database
 
-        :param \*\*attrs: additional attributes of the instance. Will be pickled and
+        :param \*\*attrs: additional attributes of the instance. Will be serialized and
         written to the store. Additionally, values from the attrs will be converted
         to tags, thus allowing you to search by them
 
@@ -183,5 +333,7 @@ class TaggedAttrsModel(TaggedModel):
 
 class Verbose(object):
     """ Verbose mix-in. Displays complete set of attributes in __repr__"""
+    __slots__ = ()
+
     def __repr__(self):
         return '<%s id:%s attrs:%s>' % (self.__class__.__name__, self.id, self.attrs)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Connection pools of systems
+
+Clients of systems are created on first use with pools, which count their
+connections, so that :func:`ormist.pool_stats` can report them. Defaults of
+all pools can be tuned centrally::
+
+    ormist.POOL_DEFAULTS.update(max_connections=20, blocking=True, timeout=5)
+
+or per system with :func:`ormist.setup_redis` arguments ``max_connections``,
+``pool_timeout`` and ``blocking_pool``.
+"""
+import redis
+
+
+#: default settings of pools: max number of connections (None is "no
+#: limit"), whether to wait for a free connection when there are
+#: max_connections of them in use (otherwise ConnectionError is raised), and
+#: how many seconds to wait
+POOL_DEFAULTS = {
+    'max_connections': None,
+    'blocking': False,
+    'timeout': 20,
+}
+
+# arguments of create_redis(), which redis.Redis doesn't accept
+POOL_ARGUMENTS = ('pool_timeout', 'blocking_pool')
+
+
+class ConnectionPool(redis.ConnectionPool):
+
+    def stats(self):
+        # the pool never waits, it raises ConnectionError instead
+        return {
+            'created': self._created_connections,
+            'in_use': len(self._in_use_connections),
+            'idle': len(self._available_connections),
+            'max_connections': self.max_connections,
+        }
+
+
+class BlockingConnectionPool(redis.BlockingConnectionPool):
+
+    waits = 0
+
+    def reset(self):
+        super(BlockingConnectionPool, self).reset()
+        self.waits = 0
+
+    def get_connection(self, *args, **kwargs):
+        # empty queue means that all connections are in use
+        if self.pool.empty():
+            self.waits += 1
+        return super(BlockingConnectionPool, self).get_connection(*args, **kwargs)
+
+    def stats(self):
+        stats = _blocking_pool_stats(self)
+        stats['waits'] = self.waits
+        return stats
+
+
+def _blocking_pool_stats(pool):
+    """
+    Return stats of the redis-py blocking pool, which doesn't track
+    connections in use, but keeps idle ones in the queue
+    """
+    created = len(pool._connections)
+    idle = len([conn for conn in list(pool.pool.queue) if conn is not None])
+    return {
+        'created': created,
+        'in_use': created - idle,
+        'idle': idle,
+        'max_connections': pool.max_connections,
+    }
+
+
+def create_redis(host=None, port=None, max_connections=None, pool_timeout=None,
+                 blocking_pool=None, **kw):
+    """
+    Create the client with the pool of :class:`ConnectionPool` or
+    :class:`BlockingConnectionPool`. Pool settings, which are not given, are
+    taken from :data:`POOL_DEFAULTS`.
+    """
+    if max_connections is None:
+        max_connections = POOL_DEFAULTS['max_connections']
+    if pool_timeout is None:
+        pool_timeout = POOL_DEFAULTS['timeout']
+    if blocking_pool is None:
+        blocking_pool = POOL_DEFAULTS['blocking']
+    client = redis.Redis(host=host, port=port, **kw)
+    # let redis-py parse connection arguments, and replace the pool only
+    base = client.connection_pool
+    if blocking_pool:
+        client.connection_pool = BlockingConnectionPool(
+            connection_class=base.connection_class,
+            max_connections=max_connections or 50, timeout=pool_timeout,
+            **base.connection_kwargs)
+    else:
+        client.connection_pool = ConnectionPool(
+            connection_class=base.connection_class,
+            max_connections=max_connections, **base.connection_kwargs)
+    return client
+
+
+def connection_stats(client):
+    """
+    Return the dict with numbers of connections of the client: "created",
+    "in_use", "idle" and "max_connections". Blocking pools report "waits"
+    too (times clients had to wait for a connection). Pools not created by
+    ormist report what they can.
+    """
+    pool = client.connection_pool
+    if isinstance(pool, (ConnectionPool, BlockingConnectionPool)):
+        return pool.stats()
+    if isinstance(pool, redis.BlockingConnectionPool):
+        return _blocking_pool_stats(pool)
+    in_use = len(getattr(pool, '_in_use_connections', ()))
+    idle = len(getattr(pool, '_available_connections', ()))
+    return {
+        'created': getattr(pool, '_created_connections', in_use + idle),
+        'in_use': in_use,
+        'idle': idle,
+        'max_connections': getattr(pool, 'max_connections', None),
+    }
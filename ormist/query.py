@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Query expressions over tags
+
+.. code-block:: python
+
+    from ormist import Q
+
+    # books about python or ruby, but not about rails
+    Book.objects.find(Q('python') | Q('ruby'), ~Q('rails'))
+    Book.objects.find(Q('python') & (Q('web') | Q('cli')) & ~Q('beginners'))
+
+Expressions are evaluated on the server side with SINTERSTORE, SUNIONSTORE
+and SDIFFSTORE into temporary keys, in one transaction. Cardinalities of tag
+sets are fetched beforehand, so that operands are ordered from the smallest
+one, and intersections with an empty set are not computed at all.
+"""
+
+
+class Q(object):
+    """
+    Query expression: an intersection of tags and other expressions, which
+    can be combined with ``&``, ``|`` and ``~``
+    """
+    AND = 'and'
+    OR = 'or'
+    NOT = 'not'
+
+    def __init__(self, *tags):
+        self.op = self.AND
+        self.children = list(tags)
+
+    @classmethod
+    def _combine(cls, op, children):
+        query = cls()
+        query.op = op
+        for child in children:
+            # flatten nested operations of the same kind
+            if isinstance(child, Q) and child.op == op and op != cls.NOT:
+                query.children += child.children
+            else:
+                query.children.append(child)
+        return query
+
+    def __and__(self, other):
+        return self._combine(self.AND, [self, other])
+
+    def __or__(self, other):
+        return self._combine(self.OR, [self, other])
+
+    def __invert__(self):
+        if self.op == self.NOT:
+            return self.children[0]
+        return self._combine(self.NOT, [self])
+
+    def tags(self):
+        """
+        Return the set of all tags used in the expression
+        """
+        ret = set()
+        for child in self.children:
+            if isinstance(child, Q):
+                ret |= child.tags()
+            else:
+                ret.add(child)
+        return ret
+
+    def __repr__(self):
+        if self.op == self.NOT:
+            return '~%r' % (self.children[0], )
+        separator = ' & ' if self.op == self.AND else ' | '
+        return '(%s)' % separator.join(repr(child) for child in self.children)
+
+
+class QueryCompiler(object):
+    """
+    Translate the query to commands of the pipeline, storing the result in
+    a temporary key. Used by :class:`ormist.TaggedModelManager`.
+    """
+
+    def __init__(self, manager, cardinalities, all_cardinality):
+        """
+        :param cardinalities: {tag: SCARD of the tag set}
+        :param all_cardinality: SCARD of the set of all objects
+        """
+        self.manager = manager
+        self.cardinalities = cardinalities
+        self.all_cardinality = all_cardinality
+        self.temp_keys = []
+
+    def compile(self, pipe, query):
+        """
+        Add commands evaluating the query to the pipeline, and return the
+        key the result will be stored in. Intermediate keys are removed in
+        the same pipeline. If the result key is a temporary one, it's the
+        only item of :attr:`temp_keys` afterwards.
+        """
+        key = self._build(pipe, query)
+        intermediate = [temp_key for temp_key in self.temp_keys if temp_key != key]
+        if intermediate:
+            pipe.delete(*intermediate)
+        self.temp_keys = [key] if key in self.temp_keys else []
+        return key
+
+    def estimate(self, node):
+        """
+        Estimate the max number of items in the result of the node
+        """
+        if not isinstance(node, Q):
+            return self.cardinalities[node]
+        if node.op == Q.NOT:
+            return self.all_cardinality
+        estimates = [self.estimate(child) for child in node.children
+                     if not self._is_negation(child)]
+        if node.op == Q.OR:
+            return min(sum(estimates), self.all_cardinality)
+        if not estimates:
+            return self.all_cardinality
+        return min(estimates)
+
+    def _is_negation(self, node):
+        return isinstance(node, Q) and node.op == Q.NOT
+
+    def _build(self, pipe, node):
+        if not isinstance(node, Q):
+            return self.manager._tag_keys([node])[0]
+        if node.op == Q.OR:
+            return self._build_union(pipe, node)
+        return self._build_intersection(pipe, node)
+
+    def _build_union(self, pipe, node):
+        children = [child for child in node.children if self.estimate(child)]
+        if not children:
+            return self._empty_key()
+        if len(children) == 1:
+            return self._build(pipe, children[0])
+        keys = [self._build(pipe, child) for child in children]
+        return self._store(pipe, 'sunionstore', keys)
+
+    def _build_intersection(self, pipe, node):
+        if node.op == Q.NOT:
+            positive, negative = [], [node.children[0]]
+        else:
+            positive = [child for child in node.children
+                        if not self._is_negation(child)]
+            negative = [child.children[0] for child in node.children
+                        if self._is_negation(child)]
+        if positive and not min(self.estimate(child) for child in positive):
+            # nothing to intersect with, don't evaluate anything
+            return self._empty_key()
+        # the smallest set drives the work
+        positive.sort(key=self.estimate)
+        keys = [self._build(pipe, child) for child in positive]
+        if not keys:
+            keys = [self.manager._key('__all__')]
+        negative = [child for child in negative if self.estimate(child)]
+        if len(keys) == 1 and not negative:
+            return keys[0]
+        if len(keys) > 1:
+            keys = [self._store(pipe, 'sinterstore', keys)]
+        if negative:
+            keys += [self._build(pipe, child) for child in negative]
+            return self._store(pipe, 'sdiffstore', keys)
+        return keys[0]
+
+    def _store(self, pipe, command, keys):
+        # EXPIRE has no effect before the key is created, queue it after
+        key = self.manager._new_temp_key()
+        getattr(pipe, command)(key, keys)
+        pipe.expire(key, self.manager.temp_key_ttl)
+        self.temp_keys.append(key)
+        return key
+
+    def _empty_key(self):
+        # the key, which is never created, is an empty set
+        return self.manager._new_temp_key()
+
+
+def as_query(tags):
+    """
+    Convert arguments of :meth:`ormist.TaggedModelManager.find` to the query
+    """
+    if len(tags) == 1 and isinstance(tags[0], Q):
+        return tags[0]
+    return Q(*tags)
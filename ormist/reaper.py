@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Expiration reaper
+
+Expired objects are never returned by managers, but they're kept in the
+database until somebody removes them. The reaper is this somebody: it removes
+expired objects of given models in bounded batches, spending no more than a
+fixed time budget per tick.
+
+.. code-block:: python
+
+    from ormist.reaper import Reaper
+
+    reaper = Reaper([Session, Book])
+
+    # in a background thread
+    reaper.start()
+
+    # or in the asyncio event loop
+    reaper.schedule(loop)
+
+    # or from the command line
+    # $ ormist-reaper myapp.models:Session myapp.models:Book
+
+    reaper.stats['session'].removed
+"""
+import argparse
+import importlib
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReapStats(object):
+    """
+    Reaper statistics of a model
+
+    :ivar removed: total number of removed objects
+    :ivar last_removed: number of objects removed during the last tick
+    :ivar lag: number of seconds the oldest expired object, which is still
+               in the database, is past its expiration time
+    :ivar last_run: timestamp of the last tick
+    """
+
+    def __init__(self):
+        self.removed = 0
+        self.last_removed = 0
+        self.lag = 0
+        self.last_run = None
+
+    def __repr__(self):
+        return '<ReapStats removed:%s lag:%.3f>' % (self.removed, self.lag)
+
+
+class Reaper(object):
+
+    def __init__(self, models, batch_size=100, time_budget=0.05, interval=1,
+                 system=None):
+        """
+        Create a new reaper
+
+        :param models: list of model classes to take care of
+        :param batch_size: max number of objects of a model removed with one
+                           call of :meth:`ModelManager.expire`
+        :param time_budget: number of seconds a tick may spend removing
+                            objects. At least one batch per model is removed
+                            every tick. None means "no limit"
+        :param interval: number of seconds between ticks
+        :param system: the system to clean up, by default the system of every
+                       model is used
+        """
+        self.models = list(models)
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self.interval = interval
+        self.system = system
+        self.stats = dict((model.objects.model_name, ReapStats())
+                          for model in self.models)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def tick(self):
+        """
+        Remove expired objects in batches, until there are no more expired
+        objects, or the time budget (if any) is over. Models are served in a
+        round-robin manner.
+
+        :returns: the number of removed objects
+        """
+        deadline = None
+        if self.time_budget is not None:
+            deadline = time.time() + self.time_budget
+        for model in self.models:
+            self.stats[model.objects.model_name].last_removed = 0
+        pending = list(self.models)
+        while pending:
+            for model in list(pending):
+                removed = model.objects.expire(system=self.system,
+                                               limit=self.batch_size)
+                stats = self.stats[model.objects.model_name]
+                stats.removed += removed
+                stats.last_removed += removed
+                if removed < self.batch_size:
+                    pending.remove(model)
+            if deadline is not None and time.time() >= deadline:
+                break
+        now = time.time()
+        for model in self.models:
+            stats = self.stats[model.objects.model_name]
+            stats.lag = model.objects.expire_lag(system=self.system)
+            stats.last_run = now
+        return sum(self.stats[model.objects.model_name].last_removed
+                   for model in self.models)
+
+    def run(self):
+        """
+        Run ticks every :attr:`interval` seconds until :meth:`stop` is called
+        """
+        while not self._stop.is_set():
+            try:
+                self.tick()
+            except Exception:
+                logger.exception('Reaper tick failed')
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """
+        Start the reaper in a background (daemon) thread
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='ormist-reaper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def schedule(self, loop):
+        """
+        Run the reaper periodically in the asyncio event loop
+
+        Ticks are executed in the default executor of the loop, so that they
+        don't block it.
+        """
+        self._stop.clear()
+
+        def run():
+            if self._stop.is_set():
+                return
+            future = loop.run_in_executor(None, self.tick)
+            future.add_done_callback(done)
+
+        def done(future):
+            if not future.cancelled() and future.exception() is not None:
+                logger.error('Reaper tick failed', exc_info=future.exception())
+            loop.call_later(self.interval, run)
+
+        loop.call_soon(run)
+
+    def stop(self):
+        """
+        Stop the reaper, started by :meth:`start` or :meth:`schedule`
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def import_model(path):
+    """
+    Import the model by its path like "myapp.models:Session"
+    """
+    module_name, _, class_name = path.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='ormist-reaper',
+        description='Remove expired objects of ormist models')
+    parser.add_argument('models', nargs='+', metavar='MODULE:MODEL',
+                        help='model to take care of, e.g. myapp.models:Session')
+    parser.add_argument('--system', default=None,
+                        help='system to clean up (default: system of the model)')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--time-budget', type=float, default=0.05)
+    parser.add_argument('--interval', type=float, default=1)
+    parser.add_argument('--once', action='store_true',
+                        help='remove everything expired and exit')
+    opts = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+    models = [import_model(path) for path in opts.models]
+    reaper = Reaper(models, batch_size=opts.batch_size,
+                    time_budget=opts.time_budget, interval=opts.interval,
+                    system=opts.system)
+    if opts.once:
+        while reaper.tick():
+            pass
+        return
+    try:
+        reaper.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
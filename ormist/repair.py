@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Repair of tag indexes
+
+Ids of objects end up in tag sets of tagged models after the objects are
+gone, if they've been removed bypassing ormist, or if a client has died in
+the middle of the non-transactional save or delete (Redis Cluster mode).
+They're harmless, but they take memory and cost lookups of objects, which
+don't exist. :meth:`ormist.TaggedModelManager.repair_tags` removes them.
+
+.. code-block:: python
+
+    report = Book.objects.repair_tags(dry_run=True)
+    report.stale_by_tag  # {'python': 12, 'ruby': 3}
+    Book.objects.repair_tags(rate_limit=10000)  # ids per second
+"""
+import time
+
+
+class TagRepairReport(object):
+    """
+    Report of the repair of tag sets of a model
+
+    :ivar tags: number of scanned tag sets
+    :ivar checked: number of checked ids
+    :ivar stale: number of ids of objects, which don't exist
+    :ivar removed: number of ids removed from tag sets (0 for dry runs)
+    :ivar stale_by_tag: {tag: number of stale ids}
+    """
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.tags = 0
+        self.checked = 0
+        self.stale = 0
+        self.removed = 0
+        self.stale_by_tag = {}
+
+    def add(self, tag, checked, stale, removed):
+        self.checked += checked
+        self.stale += stale
+        self.removed += removed
+        if stale:
+            self.stale_by_tag[tag] = self.stale_by_tag.get(tag, 0) + stale
+
+    def __repr__(self):
+        return '<TagRepairReport tags:%s checked:%s stale:%s removed:%s%s>' % (
+            self.tags, self.checked, self.stale, self.removed,
+            ' dry run' if self.dry_run else '')
+
+
+class RateLimiter(object):
+    """
+    Sleep as much as required to process no more than :attr:`rate` items
+    per second on average
+    """
+
+    def __init__(self, rate=None):
+        """
+        :param rate: number of items per second, None means "no limit"
+        """
+        self.rate = rate
+        self.started = time.time()
+        self.done = 0
+
+    def wait(self, items):
+        self.done += items
+        if not self.rate:
+            return
+        delay = self.started + float(self.done) / self.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
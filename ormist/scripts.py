@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Lua scripts, executed on the server side
+
+Scripts are loaded with SCRIPT LOAD once per system, and then called with
+EVALSHA, usually queued in the same pipeline with other commands of the
+operation.
+"""
+import hashlib
+
+
+#: all scripts defined with :class:`Script`
+SCRIPTS = []
+
+
+class Script(object):
+
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        # names of systems, where the script has been loaded
+        self.systems = set()
+        SCRIPTS.append(self)
+
+    def load(self, redis, system):
+        """
+        Load the script to the redis instance of the system, if it hasn't
+        been loaded before
+        """
+        if system not in self.systems:
+            redis.script_load(self.source)
+            self.systems.add(system)
+
+    def queue(self, pipe, keys, args):
+        """
+        Add the EVALSHA command to the pipeline
+        """
+        keys_and_args = list(keys) + list(args)
+        pipe.evalsha(self.sha, len(keys), *keys_and_args)
+
+
+def reload_scripts(redis, system):
+    """
+    Load all scripts to the system again (e.g. after the script cache of the
+    server has been flushed)
+    """
+    for script in SCRIPTS:
+        script.systems.discard(system)
+        script.load(redis, system)
+
+
+#: Make cached intersections, which depend on the tag, obsolete: bump the
+#: generation of the tag, stored in the key ``gens .. tag``. Empty gens
+#: disable it.
+INVALIDATE_FUNCTION = '''
+local function invalidate(gens, tag)
+    if gens ~= '' then
+        redis.call('INCR', gens .. tag)
+    end
+end
+'''
+
+
+#: Replace tags of the object with given ones, and update the tag index
+#: accordingly. Cached intersections of added and removed tags become
+#: obsolete.
+#:
+#: KEYS[1]: the set of object tags
+#: ARGV[1]: object id, ARGV[2]: prefix of tag keys, ARGV[3]: prefix of
+#: keys of generations of tags or '', ARGV[4...]: tags
+SAVE_TAGS = Script(INVALIDATE_FUNCTION + '''
+local id, prefix, gens = ARGV[1], ARGV[2], ARGV[3]
+local tags = {}
+for i = 4, #ARGV do
+    tags[ARGV[i]] = true
+end
+for _, tag in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    if not tags[tag] then
+        redis.call('SREM', prefix .. tag, id)
+        redis.call('SREM', KEYS[1], tag)
+        invalidate(gens, tag)
+    end
+end
+for tag in pairs(tags) do
+    redis.call('SADD', prefix .. tag, id)
+    if redis.call('SADD', KEYS[1], tag) == 1 then
+        invalidate(gens, tag)
+    end
+end
+''')
+
+
+#: Delete the tagged object: remove it from the tag index, the set of all
+#: objects and the expiration index, and delete all its keys. Cached
+#: intersections of its tags become obsolete.
+#:
+#: KEYS[1]: the set of all objects, KEYS[2]: the expiration index,
+#: KEYS[3]: the set of object tags, KEYS[4...]: other keys of the object
+#: ARGV[1]: object id, ARGV[2]: prefix of tag keys, ARGV[3]: prefix of keys
+#: of generations of tags or ''
+DELETE_TAGGED = Script(INVALIDATE_FUNCTION + '''
+local id, prefix, gens = ARGV[1], ARGV[2], ARGV[3]
+for _, tag in ipairs(redis.call('SMEMBERS', KEYS[3])) do
+    redis.call('SREM', prefix .. tag, id)
+    invalidate(gens, tag)
+end
+redis.call('SREM', KEYS[1], id)
+redis.call('ZREM', KEYS[2], id)
+for i = 3, #KEYS do
+    redis.call('DEL', KEYS[i])
+end
+''')
+
+
+#: Remove ids of objects, which are not in the set of all objects anymore,
+#: from the tag set. The check and the removal are atomic, so that objects
+#: created meanwhile are never removed.
+#:
+#: KEYS[1]: the tag set, KEYS[2]: the set of all objects
+#: ARGV: ids to check
+#: Returns the list of removed ids, which were in the tag set
+REMOVE_STALE_IDS = Script('''
+local removed = {}
+for _, id in ipairs(ARGV) do
+    if redis.call('SISMEMBER', KEYS[2], id) == 0 and
+            redis.call('SREM', KEYS[1], id) == 1 then
+        removed[#removed + 1] = id
+    end
+end
+return removed
+''')
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Serializers of object attributes
+
+Every value written by a serializer starts with a small header, telling which
+codec and which compression has been used, so that the data can be decoded
+regardless of the current settings. Values without the header are considered
+to be written by older versions of ormist, and they are unpickled.
+
+.. code-block:: python
+
+    class Document(ormist.Model):
+        serializer = ormist.Serializer(ormist.JSONCodec(), compression='zlib')
+
+    # or for every model of the system
+    ormist.setup_redis('default', 'localhost', 6379,
+                       serializer=ormist.Serializer(ormist.MsgpackCodec()))
+"""
+import json
+import pickle
+import zlib
+
+from .compat import b, text
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+
+MAGIC = b('\x00')
+
+#: registry of known codecs, {tag: codec}
+CODECS = {}
+
+
+class Codec(object):
+    """
+    Base class for codecs
+
+    Subclasses must define a unique one-byte :attr:`tag` and implement
+    :meth:`dumps` and :meth:`loads`. Codecs are registered, when serializers
+    using them are created, so that :func:`loads` can decode their data. In
+    processes, which only read the data, register them with
+    :func:`register_codec`.
+    """
+    tag = None
+
+    def dumps(self, obj):
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+
+class PickleCodec(Codec):
+    tag = b('p')
+
+    def __init__(self, protocol=2):
+        self.protocol = protocol
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONCodec(Codec):
+    tag = b('j')
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class MsgpackCodec(Codec):
+    tag = b('m')
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError('msgpack is required by MsgpackCodec')
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class CallableCodec(Codec):
+    """
+    Codec built from a pair of user functions
+
+    The codec is registered on creation, so it must be created (with the
+    same tag) in every process, which reads the data.
+    """
+
+    def __init__(self, tag, dumps, loads):
+        if isinstance(tag, text):
+            tag = b(tag)
+        self.tag = tag
+        self.dumps = dumps
+        self.loads = loads
+        register_codec(self)
+
+
+def register_codec(codec):
+    """
+    Make the codec known to :func:`loads`
+
+    Registering another instance of the same codec is a no-op. Tags of
+    different codecs must differ, because data, which is already written,
+    would be decoded with the wrong codec otherwise.
+
+    :raises ValueError: the tag isn't one byte long, or it's taken by a
+                        different codec
+    """
+    tag = codec.tag
+    if tag is None or len(tag) != 1:
+        raise ValueError('Codec tag must be exactly one byte long')
+    registered = CODECS.get(tag)
+    if registered is None:
+        CODECS[tag] = codec
+    elif not _same_codec(registered, codec):
+        raise ValueError('Codec tag %r is taken by %r' % (tag, registered))
+
+
+def _same_codec(codec, other):
+    if type(codec) is not type(other):
+        return False
+    if isinstance(codec, CallableCodec):
+        return codec.dumps is other.dumps and codec.loads is other.loads
+    return True
+
+
+for codec_class in (PickleCodec, JSONCodec):
+    register_codec(codec_class())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+
+
+COMPRESSIONS = {
+    # tag: (compress, decompress)
+    b('z'): (zlib.compress, zlib.decompress),
+}
+if lz4 is not None:
+    COMPRESSIONS[b('4')] = (lz4.compress, lz4.decompress)
+COMPRESSION_TAGS = {'zlib': b('z'), 'lz4': b('4')}
+NO_COMPRESSION = b('-')
+
+
+class Serializer(object):
+
+    def __init__(self, codec=None, compression=None, threshold=1024):
+        """
+        Create a new serializer
+
+        :param codec: codec instance, :class:`PickleCodec` by default
+        :param compression: None, "zlib" or "lz4" (requires lz4 package)
+        :param threshold: compress only values longer than this number of
+                          bytes
+        """
+        if compression is not None:
+            compression_tag = COMPRESSION_TAGS.get(compression)
+            if compression_tag not in COMPRESSIONS:
+                raise RuntimeError('Compression %r is not available' % compression)
+        self.codec = codec or PickleCodec()
+        register_codec(self.codec)
+        self.compression = compression
+        self.threshold = threshold
+
+    def dumps(self, obj):
+        data = self.codec.dumps(obj)
+        compression_tag = NO_COMPRESSION
+        if self.compression and len(data) > self.threshold:
+            compression_tag = COMPRESSION_TAGS[self.compression]
+            data = COMPRESSIONS[compression_tag][0](data)
+        return MAGIC + self.codec.tag + compression_tag + data
+
+    def loads(self, data):
+        return loads(data)
+
+
+def loads(data):
+    """
+    Decode the value, written by any serializer, or the plain pickle
+    """
+    if data[:1] != MAGIC:
+        return pickle.loads(data)
+    codec_tag, compression_tag, data = data[1:2], data[2:3], data[3:]
+    if compression_tag != NO_COMPRESSION:
+        data = COMPRESSIONS[compression_tag][1](data)
+    return CODECS[codec_tag].loads(data)
+
+
+DEFAULT_SERIALIZER = Serializer()
+
+#: serializers of systems, set up with :func:`ormist.setup_redis`
+SYSTEM_SERIALIZERS = {}
+
+
+def get_serializer(system):
+    return SYSTEM_SERIALIZERS.get(system, DEFAULT_SERIALIZER)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Sharding of models across several systems
+
+.. code-block:: python
+
+    ormist.setup_redis('shard0', 'redis0', 6379)
+    ormist.setup_redis('shard1', 'redis1', 6379)
+    ormist.setup_sharded_redis('users', ['shard0', 'shard1'])
+
+    class User(ormist.Model):
+        system = 'users'
+
+Every object lives on the shard owning its id on the consistent hash ring,
+and operations with objects go to their shards. Result sets of ``all()``
+and ``find()`` are evaluated on every shard and merged. Adding a shard to the
+ring moves only about 1/N of objects to it, but moving them is up to you:
+ormist doesn't rebalance shards.
+"""
+import bisect
+import hashlib
+
+from .compat import text, u
+
+
+#: sharded systems, set up with :func:`setup_sharded_redis`, {name: HashRing}
+SHARDED_SYSTEMS = {}
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of systems
+    """
+
+    def __init__(self, nodes, replicas=128):
+        """
+        :param nodes: list of names of systems
+        :param replicas: number of points of every node on the ring. More
+                         points spread objects more evenly
+        """
+        if not nodes:
+            raise RuntimeError('Hash ring requires at least one node')
+        self.nodes = list(nodes)
+        ring = sorted((hash_key('%s:%d' % (node, i)), node)
+                      for node in self.nodes for i in range(replicas))
+        self._points = [point for point, node in ring]
+        self._owners = [node for point, node in ring]
+
+    def get_node(self, key):
+        """
+        Return the node owning the key
+        """
+        index = bisect.bisect(self._points, hash_key(key))
+        return self._owners[index % len(self._owners)]
+
+
+def hash_key(key):
+    key = u(key)
+    if isinstance(key, text):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+def setup_sharded_redis(name, systems, replicas=128):
+    """
+    Setup a sharded system, spreading objects across given systems
+
+    :param name: the name of the sharded system, which models use as their
+                 ``system``
+    :param systems: names of systems (shards), set up with
+                    :func:`ormist.setup_redis`. Reordering or renaming them
+                    moves objects to other shards
+    """
+    SHARDED_SYSTEMS[name] = HashRing(systems, replicas=replicas)
+
+
+def is_sharded(system):
+    return system in SHARDED_SYSTEMS
+
+
+def get_shards(system):
+    """
+    Return the list of systems, where objects of the system live
+    """
+    if system in SHARDED_SYSTEMS:
+        return SHARDED_SYSTEMS[system].nodes
+    return [system]
+
+
+def get_shard(system, id):
+    """
+    Return the system, where the object with given id lives
+    """
+    if system in SHARDED_SYSTEMS:
+        return SHARDED_SYSTEMS[system].get_node(str(u(id)))
+    return system
+
+
+def group_by_shard(system, items, get_id=lambda item: item):
+    """
+    Split items (ids or instances) by shards of the system, and return the
+    list of tuples (shard, items), preserving the order of items
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault(get_shard(system, get_id(item)), []).append(item)
+    return sorted(groups.items())
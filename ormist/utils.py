@@ -1,19 +1,74 @@
 # -*- coding: utf-8 -*-
 import calendar
+import os
 import string
 import random
 import datetime
+import numbers
 
-from .compat import xrange
+from .compat import xrange, b
+
+# random bits from the OS: the state of the random module isn't reseeded in
+# forked processes before Python 3.7, so that they'd generate the same ids
+_system_random = random.SystemRandom()
 
 
 def random_string(len, corpus=None):
     """
     Return random string with given len
     """
-    if not corpus:
-        corpus = string.ascii_letters + string.digits
-    return ''.join(random.choice(corpus) for _ in xrange(len))
+    return _random_chars(len, corpus or ALPHANUMERIC)
+
+
+ALPHANUMERIC = string.ascii_letters + string.digits
+
+# {corpus: (table of bytes.translate(), bytes to delete) or None}
+_translations = {}
+
+
+def _random_chars(count, corpus):
+    translation = _translations.get(corpus, False)
+    if translation is False:
+        translation = _translations[corpus] = _translation(corpus)
+    if translation is None:
+        return ''.join(_system_random.choice(corpus) for _ in xrange(count))
+    table, delete, limit = translation
+    # random bytes are mapped to characters in C with one urandom call
+    # (usually), instead of one per character
+    chars = b''
+    while len(chars) < count:
+        chars += os.urandom(count * 256 // limit + 8).translate(table, delete)
+    chars = chars[:count]
+    return chars if isinstance(chars, str) else chars.decode('ascii')
+
+
+def _translation(corpus):
+    """
+    Return the tuple (table, bytes to delete, number of kept bytes) to map
+    random bytes to characters of the corpus, or None, if they can't be
+    """
+    if len(corpus) > 256 or any(ord(char) > 127 for char in corpus):
+        return None
+    # bytes above the largest multiple of the size of the corpus are
+    # deleted, otherwise first characters of the corpus would be more likely
+    limit = 256 - 256 % len(corpus)
+    table = b((corpus * (256 // len(corpus) + 1))[:256])
+    delete = b(''.join(chr(byte) for byte in xrange(limit, 256)))
+    return table, delete, limit
+
+
+def chunks(iterable, size):
+    """
+    Split iterable into lists of at most :param:`size` items each
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def expire_to_datetime(expire):
@@ -47,6 +102,22 @@ def datetime_to_timestamp(dt):
     return ts + micro
 
 
+def to_score(value):
+    """
+    Convert the value of an indexed attribute to the score of a sorted set
+
+    Numbers are used as is, datetimes (considered as UTC ones) and dates are
+    converted to timestamps
+    """
+    if isinstance(value, datetime.datetime):
+        return datetime_to_timestamp(value)
+    if isinstance(value, datetime.date):
+        return calendar.timegm(value.timetuple())
+    if isinstance(value, numbers.Number):
+        return float(value)
+    raise ValueError('Value %r can\'t be indexed' % (value, ))
+
+
 def timestamp_to_datetime(ts):
     """
     Convert timestamps to datetime objects
@@ -20,6 +20,9 @@ setup(
     packages = ['ormist', ],
     long_description = read('README.rst'),
     install_requires = ['redis', ],
+    entry_points = {
+        'console_scripts': ['ormist-reaper = ormist.reaper:main'],
+    },
     classifiers = [
         'Development Status :: 4 - Beta',
         'Programming Language :: Python :: 2.6',
@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
+import binascii
 import datetime
+import os
+import pickle
+import random
+import warnings
 import mock
 import pytest
 import ormist
+from ormist import Q
+from ormist.compat import b, u
+from redis.exceptions import ConnectionError as RedisConnectionError
 
 
 ormist.setup_redis('default', 'localhost', 6379, db=0)
@@ -213,19 +221,25 @@ def test_expire_saves_attribute(user):
 def test_expire_removes_object_do_expire(user):
     user.set_expire(0)  # expire in 0 seconds
     user.save()
-    with mock.patch('ormist.managers.random_true') as random_true:
-        random_true.return_value = True
-        assert User.objects.get(user.id) is None
-        assert list(User.objects.all()) == []
+    assert User.objects.expire() == 1
+    assert User.objects.get(user.id) is None
+    assert list(User.objects.all()) == []
+    assert User.objects.expire() == 0
 
 
 def test_expire_removes_object_do_not_expire(user):
     user.set_expire(0)  # expire in 0 seconds
     user.save()
-    with mock.patch('ormist.managers.random_true') as random_true:
-        random_true.return_value = False
-        assert User.objects.get(user.id) is None
-        assert list(User.objects.all()) == []
+    assert User.objects.get(user.id) is None
+    assert list(User.objects.all()) == []
+
+
+def test_expire_limit():
+    User.objects.create_many([{'expire': 0}] * 3)
+    assert User.objects.expire(limit=2) == 2
+    assert User.objects.expire_lag() >= 0
+    assert User.objects.expire(limit=2) == 1
+    assert User.objects.expire_lag() == 0
 
 
 def test_ttl(user):
@@ -262,3 +276,1585 @@ def test_model_result_set():
     assert users.count() == 3
     assert len(users) == 3
     assert len(users.list()) == 3
+
+
+def test_model_result_set_loads_in_chunks():
+    ids = [User.objects.create(name='user %d' % i).id for i in range(5)]
+    with mock.patch.object(User.objects, 'chunk_size', 2):
+        users = User.objects.all().list()
+    assert set(user.id for user in users) == set(ids)
+
+
+def test_model_result_set_slicing_loads_required_objects_only():
+    ids = set(user.id for user in User.objects.create_many([{}] * 5))
+    load_many = User.objects._load_many
+    with mock.patch.object(User.objects, '_load_many') as patched:
+        patched.side_effect = load_many
+        users = User.objects.all()
+        assert users[0].id in ids
+        assert len(users[1:3]) == 2
+        assert len(users[4:10]) == 1
+        with pytest.raises(IndexError):
+            users[5]
+    loaded = [len(call[0][0]) for call in patched.call_args_list]
+    assert loaded == [1, 3, 5, 5]
+    assert users._cache is None
+
+
+def test_find_streams_intersection(book):
+    Book.objects.create('foo', title='Foo only')
+    books = Book.objects.find('foo', 'bar')
+    assert [b.id for b in books] == [book.id]
+    assert [b.title for b in books[:1]] == ['How to Foo and Bar']
+    # temporary keys are removed after the iteration
+    assert not list(ormist.get_redis().scan_iter('ormist:book:__tmp__:*'))
+
+def test_model_result_set_count_doesnt_load_objects(book):
+    Book.objects.create('foo', title='Foo only')
+    with mock.patch.object(Book.objects, '_load_many') as load_many:
+        assert Book.objects.all().count() == 2
+        assert Book.objects.find('foo').count() == 2
+        assert Book.objects.find('foo', 'bar').count() == 1
+        assert Book.objects.find('foo', 'baz').count() == 0
+    assert not load_many.called
+    assert not list(ormist.get_redis().scan_iter('ormist:book:__tmp__:*'))
+
+
+def test_model_result_set_len(book):
+    Book.objects.create('foo', title='Foo only')
+    books = Book.objects.find('foo')
+    with mock.patch.object(Book.objects, '_count_result') as count_result:
+        assert len(list(books)) == 2
+        assert len(books) == 2
+    assert not count_result.called
+
+
+def test_model_result_set_exact_count(book):
+    Book.objects.create('foo', title='Expired', expire=datetime.datetime(2012, 1, 1))
+    Book.objects.create('foo', title='Expires later', expire=3600)
+    assert Book.objects.find('foo').count() == 3
+    assert Book.objects.find('foo').count(exact=True) == 2
+    assert Book.objects.find('foo', 'bar').count(exact=True) == 1
+    assert Book.objects.all().count(exact=True) == 2
+
+
+def test_exists(user):
+    assert User.objects.exists(1234)
+    assert not User.objects.exists('missing')
+    user.set_expire(datetime.datetime(2012, 1, 1))
+    user.save()
+    assert not User.objects.exists(1234)
+
+#--- Test for get_many
+
+def test_get_many(user):
+    other = User.objects.create(name='Jane Doe')
+    users = User.objects.get_many([other.id, 'missing', user.id])
+    assert users == [other, user]
+    assert users[0].name == 'Jane Doe'
+
+
+def test_get_many_skips_expired(user):
+    other = User.objects.create(name='Jane Doe', expire=datetime.datetime(2012, 1, 1))
+    assert User.objects.get_many([user.id, other.id]) == [user]
+
+
+def test_get_many_tagged(book, tags):
+    books = Book.objects.get_many([book.id])
+    assert books == [book]
+    assert set(books[0].tags) == set(tags)
+
+#--- Test for bulk writes
+
+def test_save_many():
+    users = [User(id=1, name='John'), User(name='Jane', expire=10)]
+    with mock.patch.object(User.objects, 'chunk_size', 1):
+        User.objects.save_many(users)
+    assert users[1].id is not None
+    assert set(user.id for user in User.objects.all()) == set(user.id for user in users)
+    assert User.objects.get(users[1].id).ttl() > 0
+
+
+def test_create_many_tagged():
+    books = Book.objects.create_many([(('foo', 'bar'), {'title': 'Foo'}),
+                                      {'title': 'Untagged'}])
+    assert len(set(book.id for book in books)) == 2
+    assert Book.objects.find('foo', 'bar').list() == [books[0]]
+    assert Book.objects.get(books[1].id).title == 'Untagged'
+
+
+def test_delete_many(book, tags):
+    other = Book.objects.create('foo')
+    Book.objects.delete_many([book, other.id])
+    assert list(Book.objects.all()) == []
+    assert len(Book.objects.find_ids(tags[0])) == 0
+    assert len(Book.objects.find_ids(tags[1])) == 0
+
+
+def test_reserve_random_ids_failed_random():
+    with mock.patch('ormist.managers.random_string') as random_string:
+        random_string.return_value = '1234'
+        with pytest.raises(RuntimeError):
+            User.objects.reserve_random_ids(2)
+
+
+def test_delete_removes_object_keys(book):
+    book.set_expire(10)
+    book.save()
+    redis = ormist.get_redis()
+    with mock.patch.object(redis, 'keys') as keys:
+        book.delete()
+    assert not keys.called
+    assert redis.keys('ormist:book:object:*') == []
+
+#--- Test for full cleanup
+
+def test_full_cleanup(book):
+    Book.objects.create('foo')
+    progress = []
+    removed = Book.objects.full_cleanup(batch_size=2, callback=progress.append)
+    # 2 objects with tags keys, 2 tag sets and __all__
+    assert removed == 7
+    assert progress[-1] == removed
+    assert ormist.get_redis().keys('ormist:book:*') == []
+
+#--- Test for reaper
+
+def test_reaper_tick(book):
+    Book.objects.create_many([(('foo', ), {'expire': 0})] * 5)
+    reaper = ormist.Reaper([Book, User], batch_size=2, time_budget=None)
+    assert reaper.tick() == 5
+    assert reaper.stats['book'].removed == 5
+    assert reaper.stats['book'].lag == 0
+    assert Book.objects.find('foo').list() == [book]
+    assert Book.objects.find_ids('foo') == set([b('1234')])
+
+
+def test_reaper_time_budget():
+    User.objects.create_many([{'expire': 0}] * 5)
+    reaper = ormist.Reaper([User], batch_size=2, time_budget=0)
+    assert reaper.tick() == 2
+    assert reaper.stats['user'].lag >= 0
+    assert reaper.tick() == 2
+    assert reaper.tick() == 1
+    assert reaper.stats['user'].removed == 5
+
+#--- Test for serializers
+
+class JSONUser(ormist.Model):
+    model_name = 'user'
+    serializer = ormist.Serializer(ormist.JSONCodec(), compression='zlib',
+                                   threshold=10)
+
+
+def test_json_serializer():
+    user = JSONUser.objects.create(name='John Doe', bio='x' * 100)
+    value = ormist.get_redis().get('ormist:user:object:%s' % user.id)
+    assert value.startswith(b('\x00jz'))
+    # models with different serializers can read the data
+    same_user = User.objects.get(user.id)
+    assert same_user.name == 'John Doe'
+    assert same_user.bio == 'x' * 100
+
+
+def test_legacy_pickle_data(user):
+    import pickle
+    ormist.get_redis().set('ormist:user:object:1234', pickle.dumps({'name': 'Old'}))
+    assert User.objects.get(1234).name == 'Old'
+
+
+def test_callable_codec():
+    codec = ormist.CallableCodec('r', lambda obj: b(repr(obj)),
+                                 lambda data: eval(u(data)))
+    serializer = ormist.Serializer(codec)
+    data = serializer.dumps({'foo': 1})
+    assert data == b("\x00r-{'foo': 1}")
+    assert serializer.loads(data) == {'foo': 1}
+    # the tag of the codec can't be taken by another one
+    with pytest.raises(ValueError):
+        ormist.CallableCodec('r', repr, eval)
+    with pytest.raises(ValueError):
+        ormist.CallableCodec('j', repr, eval)
+    ormist.register_codec(ormist.JSONCodec())
+    del ormist.serializers.CODECS[b('r')]
+
+
+class UpperCodec(ormist.JSONCodec):
+    tag = b('u')
+
+    def dumps(self, obj):
+        return super(UpperCodec, self).dumps(obj).upper()
+
+
+def test_codec_registered_by_serializer():
+    serializer = ormist.Serializer(UpperCodec())
+    try:
+        assert ormist.serializers.loads(serializer.dumps('foo')) == 'FOO'
+    finally:
+        del ormist.serializers.CODECS[b('u')]
+
+#--- Test for hash storage
+
+class HashUser(ormist.Model):
+    storage = 'hash'
+
+class HashTaggedUser(ormist.TaggedAttrsModel):
+    storage = 'hash'
+
+
+def pytest_funcarg__hash_user(request):
+    user = HashUser(id=1234, name='John Doe', age=30)
+    user.save()
+    request.addfinalizer(HashUser.objects.full_cleanup)
+    return user
+
+
+def test_hash_save_and_get(hash_user):
+    redis = ormist.get_redis()
+    assert redis.type('ormist:hash_user:object:1234') == b('hash')
+    same_user = HashUser.objects.get(1234)
+    assert same_user.attrs == {'name': 'John Doe', 'age': 30}
+    same_user.unset('age')
+    same_user.save()
+    assert HashUser.objects.get(1234).attrs == {'name': 'John Doe'}
+
+
+def test_hash_save_without_deprecated_commands(hash_user):
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        hash_user.set(age=31)
+        hash_user.save()
+    assert not [w for w in caught if issubclass(w.category, DeprecationWarning)]
+    assert HashUser.objects.get(1234).age == 31
+
+
+def test_hash_only(hash_user):
+    user = HashUser.objects.all().only('name')[0]
+    assert user.attrs == {'name': 'John Doe'}
+    # partial instances don't remove attributes they don't know about
+    user.set(name='Just John')
+    user.save()
+    assert HashUser.objects.get(1234).attrs == {'name': 'Just John', 'age': 30}
+
+
+def test_hash_defer(hash_user):
+    users = HashUser.objects.get_many([1234, 'missing'], defer=['name'])
+    assert [user.attrs for user in users] == [{'age': 30}]
+
+
+def test_hash_partial_tagged_attrs_model():
+    HashTaggedUser.objects.create(id=1234, name='John Doe', age=30)
+    user = HashTaggedUser.objects.find(age=30).only('name')[0]
+    assert set(user.tags) >= set(['name:John Doe', 'age:30'])
+    with pytest.raises(RuntimeError):
+        user.save()
+    HashTaggedUser.objects.full_cleanup()
+
+#--- Test for dirty tracking
+
+def test_save_unchanged_writes_nothing(user):
+    same_user = User.objects.get(user.id)
+    redis = ormist.get_redis()
+    redis.set('ormist:user:object:1234', 'garbage')
+    same_user.save()
+    assert redis.get('ormist:user:object:1234') == b('garbage')
+    same_user.set(age=31)
+    same_user.save()
+    assert User.objects.get(user.id).age == 31
+
+
+def test_save_writes_changed_fields_only(hash_user):
+    same_user = HashUser.objects.get(hash_user.id)
+    redis = ormist.get_redis()
+    redis.hset('ormist:hash_user:object:1234', 'name',
+               HashUser.objects.get_serializer('default').dumps('Jane Doe'))
+    same_user.set(age=31)
+    same_user.save()
+    assert HashUser.objects.get(hash_user.id).attrs == {'name': 'Jane Doe',
+                                                        'age': 31}
+
+
+def test_save_to_other_system_writes_everything(user):
+    same_user = User.objects.get(user.id)
+    same_user.save(system='db1')
+    assert User.objects.get(user.id, system='db1').name == 'John Doe'
+    User.objects.delete_instance_by_id(user.id, system='db1')
+
+
+def test_unset_expire(user):
+    user.set_expire(10)
+    user.save()
+    same_user = User.objects.get(user.id)
+    same_user.set_expire(None)
+    same_user.save()
+    assert User.objects.get(user.id).expire is None
+    assert ormist.get_redis().zscore('ormist:user:__expire__', user.id) is None
+
+
+def test_loaded_tags_remove(book):
+    same_book = Book.objects.get(book.id)
+    same_book.tags = []
+    same_book.save()
+    assert Book.objects.get(book.id).tags == []
+    assert list(Book.objects.find('foo')) == []
+
+
+def test_save_after_concurrent_delete(user, hash_user):
+    for model, instance in ((User, user), (HashUser, hash_user)):
+        same_instance = model.objects.get(instance.id)
+        model.objects.delete_instance_by_id(instance.id)
+        same_instance.set(name='Jane Doe')
+        same_instance.save()
+        assert model.objects.get(instance.id).name == 'Jane Doe'
+        assert [i.id for i in model.objects.all()] == [instance.id]
+
+
+def test_save_after_delete_many(book):
+    Book.objects.delete_many([book])
+    book.save()
+    assert Book.objects.get(book.id).title == book.title
+    assert [b.id for b in Book.objects.find('foo')] == [book.id]
+
+#--- Test for query expressions
+
+def pytest_funcarg__books(request):
+    books = Book.objects.create_many([
+        (('python', 'web'), {'title': 'Django'}),
+        (('python', 'cli'), {'title': 'Click'}),
+        (('ruby', 'web'), {'title': 'Rails'}),
+        (('ruby', 'web', 'beginners'), {'title': 'Rails for beginners'}),
+    ])
+    request.addfinalizer(Book.objects.full_cleanup)
+    return books
+
+
+def find_titles(*tags):
+    return sorted(book.title for book in Book.objects.find(*tags))
+
+
+def test_query_union(books):
+    assert find_titles(Q('python') | Q('ruby')) == [
+        'Click', 'Django', 'Rails', 'Rails for beginners']
+    assert find_titles(Q('cli') | Q('missing')) == ['Click']
+
+
+def test_query_difference(books):
+    assert find_titles('web', ~Q('python')) == ['Rails', 'Rails for beginners']
+    assert find_titles(~Q('web')) == ['Click']
+    assert find_titles(~~Q('cli')) == ['Click']
+
+
+def test_query_nested(books):
+    query = (Q('python') | Q('ruby')) & Q('web') & ~Q('beginners')
+    assert find_titles(query) == ['Django', 'Rails']
+    assert find_titles(Q('ruby') & (Q('cli') | Q('beginners'))) == [
+        'Rails for beginners']
+    assert Book.objects.find(query).count() == 2
+    assert not list(ormist.get_redis().scan_iter('ormist:book:__tmp__:*'))
+
+
+def test_query_skips_empty_intersections(books):
+    query = Q('missing') & (Q('python') | Q('ruby'))
+    with mock.patch.object(ormist.get_redis(), 'pipeline') as pipeline:
+        pipeline.return_value.execute.return_value = [0, 0, 0, 4]
+        key, temp_keys = Book.objects._store_query(query, 'default')
+    assert temp_keys == []
+    assert not pipeline.return_value.sunionstore.called
+    assert not pipeline.return_value.sinterstore.called
+    assert find_titles(query) == []
+
+#--- Test for sorted indexes
+
+class Employee(ormist.TaggedAttrsModel):
+    objects = ormist.TaggedAttrsModelManager(['name'])
+    indexes = ['age', 'hired']
+
+
+def pytest_funcarg__employees(request):
+    employees = Employee.objects.create_many([
+        {'name': 'John', 'age': 20, 'dept': 1,
+         'hired': datetime.datetime(2010, 1, 1)},
+        {'name': 'Mary', 'age': 30, 'dept': 1,
+         'hired': datetime.datetime(2011, 1, 1)},
+        {'name': 'Jane', 'age': 40, 'dept': 2},
+    ])
+    request.addfinalizer(Employee.objects.full_cleanup)
+    return employees
+
+
+def find_names(**attrs):
+    return sorted(e.name for e in Employee.objects.find(**attrs))
+
+
+def test_indexed_attrs_are_not_tags(employees):
+    assert set(employees[0].tags) == set(['dept:1'])
+
+
+def test_index_range_lookups(employees):
+    assert find_names(age__gte=20, age__lt=40) == ['John', 'Mary']
+    assert find_names(age__gt=20) == ['Jane', 'Mary']
+    assert find_names(age__lte=30, dept=1) == ['John', 'Mary']
+    assert find_names(age=30) == ['Mary']
+    assert find_names(hired__lt=datetime.datetime(2011, 1, 1)) == ['John']
+    assert find_names(age__gt=20, hired__gte=datetime.date(2010, 6, 1)) == ['Mary']
+    assert Employee.objects.find(age__gt=20, dept=1).count() == 1
+    assert not list(ormist.get_redis().scan_iter('ormist:employee:__tmp__:*'))
+
+
+def test_index_not_indexed_lookup(employees):
+    with pytest.raises(RuntimeError):
+        Employee.objects.find(dept__gt=1)
+
+
+def test_index_updated_on_save_and_delete(employees):
+    john = employees[0]
+    john.set(age=50)
+    john.unset('hired')
+    john.save()
+    assert find_names(age__gte=45) == ['John']
+    assert find_names(hired__gte=datetime.date(2000, 1, 1)) == ['Mary']
+    john.delete()
+    assert find_names(age__gte=0) == ['Jane', 'Mary']
+    assert ormist.get_redis().zcard('ormist:employee:index:age') == 2
+
+#--- Test for ordering
+
+class Article(ormist.Model):
+    indexes = ['published']
+
+
+def pytest_funcarg__articles(request):
+    articles = Article.objects.create_many(
+        [{'title': 'article %d' % i, 'published': i} for i in range(1, 6)] +
+        [{'title': 'draft'}])
+    request.addfinalizer(Article.objects.full_cleanup)
+    return articles
+
+
+def titles(articles):
+    return [article.title for article in articles]
+
+
+def test_order_by(articles):
+    # objects without the attribute are left out
+    assert titles(Article.objects.all().order_by('published')) == [
+        'article 1', 'article 2', 'article 3', 'article 4', 'article 5']
+    assert titles(Article.objects.all().order_by('-published')[:2]) == [
+        'article 5', 'article 4']
+    assert Article.objects.all().order_by('published')[1].title == 'article 2'
+    assert Article.objects.all().order_by('published').count() == 5
+    # the index is paged as is
+    assert not list(ormist.get_redis().scan_iter('ormist:article:__tmp__:*'))
+
+
+def test_order_by_negative_values(articles):
+    Article(title='old', published=-1).save()
+    Article(title='zero', published=0).save()
+    assert titles(Article.objects.all().order_by('published')[:3]) == [
+        'old', 'zero', 'article 1']
+
+
+def test_order_by_loads_page_only(articles):
+    load_many = Article.objects._load_many
+    with mock.patch.object(Article.objects, '_load_many') as patched:
+        patched.side_effect = load_many
+        page = Article.objects.all().order_by('-published')[2:4]
+    assert titles(page) == ['article 3', 'article 2']
+    assert [len(call[0][0]) for call in patched.call_args_list] == [2]
+
+
+def test_order_by_stores_result_once(employees):
+    employees = Employee.objects.find(dept=1).order_by('hired')
+    store_ordering = Employee.objects._store_ordering
+    with mock.patch.object(Employee.objects, '_store_ordering') as patched:
+        patched.side_effect = store_ordering
+        assert employees[0].name == 'John'
+        assert employees[1].name == 'Mary'
+        assert employees.count() == 2
+    assert patched.call_count == 1
+    # the stored result expires, and it's stored again then
+    ormist.get_redis().delete(*employees._ordered_keys.values())
+    assert [e.name for e in employees] == ['John', 'Mary']
+
+
+def test_order_by_not_indexed(articles):
+    with pytest.raises(RuntimeError):
+        Article.objects.all().order_by('title')
+
+
+def test_order_by_with_lookups(employees):
+    employees = Employee.objects.find(age__gte=25).order_by('-age')
+    assert [e.name for e in employees] == ['Jane', 'Mary']
+    employees = Employee.objects.find(dept=1).order_by('hired')
+    assert [e.name for e in employees] == ['John', 'Mary']
+
+#--- Test for sharding
+
+ormist.setup_redis('shard0', 'localhost', 6379, db=2)
+ormist.setup_redis('shard1', 'localhost', 6379, db=3)
+ormist.setup_sharded_redis('sharded', ['shard0', 'shard1'])
+
+
+class ShardedBook(ormist.TaggedModel):
+    system = 'sharded'
+    indexes = ['year']
+
+
+def pytest_funcarg__sharded_books(request):
+    books = ShardedBook.objects.create_many(
+        [(('even' if i % 2 == 0 else 'odd', ), {'year': 2000 + i})
+         for i in range(20)])
+    request.addfinalizer(ShardedBook.objects.full_cleanup)
+    return books
+
+
+def test_sharding_spreads_objects(sharded_books):
+    sizes = [ormist.get_redis(shard).scard('ormist:sharded_book:__all__')
+             for shard in ('shard0', 'shard1')]
+    assert sum(sizes) == 20 and min(sizes) > 0
+    for book in sharded_books:
+        shard = ormist.get_shard('sharded', book.id)
+        assert ormist.get_redis(shard).exists('ormist:sharded_book:object:%s' % book.id)
+
+
+def test_sharding_routes_objects(sharded_books):
+    book = ShardedBook.objects.get(sharded_books[0].id)
+    assert book.year == 2000
+    book.set(year=1999)
+    book.save()
+    assert ShardedBook.objects.get(book.id).year == 1999
+    assert ShardedBook.objects.exists(book.id)
+    assert len(ShardedBook.objects.get_many([b.id for b in sharded_books])) == 20
+    book.delete()
+    assert ShardedBook.objects.get(book.id) is None
+    ShardedBook.objects.delete_many(sharded_books[1:5])
+    assert ShardedBook.objects.all().count() == 15
+
+
+def test_sharding_fans_out_result_sets(sharded_books):
+    assert ShardedBook.objects.all().count() == 20
+    assert len(ShardedBook.objects.find('even').list()) == 10
+    assert len(ShardedBook.objects.find_ids('odd')) == 10
+    books = ShardedBook.objects.find('odd').order_by('-year')[1:4]
+    assert [book.year for book in books] == [2017, 2015, 2013]
+
+
+def test_sharding_abandoned_iteration_removes_temp_keys(sharded_books):
+    ShardedBook.objects.create_many([(('even', 'odd'), {}) for _ in range(20)])
+    ids = ShardedBook.objects.find('even', 'odd')._iter_ids()
+    next(ids)
+    ids.close()
+    for shard in ('shard0', 'shard1'):
+        assert not list(ormist.get_redis(shard).scan_iter('ormist:sharded_book:__tmp__:*'))
+
+
+def test_hash_ring_moves_few_keys():
+    from ormist.sharding import HashRing
+    keys = [str(i) for i in range(1000)]
+    ring = HashRing(['a', 'b', 'c'])
+    bigger_ring = HashRing(['a', 'b', 'c', 'd'])
+    moved = [key for key in keys if ring.get_node(key) != bigger_ring.get_node(key)]
+    assert all(bigger_ring.get_node(key) == 'd' for key in moved)
+    assert 150 < len(moved) < 350
+
+#--- Test for cluster mode
+
+class ClusterBook(ormist.TaggedModel):
+    cluster = True
+
+
+def test_cluster_keys_are_hash_tagged():
+    book = ClusterBook('foo', id=1234, title='Foo')
+    book.save()
+    redis = ormist.get_redis()
+    assert redis.exists('ormist:cluster_book:object:{1234}')
+    assert redis.exists('ormist:cluster_book:object:{1234}:tags')
+    assert redis.sismember('ormist:{cluster_book}:__all__', '1234')
+    assert redis.sismember('ormist:{cluster_book}:tags:foo', '1234')
+    assert ClusterBook.objects.get(1234).title == 'Foo'
+    assert [b.id for b in ClusterBook.objects.find('foo')] == ['1234']
+    assert ClusterBook.objects.full_cleanup() == 4
+    assert not redis.exists('ormist:cluster_book:object:{1234}')
+
+
+class IndexedClusterBook(ormist.TaggedModel):
+    cluster = True
+    indexes = ['year']
+    query_cache_ttl = 30
+    scripting = False
+
+
+def hash_slot(key):
+    """
+    Return the Redis Cluster hash slot of the key
+    """
+    key = u(key)
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return binascii.crc_hqx(key.encode('utf-8'), 0) % 16384
+
+
+def command_keys(name, args):
+    """
+    Return keys of the multi-key command, called by the method of the client
+    """
+    if name == 'execute_command':
+        name, args = args[0].lower(), args[1:]
+    if name in ('sinterstore', 'sunionstore', 'sdiffstore', 'zinterstore',
+                'zunionstore'):
+        return [args[0]] + list(args[1])
+    if name in ('delete', 'del', 'unlink', 'mget', 'sinter', 'sunion',
+                'sdiff', 'exists', 'watch'):
+        keys = []
+        for arg in args:
+            keys.extend(arg if isinstance(arg, (list, tuple)) else [arg])
+        return keys
+    if name in ('rename', 'renamenx', 'smove'):
+        return list(args[:2])
+    return []
+
+
+class SlotCheckingClient(object):
+    """
+    Proxy of the client (or the pipeline), which checks that keys of every
+    multi-key command are in the same hash slot
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __enter__(self):
+        self._client.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._client.__exit__(*exc_info)
+
+    def __len__(self):
+        return len(self._client)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        if name == 'pipeline':
+            return lambda *args, **kwargs: SlotCheckingClient(attr(*args, **kwargs))
+
+        def command(*args, **kwargs):
+            keys = command_keys(name, args)
+            assert len(set(hash_slot(key) for key in keys)) <= 1, (name, keys)
+            return attr(*args, **kwargs)
+        return command
+
+
+def test_cluster_multi_key_commands_share_hash_slot():
+    trace = ormist.managers._trace
+    patch = mock.patch.object(ormist.managers, '_trace',
+                              lambda client: SlotCheckingClient(trace(client)))
+    objects = IndexedClusterBook.objects
+    try:
+        with patch:
+            books = objects.create_many(
+                [(('foo', 'bar') if i % 2 else ('foo', ), {'year': 2000 + i})
+                 for i in range(10)])
+            assert len(objects.find('foo', 'bar').list()) == 5
+            assert objects.find('foo', 'bar').count() == 5
+            assert objects.find(Q('foo') & ~Q('bar') | Q('baz')).count() == 5
+            years = [b.year for b in objects.find('foo', 'bar').order_by('-year')[1:3]]
+            assert years == [2007, 2005]
+            assert objects.all().order_by('year').count() == 10
+            books[0].tags = ['bar']
+            books[0].save()
+            books[1].delete()
+            objects.delete_many(books[2:4])
+            objects.repair_tags()
+            objects.expire()
+            assert objects.all().count() == 7
+    finally:
+        objects.full_cleanup()
+
+#--- Test for read replicas
+
+# the replica never gets data of the primary here, so that we can see where
+# reads go
+ormist.setup_redis('replicated', 'localhost', 6379, db=4, replicas=[{'db': 5}])
+
+
+class ReplicatedBook(ormist.TaggedModel):
+    system = 'replicated'
+
+
+def pytest_funcarg__replicated_book(request):
+    book = ReplicatedBook('foo', id=1234, title='Foo')
+    book.save()
+    request.addfinalizer(ReplicatedBook.objects.full_cleanup)
+    return book
+
+
+def test_reads_go_to_replicas(replicated_book):
+    assert ReplicatedBook.objects.get(1234) is None
+    assert not ReplicatedBook.objects.exists(1234)
+    assert ReplicatedBook.objects.find('foo').count() == 0
+    assert ReplicatedBook.objects.all().list() == []
+    assert not ReplicatedBook.objects.find_ids('foo')
+
+
+def test_use_primary(replicated_book):
+    with ormist.use_primary():
+        assert ReplicatedBook.objects.get(1234).title == 'Foo'
+        with ormist.use_primary():
+            assert ReplicatedBook.objects.exists(1234)
+        assert [b.id for b in ReplicatedBook.objects.find('foo')] == ['1234']
+    assert ReplicatedBook.objects.get(1234) is None
+
+
+def test_replica_strategies():
+    clients = [mock.Mock(), mock.Mock()]
+    replicas = ormist.ReplicaSet(clients)
+    assert [replicas.choose() for _ in range(3)] == [clients[0], clients[1], clients[0]]
+    for client in clients:
+        client.connection_pool._in_use_connections = set()
+        client.connection_pool._available_connections = []
+    replicas = ormist.ReplicaSet(clients, strategy='least_loaded')
+    # idle replicas are used in turn
+    assert [replicas.choose() for _ in range(3)] == [clients[0], clients[1], clients[0]]
+    clients[0].connection_pool._in_use_connections = set([1, 2])
+    clients[1].connection_pool._in_use_connections = set([1])
+    assert [replicas.choose() for _ in range(2)] == [clients[1], clients[1]]
+    with pytest.raises(RuntimeError):
+        ormist.ReplicaSet(clients, strategy='random')
+
+#--- Test for connection pools
+
+def test_systems_are_lazy():
+    ormist.setup_redis('lazy', 'localhost', 6379, db=6)
+    assert 'lazy' not in ormist.pool_stats()
+    # clients of configured systems are created on access
+    assert 'lazy' in ormist.SYSTEMS
+    client = ormist.SYSTEMS['lazy']
+    assert ormist.get_redis('lazy') is client
+    assert 'lazy' in ormist.pool_stats()
+    with pytest.raises(KeyError):
+        ormist.SYSTEMS['unknown']
+
+
+def test_pool_stats():
+    ormist.setup_redis('pooled', 'localhost', 6379, db=6, max_connections=3)
+    pool = ormist.get_redis('pooled').connection_pool
+    connection = pool.get_connection('PING')
+    stats = ormist.pool_stats('pooled')
+    assert stats['created'] == 1
+    assert stats['in_use'] == 1
+    assert stats['idle'] == 0
+    assert stats['max_connections'] == 3
+    pool.release(connection)
+    stats = ormist.pool_stats('pooled')
+    assert (stats['in_use'], stats['idle']) == (0, 1)
+    # non-blocking pools don't wait
+    assert 'waits' not in stats
+
+
+def test_blocking_pool_waits():
+    ormist.setup_redis('blocking', 'localhost', 6379, db=6, max_connections=1,
+                       blocking_pool=True, pool_timeout=0.01)
+    pool = ormist.get_redis('blocking').connection_pool
+    connection = pool.get_connection('PING')
+    with pytest.raises(RedisConnectionError):
+        pool.get_connection('PING')
+    assert ormist.pool_stats('blocking')['waits'] == 1
+    pool.release(connection)
+    assert ormist.pool_stats('blocking')['in_use'] == 0
+
+
+def test_foreign_blocking_pool_stats():
+    import redis
+    pool = redis.BlockingConnectionPool(max_connections=2)
+    # a connection taken from the pool
+    pool.make_connection()
+    stats = ormist.connection_stats(mock.Mock(connection_pool=pool))
+    assert (stats['created'], stats['in_use'], stats['idle']) == (1, 1, 0)
+
+
+def test_pool_reset_after_fork():
+    ormist.setup_redis('forked', 'localhost', 6379, db=6)
+    pool = ormist.get_redis('forked').connection_pool
+    pool.get_connection('PING')
+    assert ormist.pool_stats('forked')['in_use'] == 1
+    with mock.patch('os.getpid', return_value=os.getpid() + 1):
+        assert ormist.pool_stats('forked')['created'] == 0
+
+#--- Test for instrumentation
+
+class InstrumentedBook(ormist.TaggedModel):
+    instrumentation = ormist.Instrumentation()
+
+
+def pytest_funcarg__instrumentation(request):
+    instrumentation = InstrumentedBook.objects.instrumentation
+    instrumentation.reset()
+    request.addfinalizer(InstrumentedBook.objects.full_cleanup)
+    return instrumentation
+
+
+def test_instrumentation_stats(instrumentation):
+    book = InstrumentedBook('foo', id=1234, title='Foo')
+    book.save()
+    InstrumentedBook.objects.get(1234)
+    InstrumentedBook.objects.get_many([1234, 1235])
+    stats = instrumentation.stats()['instrumented_book']
+    assert stats['get']['count'] == 2
+    assert stats['get']['round_trips'] == 2
+    assert stats['get']['pipelines'] == 2
+    assert stats['get']['commands']['SMEMBERS'] == 3
+    assert stats['get']['latency'][-1] == (float('inf'), 2)
+    assert stats['get']['serialization_time'] > 0
+    assert stats['save']['count'] == 1
+    assert stats['save']['commands']['EVALSHA'] == 1
+    book.delete()
+    assert instrumentation.stats()['instrumented_book']['delete']['count'] == 1
+
+
+def test_instrumentation_of_result_sets(instrumentation):
+    InstrumentedBook('foo', id=1234, title='Foo').save()
+    InstrumentedBook('foo', id=1235, title='Bar').save()
+    with mock.patch.object(InstrumentedBook.objects, 'chunk_size', 1):
+        for book in InstrumentedBook.objects.find('foo'):
+            # commands of consumers are not accounted to the iteration
+            InstrumentedBook.objects.get(book.id)
+    assert InstrumentedBook.objects.find('foo').count() == 2
+    stats = instrumentation.stats()['instrumented_book']
+    assert stats['find']['count'] == 1
+    assert stats['find']['commands']['SSCAN'] >= 1
+    assert stats['get']['count'] == 2
+    assert stats['count']['count'] == 1
+
+
+def test_instrumentation_hooks(instrumentation):
+    calls = []
+    def failing_hook(operation):
+        raise ValueError()
+    instrumentation.add_hook(before=lambda op: calls.append(('before', op.name)),
+                             after=lambda op: calls.append(('after', op.name,
+                                                            op.round_trips)))
+    instrumentation.add_hook(after=failing_hook)
+    try:
+        InstrumentedBook.objects.exists(1234)
+    finally:
+        del instrumentation.before_hooks[:], instrumentation.after_hooks[:]
+    assert calls == [('before', 'exists'), ('after', 'exists', 1)]
+
+
+def test_slow_log(instrumentation):
+    InstrumentedBook.objects.get(1234)
+    assert len(instrumentation.slow_log) == 0
+    instrumentation.slow_threshold = 0
+    try:
+        InstrumentedBook.objects.get(1234)
+    finally:
+        instrumentation.slow_threshold = None
+    operation, = instrumentation.slow_log
+    assert (operation.model, operation.name) == ('instrumented_book', 'get')
+
+
+def test_instrumentation_round_trips(instrumentation):
+    key = 'ormist:instrumented_book:scanned'
+    redis = ormist.get_redis()
+    redis.sadd(key, *['id%d' % i for i in range(200)])
+    pages, cursor = 0, 0
+    while not pages or int(cursor):
+        cursor, _ = redis.sscan(key, cursor, count=20)
+        pages += 1
+    operation = instrumentation.operation('instrumented_book', 'scan', 'default')
+    client = operation.trace(redis)
+    # every page of the scan is a round trip
+    assert len(set(client.sscan_iter(key, count=20))) == 200
+    assert operation.round_trips == operation.commands['SSCAN'] == pages
+    assert list(client.scan_iter('ormist:instrumented_book:*')) == [b(key)]
+    assert operation.round_trips == pages + operation.commands['SCAN']
+    # empty pipelines are not sent
+    round_trips = operation.round_trips
+    client.pipeline().execute()
+    assert operation.round_trips == round_trips
+    assert operation.pipelines == []
+
+
+def test_instrumentation_of_pipelines_in_with_blocks(instrumentation):
+    operation = instrumentation.operation('instrumented_book', 'with', 'default')
+    with operation.trace(ormist.get_redis()).pipeline() as pipe:
+        pipe.get('ormist:instrumented_book:missing')
+        assert pipe.execute() == [None]
+    assert operation.pipelines == [1]
+    # repair of tags without scripting uses the pipeline in the with block
+    operation = instrumentation.operation('cluster_book', 'repair', 'default')
+    with operation:
+        ClusterBook.objects.repair_tags()
+    assert operation.round_trips > 0
+
+
+def test_system_instrumentation():
+    instrumentation = ormist.Instrumentation()
+    ormist.setup_redis('instrumented', 'localhost', 6379, db=7,
+                       instrumentation=instrumentation)
+    User.objects.get(1234, system='instrumented')
+    assert instrumentation.stats()['user']['get']['count'] == 1
+
+#--- Test for id strategies
+
+class Invoice(ormist.Model):
+    id_strategy = ormist.SequenceIds(block_size=3)
+
+
+class Event(ormist.Model):
+    id_strategy = ormist.TimeOrderedIds()
+
+
+class Visit(ormist.Model):
+    id_strategy = ormist.RandomIds(check=False)
+
+
+def pytest_funcarg__invoices(request):
+    # every test starts with a new counter and no blocks
+    Invoice.objects.id_strategy = ormist.SequenceIds(block_size=3)
+    def cleanup():
+        Invoice.objects.full_cleanup()
+        ormist.get_redis().delete('ormist:invoice:__sequence__')
+    request.addfinalizer(cleanup)
+
+
+def test_sequence_ids(invoices):
+    redis = ormist.get_redis()
+    assert [Invoice.objects.create(n=i).id for i in range(2)] == ['1', '2']
+    assert redis.get('ormist:invoice:__sequence__') == b('3')
+    invoices = Invoice.objects.create_many([{'n': i} for i in range(5)])
+    assert [invoice.id for invoice in invoices] == ['3', '4', '5', '6', '7']
+    assert redis.get('ormist:invoice:__sequence__') == b('9')
+    assert Invoice.objects.get('7').n == 4
+
+
+def test_sequence_ids_after_fork(invoices):
+    assert Invoice.objects.create().id == '1'
+    with mock.patch('os.getpid', return_value=os.getpid() + 1):
+        # the child process doesn't reuse the block of the parent
+        assert Invoice.objects.create().id == '4'
+
+
+def test_sequence_ids_survive_cleanup(invoices):
+    assert Invoice.objects.create().id == '1'
+    Invoice.objects.full_cleanup()
+    assert Invoice.objects.get('1') is None
+    # another process reserves the next block
+    other_process = ormist.SequenceIds(block_size=3)
+    assert other_process.generate(Invoice.objects, 1, 'default') == ['4']
+    assert Invoice.objects.create().id == '2'
+
+
+def test_time_ordered_ids():
+    strategy = ormist.TimeOrderedIds()
+    first = strategy.new_id(timestamp=1500000000)
+    second = strategy.new_id(timestamp=1500000000.001)
+    assert len(first) == 26
+    assert first < second
+    assert first[:10] == strategy.new_id(timestamp=1500000000)[:10]
+
+
+def test_local_ids_dont_depend_on_random_state():
+    # forked processes share the state of the random module before 3.7
+    state = random.getstate()
+    ids = [ormist.TimeOrderedIds().new_id(0), ormist.random_string(16)]
+    random.setstate(state)
+    assert [ormist.TimeOrderedIds().new_id(0), ormist.random_string(16)] != ids
+
+
+def test_random_string_corpus():
+    value = ormist.random_string(1000)
+    assert len(value) == 1000 and value.isalnum()
+    assert set(ormist.random_string(100, 'ab')) == set('ab')
+    assert ormist.random_string(3, u('\xe9')) == u('\xe9\xe9\xe9')
+
+
+def test_local_ids_take_no_round_trips():
+    with mock.patch.object(ormist.ModelManager, 'reserve_random_id') as reserve:
+        event = Event.objects.create(name='click')
+        visit = Visit.objects.create(path='/')
+    assert not reserve.called
+    assert len(event.id) == 26
+    assert len(visit.id) == 16
+    assert Event.objects.get(event.id).name == 'click'
+    assert [v.id for v in Visit.objects.all()] == [visit.id]
+    Event.objects.full_cleanup()
+    Visit.objects.full_cleanup()
+
+#--- Test for compact models
+
+class CompactUser(ormist.Model):
+    compact = True
+
+
+class CompactProfile(ormist.Model):
+    compact = True
+    storage = 'hash'
+    cache = ormist.LocalCache()
+
+
+def pytest_funcarg__compact_profile(request):
+    profile = CompactProfile(id=1234, name='John', bio='...', age=30)
+    profile.save()
+    request.addfinalizer(CompactProfile.objects.full_cleanup)
+    return profile
+
+
+def test_compact_instances_have_no_dict():
+    user = CompactUser(name='John')
+    assert not hasattr(user, '__dict__')
+    with pytest.raises(AttributeError):
+        user.nickname = 'johnny'
+    assert hasattr(Book('foo'), '__dict__')
+
+
+def test_compact_instances_decode_lazily():
+    CompactUser(id=1234, name='John', age=30).save()
+    with mock.patch('ormist.serializers.loads', wraps=ormist.serializers.loads) as loads:
+        user = CompactUser.objects.get(1234)
+        assert not loads.called
+        assert user.name == 'John'
+        assert user.age == 30
+    assert loads.call_count == 1
+    user.set(age=31)
+    user.save()
+    assert CompactUser.objects.get(1234).attrs == {'name': 'John', 'age': 31}
+    CompactUser.objects.full_cleanup()
+
+
+def test_compact_hashes_decode_accessed_fields(compact_profile):
+    with mock.patch('ormist.serializers.loads', wraps=ormist.serializers.loads) as loads:
+        profiles = CompactProfile.objects.get_many([1234, 1234])
+        assert [profile.name for profile in profiles] == ['John', 'John']
+    assert loads.call_count == 2
+    profile = profiles[0]
+    profile.set(name='Jane')
+    profile.save()
+    assert CompactProfile.objects.get(1234).attrs == {'name': 'Jane', 'bio': '...',
+                                                      'age': 30}
+    assert profiles[1].attrs == {'name': 'John', 'bio': '...', 'age': 30}
+
+
+def test_models_pickled(compact_profile, book):
+    for protocol in (0, 2):
+        profile = CompactProfile.objects.get(1234)
+        for instance in (profile, Book.objects.get(book.id), User(id=1, name='John')):
+            copy = pickle.loads(pickle.dumps(instance, protocol))
+            assert (copy.id, copy.expire) == (instance.id, instance.expire)
+            assert copy.attrs == instance.attrs
+        assert copy.name == 'John'
+        copy = pickle.loads(pickle.dumps(Book.objects.get(book.id), protocol))
+        assert sorted(copy.tags) == sorted(book.tags)
+        copy.set(title='Changed %d' % protocol)
+        copy.save()
+        assert Book.objects.get(book.id).title == 'Changed %d' % protocol
+
+
+def test_compact_decoding_is_instrumented(compact_profile):
+    instrumentation = ormist.Instrumentation()
+    profile = CompactProfile.objects.get(1234)
+    with instrumentation.operation('compact_profile', 'show', 'default'):
+        assert profile.name == 'John'
+        assert profile.attrs['age'] == 30
+    stats = instrumentation.stats()['compact_profile']['show']
+    assert stats['serialization_time'] > 0
+
+#--- Test for native TTLs
+
+class NativeBook(ormist.TaggedModel):
+    native_ttl = True
+
+
+def pttl(key):
+    # redis-py 2.x returns None for keys without TTL
+    ttl = ormist.get_redis().pttl(key)
+    return -1 if ttl is None else ttl
+
+
+def pytest_funcarg__native_book(request):
+    book = NativeBook('foo', id=1234, title='Foo', expire=100)
+    book.save()
+    request.addfinalizer(NativeBook.objects.full_cleanup)
+    return book
+
+
+def test_native_ttl_save(native_book):
+    redis = ormist.get_redis()
+    assert 99000 < redis.pttl('ormist:native_book:object:1234') <= 100000
+    assert pttl('ormist:native_book:object:1234:tags') < 0
+    assert not redis.exists('ormist:native_book:object:1234:expire')
+    assert redis.zscore('ormist:native_book:__expire__', '1234')
+    # TTL survives rewrites of the object
+    native_book.set(title='Bar')
+    native_book.save()
+    assert redis.pttl('ormist:native_book:object:1234') > 99000
+    native_book.set_expire(None)
+    native_book.save()
+    assert pttl('ormist:native_book:object:1234') < 0
+    assert not redis.zscore('ormist:native_book:__expire__', '1234')
+
+
+def test_native_ttl_load(native_book):
+    book = NativeBook.objects.get(1234)
+    assert abs((book.expire - native_book.expire).total_seconds()) < 1
+    assert book.tags == ['foo']
+    book.save()
+    assert ormist.get_redis().pttl('ormist:native_book:object:1234') > 99000
+
+
+def test_native_ttl_expired(native_book):
+    redis = ormist.get_redis()
+    # Redis removes the object, but not its tags and ids in sets
+    redis.pexpireat('ormist:native_book:object:1234', 1000)
+    assert NativeBook.objects.get(1234) is None
+    assert not NativeBook.objects.exists(1234)
+    assert NativeBook.objects.find('foo').list() == []
+    with mock.patch('ormist.managers.utcnow') as utcnow:
+        utcnow.return_value = datetime.datetime.utcnow() + datetime.timedelta(seconds=200)
+        assert NativeBook.objects.expire() == 1
+    assert not redis.exists('ormist:native_book:tags:foo')
+    assert not redis.exists('ormist:native_book:object:1234:tags')
+
+#--- Test for repair of tag indexes
+
+def pytest_funcarg__stale_tags(request):
+    redis = ormist.get_redis()
+    redis.sadd('ormist:book:tags:foo', 'ghost1', 'ghost2')
+    redis.sadd('ormist:book:tags:ghosts', 'ghost3')
+    request.addfinalizer(lambda: redis.delete('ormist:book:tags:foo',
+                                              'ormist:book:tags:ghosts'))
+
+
+def test_repair_tags_dry_run(book, stale_tags):
+    report = Book.objects.repair_tags(dry_run=True)
+    assert report.tags == 3
+    assert report.checked == 5
+    assert (report.stale, report.removed) == (3, 0)
+    assert report.stale_by_tag == {'foo': 2, 'ghosts': 1}
+    assert len(Book.objects.find_ids('foo')) == 3
+
+
+def test_repair_tags(book, stale_tags):
+    reports = []
+    report = Book.objects.repair_tags(batch_size=2, callback=reports.append)
+    assert (report.stale, report.removed) == (3, 3)
+    assert len(reports) == 4
+    assert Book.objects.find_ids('foo') == set([b('1234')])
+    assert Book.objects.find_ids('bar') == set([b('1234')])
+    assert not ormist.get_redis().exists('ormist:book:tags:ghosts')
+    assert Book.objects.repair_tags().stale == 0
+
+
+def test_repair_tags_without_scripting(book, stale_tags):
+    with mock.patch.object(Book.objects, 'scripting', False):
+        with mock.patch.object(Book.objects, '_queue_script') as queue_script:
+            report = Book.objects.repair_tags(batch_size=2)
+    assert not queue_script.called
+    assert (report.stale, report.removed) == (3, 3)
+    assert Book.objects.find_ids('foo') == set([b('1234')])
+
+
+def test_repair_tags_counts_ids_once(book, stale_tags):
+    def sscan_iter(key, count=None):
+        # SSCAN returns ids again, when the set is rehashed
+        return iter(sorted(redis.smembers(key)) * 2)
+    redis = ormist.get_redis()
+    with mock.patch.object(redis, 'sscan_iter', sscan_iter):
+        report = Book.objects.repair_tags(dry_run=True)
+        assert report.stale_by_tag == {'foo': 2, 'ghosts': 1}
+        for scripting in (True, False):
+            redis.sadd('ormist:book:tags:foo', 'ghost1', 'ghost2')
+            redis.sadd('ormist:book:tags:ghosts', 'ghost3')
+            with mock.patch.object(Book.objects, 'scripting', scripting):
+                report = Book.objects.repair_tags(batch_size=1)
+            assert (report.stale, report.removed) == (3, 3)
+
+
+def test_repair_tags_rate_limit(book):
+    with mock.patch('ormist.repair.time.sleep') as sleep:
+        Book.objects.repair_tags(batch_size=1, rate_limit=1)
+    assert sleep.call_count == 2
+
+#--- Test for cached intersections
+
+class CachedBook(ormist.TaggedModel):
+    query_cache_ttl = 30
+    indexes = ['year']
+
+
+class CachedClusterBook(ormist.TaggedModel):
+    query_cache_ttl = 30
+    cluster = True
+
+
+def pytest_funcarg__cached_books(request):
+    for model in (CachedBook, CachedClusterBook):
+        model('foo', 'bar', id=1, title='One', year=2001).save()
+        model('foo', id=2, title='Two', year=2002).save()
+        request.addfinalizer(model.objects.full_cleanup)
+
+
+def query_keys(model):
+    return ormist.get_redis().keys('ormist:*%s*:__query__:*' % model.objects.model_name)
+
+
+def test_cached_intersection(cached_books):
+    assert [b.id for b in CachedBook.objects.find('foo', 'bar')] == ['1']
+    keys = query_keys(CachedBook)
+    assert len(keys) == 1
+    assert 0 < ormist.get_redis().ttl(keys[0]) <= 30
+    # the order of tags doesn't matter
+    assert [b.id for b in CachedBook.objects.find('bar', 'foo')] == ['1']
+    assert CachedBook.objects.find('bar', 'foo').count() == 1
+    assert query_keys(CachedBook) == keys
+    # single tags and empty intersections aren't cached
+    assert len(CachedBook.objects.find('foo').list()) == 2
+    assert CachedBook.objects.find('foo', 'baz').list() == []
+    assert query_keys(CachedBook) == keys
+
+
+def test_cached_intersection_served_from_cache(cached_books):
+    CachedBook.objects.find('foo', 'bar').list()
+    # writes bypassing the manager aren't seen until the cache expires
+    ormist.get_redis().sadd('ormist:cached_book:tags:bar', '2')
+    assert CachedBook.objects.find('foo', 'bar').count() == 1
+
+
+def test_cached_intersection_invalidated(cached_books):
+    for model in (CachedBook, CachedClusterBook):
+        assert model.objects.find('foo', 'bar').count() == 1
+        book = model.objects.get(2)
+        book.tags.append('bar')
+        book.save()
+        assert model.objects.find('foo', 'bar').count() == 2
+        assert len(query_keys(model)) == 2
+        # saves, which don't change tags, keep the cache
+        book.title = 'Two again'
+        book.save()
+        assert model.objects.find('foo', 'bar').count() == 2
+        assert len(query_keys(model)) == 2
+        model.objects.get(1).delete()
+        assert [b.id for b in model.objects.find('foo', 'bar')] == ['2']
+        assert len(query_keys(model)) == 3
+
+
+def test_cached_intersection_write_during_iteration(cached_books):
+    for model in (CachedBook, CachedClusterBook):
+        model.objects.save_many([model('foo', 'bar', id=100 + i, title='Book')
+                                 for i in range(20)])
+        ids = set()
+        with mock.patch.object(model.objects, 'chunk_size', 5):
+            for book in model.objects.find('foo', 'bar'):
+                if not ids:
+                    model('foo', id=200, title='Unrelated').save()
+                    model.objects.get(1).delete()
+                ids.add(book.id)
+        # the iteration keeps reading the intersection it has started with,
+        # but deleted objects are skipped on load
+        assert len(ids) in (20, 21)
+        assert set(str(100 + i) for i in range(20)) <= ids
+        assert model.objects.find('foo', 'bar').count() == 20
+
+
+def test_cached_intersection_with_ordering(cached_books):
+    books = CachedBook.objects.find('foo', 'bar').order_by('-year')
+    assert [b.id for b in books] == ['1']
+    assert len(query_keys(CachedBook)) == 1
+    # the ordered result is stored in the temporary key, which expires
+    keys = ormist.get_redis().keys('ormist:cached_book:__tmp__:*')
+    assert len(keys) == 1
+    assert 0 < ormist.get_redis().ttl(keys[0]) <= CachedBook.objects.temp_key_ttl
+
+#--- Test for server-side scripts
+
+def test_save_tags_with_stale_instance(book):
+    book1 = Book.objects.get(book.id)
+    book2 = Book.objects.get(book.id)
+    book1.tags = ['foo', 'bar', 'baz']
+    book1.save()
+    book2.tags = ['foo']
+    book2.save()
+    assert Book.objects.get(book.id).tags == ['foo']
+    assert Book.objects.find('baz').list() == []
+
+
+def test_scripts_reloaded(book, tags):
+    ormist.get_redis().script_flush()
+    book.tags = ['foo']
+    book.save()
+    assert Book.objects.find('bar').list() == []
+    ormist.get_redis().script_flush()
+    book.delete()
+    assert Book.objects.find('foo').list() == []
+
+
+def test_tags_without_scripting(book, tags):
+    with mock.patch.object(Book.objects, 'scripting', False):
+        book.tags = ['foo', 'baz']
+        book.save()
+        assert set(Book.objects.get(book.id).tags) == set(['foo', 'baz'])
+        assert Book.objects.find('bar').list() == []
+        book.delete()
+        assert Book.objects.find('foo').list() == []
+
+#--- Test for local cache
+
+class CachedUser(ormist.Model):
+    cache = ormist.LocalCache(maxsize=2, ttl=10)
+
+
+def pytest_funcarg__cached_user(request):
+    user = CachedUser(id=1234, name='John Doe')
+    user.save()
+    CachedUser.objects.cache.clear()
+    request.addfinalizer(CachedUser.objects.full_cleanup)
+    return user
+
+
+def test_cache_hit(cached_user):
+    cache = CachedUser.objects.cache
+    hits = cache.hits
+    assert CachedUser.objects.get(1234).name == 'John Doe'
+    ormist.get_redis().delete('ormist:cached_user:object:1234')
+    assert CachedUser.objects.get(1234).name == 'John Doe'
+    assert cache.hits == hits + 1
+
+
+def test_cache_invalidated_on_save_and_delete(cached_user):
+    user = CachedUser.objects.get(1234)
+    user.set(name='Jane Doe')
+    user.save()
+    assert CachedUser.objects.get(1234).name == 'Jane Doe'
+    user.delete()
+    assert CachedUser.objects.get(1234) is None
+
+
+def test_cache_honors_expire(cached_user):
+    cached_user.set_expire(10)
+    cached_user.save()
+    CachedUser.objects.get(1234)
+    with mock.patch('ormist.cache.utcnow') as utcnow:
+        utcnow.return_value = datetime.datetime.utcnow() + datetime.timedelta(seconds=20)
+        assert CachedUser.objects.cache.get(('default', '1234')) is None
+
+
+def test_cache_eviction(cached_user):
+    cache = CachedUser.objects.cache
+    evictions = cache.evictions
+    users = CachedUser.objects.create_many([{}, {}])
+    CachedUser.objects.get_many([cached_user.id] + [user.id for user in users])
+    assert len(cache) == 2
+    assert cache.evictions == evictions + 1
+
+
+def test_cache_drops_records_invalidated_while_loading(cached_user):
+    execute = []
+
+    def save_meanwhile(pipe_execute):
+        def wrapper(*args, **kwargs):
+            replies = pipe_execute(*args, **kwargs)
+            if not execute:
+                # another thread saves the object, after it's been loaded
+                execute.append(1)
+                user = CachedUser(id=1234, name='Jane Doe')
+                user.save()
+            return replies
+        return wrapper
+
+    redis = ormist.get_redis()
+    pipeline = redis.pipeline
+
+    def patched_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        pipe.execute = save_meanwhile(pipe.execute)
+        return pipe
+
+    with mock.patch.object(redis, 'pipeline', patched_pipeline):
+        assert CachedUser.objects.get(1234).name == 'John Doe'
+    assert CachedUser.objects.get(1234).name == 'Jane Doe'
+
+
+def test_cache_drops_records_loaded_before_write_is_executed(cached_user):
+    user = CachedUser.objects.get(1234)
+    user.set(name='Jane Doe')
+    pipe = ormist.get_redis().pipeline()
+    CachedUser.objects.save_instance(user, pipe=pipe, apply=False)
+    assert CachedUser.objects.get(1234).name == 'John Doe'
+    pipe.execute()
+    assert CachedUser.objects.get(1234).name == 'Jane Doe'
+    # writes executed by the manager release the hold
+    user.set(name='John Doe')
+    user.save()
+    hits = CachedUser.objects.cache.hits
+    CachedUser.objects.get(1234)
+    assert CachedUser.objects.get(1234).name == 'John Doe'
+    assert CachedUser.objects.cache.hits == hits + 1
+
+
+class CachedReplicatedUser(ormist.Model):
+    system = 'replicated'
+    cache = ormist.LocalCache(maxsize=10, ttl=10)
+
+
+def test_cache_holds_records_of_lagging_replicas():
+    user = CachedReplicatedUser(id=1234, name='John Doe')
+    user.save()
+    primary = ormist.get_redis('replicated')
+    replica = ormist.get_read_redis('replicated')
+    key = 'ormist:cached_replicated_user:object:1234'
+    try:
+        replica.set(key, primary.get(key))
+        user.set(name='Jane Doe')
+        user.save()
+        # the replica lags behind
+        assert CachedReplicatedUser.objects.get(1234).name == 'John Doe'
+        replica.set(key, primary.get(key))
+        assert CachedReplicatedUser.objects.get(1234).name == 'Jane Doe'
+    finally:
+        replica.delete(key)
+        CachedReplicatedUser.objects.full_cleanup()
+
+
+def test_cache_non_ascii_ids():
+    user = CachedUser(id=u('\xe9t\xe9'), name='Summer')
+    user.save()
+    assert CachedUser.objects.get(u('\xe9t\xe9')).name == 'Summer'
+    user.set(name='Autumn')
+    user.save()
+    assert CachedUser.objects.get(u('\xe9t\xe9')).name == 'Autumn'
+    CachedUser.objects.full_cleanup()
+
+
+def test_cache_invalidated_by_other_process(cached_user):
+    import time
+    CachedUser.objects.listen_invalidations()
+    time.sleep(0.1)
+    CachedUser.objects.get(1234)
+    assert len(CachedUser.objects.cache) == 1
+    ormist.get_redis().publish('ormist:cached_user:__invalidate__', '1234')
+    for _ in range(100):
+        if not len(CachedUser.objects.cache):
+            break
+        time.sleep(0.01)
+    assert len(CachedUser.objects.cache) == 0
+
+#--- Test for asyncio support
+
+try:
+    import asyncio
+    import redis.asyncio
+except ImportError:
+    asyncio = None
+
+requires_asyncio = pytest.mark.skipif(
+    asyncio is None or not hasattr(ormist.ModelManager, 'aget'),
+    reason='requires Python 3.6+ and redis.asyncio')
+
+_loop = []
+
+
+def run(coroutine):
+    # async clients are bound to the event loop, so we use the same one
+    if not _loop:
+        _loop.append(asyncio.new_event_loop())
+    return _loop[0].run_until_complete(coroutine)
+
+
+@requires_asyncio
+def test_async_create_and_get():
+    user = run(User.objects.acreate(name='John Doe', age=30))
+    assert User.objects.get(user.id).name == 'John Doe'
+    same_user = run(User.objects.aget(user.id))
+    assert same_user.attrs == {'name': 'John Doe', 'age': 30}
+    assert run(User.objects.aget('missing')) is None
+
+
+@requires_asyncio
+def test_async_save_writes_changes(user):
+    user = run(User.objects.aget(1234))
+    user.set(age=31)
+    run(User.objects.asave_instance(user))
+    assert User.objects.get(1234).age == 31
+
+
+@requires_asyncio
+def test_async_create_keeps_system_attribute():
+    user = run(User.objects.acreate(name='John Doe', system='Linux'))
+    assert User.objects.get(user.id).system == 'Linux'
+
+
+@requires_asyncio
+def test_async_without_client_for_custom_redis():
+    ormist.setup_redis('custom', 'localhost', 6379, db=6)
+    ormist.setup_redis('custom', redis=ormist.get_redis('db1'))
+    with pytest.raises(KeyError):
+        run(User.objects.aget(1234, system='custom'))
+
+
+@requires_asyncio
+def test_async_get_many_and_delete(user):
+    users = run(User.objects.aget_many([1234, 'missing']))
+    assert [u.id for u in users] == ['1234']
+    run(User.objects.adelete_instance(users[0]))
+    assert User.objects.get(1234) is None
+
+
+@requires_asyncio
+def test_async_find(book):
+    books = run(Book.objects.afind('foo', 'bar').alist())
+    assert [b.title for b in books] == ['How to Foo and Bar']
+    assert run(Book.objects.afind('foo', 'baz').acount()) == 0
+    assert run(Book.objects.afind().acount()) == 0
+    run(Book.objects.adelete_many([book]))
+    assert Book.objects.find('foo').list() == []
+    book.save()
+    assert [b.id for b in Book.objects.find('foo')] == [book.id]
+
+
+@requires_asyncio
+def test_async_find_query(book):
+    other = Book.objects.create('baz', title='Baz')
+    books = run(Book.objects.afind(Q('foo') | Q('baz')).alist())
+    assert sorted(b.id for b in books) == sorted([book.id, other.id])
+    books = run(Book.objects.afind(~Q('foo')).alist())
+    assert [b.id for b in books] == [other.id]
+    assert not list(ormist.get_redis().scan_iter('ormist:book:__tmp__:*'))
+    other.delete()
+
+
+@requires_asyncio
+def test_async_find_tagged_attrs(tagged_user):
+    users = run(TaggedUser.objects.afind(age=30).alist())
+    assert [u.id for u in users] == ['1234']
+
+
+@requires_asyncio
+def test_async_iteration(user):
+    iterator = User.objects.aall().only('name').__aiter__()
+    first = run(iterator.__anext__())
+    assert first.name == 'John Doe'
+    with pytest.raises(StopAsyncIteration):
+        run(iterator.__anext__())
+
+
+@requires_asyncio
+def test_async_sharding(sharded_books):
+    book = run(ShardedBook.objects.acreate('new', year=2020))
+    assert run(ShardedBook.objects.aget(book.id)).year == 2020
+    assert run(ShardedBook.objects.aall().acount()) == 21
+    run(ShardedBook.objects.adelete_many(sharded_books))
+    assert [b.id for b in ShardedBook.objects.all()] == [book.id]
+
+
+@requires_asyncio
+def test_async_sequence_ids(invoices):
+    assert Invoice.objects.create().id == '1'
+    ids = [run(Invoice.objects.acreate()).id for _ in range(3)]
+    assert ids == ['2', '3', '4']
+    assert run(Invoice.objects.aget('4')) is not None